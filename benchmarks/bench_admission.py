@@ -0,0 +1,88 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares the hit ratios of the check cache's eviction policies.
+
+The replayed keys are drawn from a Zipf distribution, so that a few hot keys
+account for most of the lookups, as API keys do.  Periodically, a scan of keys
+that are only used once is interleaved, like a burst of one-off API keys from
+a crawler.  Each policy's cache is created by
+:func:`endpoints_management.control.caches.create` with the default number of
+check cache entries; the cache's timer does not advance, so entries are only
+removed by eviction.
+
+Usage::
+
+  PYTHONPATH=. python benchmarks/bench_admission.py [number_of_lookups]
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import itertools
+import random
+import sys
+import time
+from datetime import datetime
+
+from endpoints_management.control import caches
+
+_NUM_KEYS = 20000
+_ZIPF_EXPONENT = 1.0
+_SCAN_EVERY = 5000
+_SCAN_LENGTH = 1000
+
+
+def _make_trace(number, seed=17):
+    rand = random.Random(seed)
+    weights = [1.0 / (rank ** _ZIPF_EXPONENT) for rank in range(1, _NUM_KEYS + 1)]
+    cum_weights = list(itertools.accumulate(weights))
+    hot = rand.choices(range(_NUM_KEYS), cum_weights=cum_weights, k=number)
+    one_off = itertools.count(_NUM_KEYS)
+    trace = []
+    for start in range(0, number, _SCAN_EVERY):
+        trace.extend(u'key-%d' % (k,) for k in hot[start:start + _SCAN_EVERY])
+        trace.extend(u'key-%d' % (next(one_off),) for _ in range(_SCAN_LENGTH))
+    return trace
+
+
+def _replay(policy, trace):
+    options = caches.CheckOptions(eviction_policy=policy)
+    start = datetime.utcnow()
+    hits = 0
+    with caches.create(options, timer=lambda: start) as cache:
+        for key in trace:
+            if cache.get(key) is None:
+                cache[key] = key
+            else:
+                hits += 1
+    return hits
+
+
+def main(argv):
+    number = int(argv[1]) if len(argv) > 1 else 200000
+    trace = _make_trace(number)
+    print(u'%d lookups, of which %d are from scans' % (
+        len(trace), len(trace) - number))
+    for policy in caches.EVICTION_POLICIES:
+        started = time.time()
+        hits = _replay(policy, trace)
+        secs = time.time() - started
+        print(u'%-8s hit ratio %5.1f%% %10.0f lookups/sec' % (
+            policy, 100.0 * hits / len(trace), len(trace) / secs))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,110 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares the memory used by the pending report operation aggregates.
+
+Each of a number of distinct operations is reported a few times, with all the
+known metrics and labels but no logs, and aggregated by both
+:class:`endpoints_management.control.operation.Aggregator` and
+:class:`endpoints_management.control.operation.CompactAggregator`.  The memory
+still allocated once the reported operations are discarded is measured using
+``tracemalloc``, along with the time taken to make the aggregated operations.
+Both hold the reported log entries in the same way, so they are left out.
+
+Usage::
+
+  PYTHONPATH=. python benchmarks/bench_aggregate_memory.py [number_of_operations]
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import gc
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from endpoints_management.control import (label_descriptor, metric_descriptor,
+                                          operation, report_request)
+
+_REPORTS_PER_OPERATION = 3
+
+
+def _make_rules():
+    # pylint: disable=no-member
+    return report_request.ReportingRules.from_known_inputs(
+        metric_names=[m.metric_name for m in
+                      metric_descriptor.KnownMetrics.__members__.values()],
+        label_names=[l.label_name for l in
+                     label_descriptor.KnownLabels.__members__.values()])
+
+
+def _make_operation(rules, template, index, attempt):
+    info = report_request.Info(
+        api_key=u'api-key-%d' % (index,),
+        api_key_valid=True,
+        backend_time=timedelta(milliseconds=10 + attempt),
+        consumer_project_number=index,
+        method=u'GET',
+        operation_id=u'op-%d-%d' % (index, attempt),
+        operation_name=u'a_service.AMethod',
+        overhead_time=timedelta(milliseconds=1),
+        referer=u'https://example.com/a/page',
+        request_size=100 + attempt,
+        request_time=timedelta(milliseconds=12 + attempt),
+        response_code=200,
+        response_size=1000 + attempt,
+        service_name=u'a_service',
+        url=u'https://a_service.example.com/v1/things')
+    when = datetime(2017, 1, 1, 0, 0, attempt)
+    req = info.as_report_request(rules, timer=lambda: when, template=template)
+    return req.reportRequest.operations[0]
+
+
+def _measure(agg_cls, rules, template, number):
+    gc.collect()
+    tracemalloc.start()
+    aggs = []
+    for index in range(number):
+        agg = agg_cls(_make_operation(rules, template, index, 0))
+        for attempt in range(1, _REPORTS_PER_OPERATION):
+            agg.add(_make_operation(rules, template, index, attempt))
+        aggs.append(agg)
+    gc.collect()
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    started = time.time()
+    for agg in aggs:
+        agg.as_operation()
+    return used, time.time() - started
+
+
+def main(argv):
+    number = int(argv[1]) if len(argv) > 1 else 500
+    rules = _make_rules()
+    template = report_request.Template(
+        rules, report_request.ReportedPlatforms.UNKNOWN)
+    for agg_cls in (operation.Aggregator, operation.CompactAggregator):
+        used, secs = _measure(agg_cls, rules, template, number)
+        print(u'%-18s %8.1f MB %8.1f KB/operation %8.0f as_operation/sec' % (
+            agg_cls.__name__, used / 2 ** 20, used / 2 ** 10 / number,
+            number / secs))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
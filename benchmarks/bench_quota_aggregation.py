@@ -0,0 +1,113 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures the aggregation of quota operations with the same signature.
+
+Each round makes an aggregator from an operation, merges further operations
+into it and makes the aggregated ``QuotaOperation``, as a cached quota item
+does between refreshes.  The operations are those made by
+:meth:`endpoints_management.control.quota_request.Info.as_allocate_quota_request`
+for a method with two quota metrics.
+
+:class:`endpoints_management.control.quota_request.QuotaOperationAggregator`
+is compared with ``DeepCopyAggregator``, a copy of its previous
+implementation, which deep copied the operations and merged every metric
+value using :func:`endpoints_management.control.metric_value.merge`.
+
+Usage::
+
+  PYTHONPATH=. python benchmarks/bench_quota_aggregation.py [number_of_rounds]
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import copy
+import sys
+import time
+from datetime import datetime
+
+from endpoints_management.control import metric_value, quota_request, sc_messages
+
+_MERGES_PER_ROUND = 10
+
+
+class DeepCopyAggregator(object):
+    """The previous implementation of ``QuotaOperationAggregator``."""
+
+    def __init__(self, op):
+        self.op = copy.deepcopy(op)
+        self.op.quotaMetrics = []
+        self.metric_value_sets = {}
+        self.merge_operation(op)
+
+    def merge_operation(self, op):
+        for mv_set in op.quotaMetrics:
+            metric_name = mv_set.metricName
+            if metric_name not in self.metric_value_sets:
+                self.metric_value_sets[metric_name] = mv_set.metricValues[0]
+            else:
+                self.metric_value_sets[metric_name] = metric_value.merge(
+                    metric_value.MetricKind.DELTA,
+                    self.metric_value_sets[metric_name],
+                    mv_set.metricValues[0])
+
+    def as_quota_operation(self):
+        op = copy.deepcopy(self.op)
+        for m_name, m_value in list(self.metric_value_sets.items()):
+            op.quotaMetrics.append(sc_messages.MetricValueSet(
+                metricName=m_name, metricValues=[m_value]))
+        return op
+
+
+def _make_operations():
+    info = quota_request.Info(
+        api_key=u'api-key',
+        api_key_valid=True,
+        client_ip=u'10.0.0.1',
+        operation_name=u'a_service.AMethod',
+        quota_info={u'read_requests': 1, u'expensive_requests': 5},
+        referer=u'https://example.com/a/page',
+        service_name=u'a_service')
+    when = datetime(2017, 1, 1)
+    return [
+        info._replace(operation_id=u'op-%d' % (index,)).as_allocate_quota_request(
+            timer=lambda: when).allocateQuotaRequest.allocateOperation
+        for index in range(_MERGES_PER_ROUND + 1)]
+
+
+def _measure(agg_cls, ops, rounds):
+    first, rest = ops[0], ops[1:]
+    started = time.time()
+    for _ in range(rounds):
+        agg = agg_cls(first)
+        for op in rest:
+            agg.merge_operation(op)
+        agg.as_quota_operation()
+    return time.time() - started
+
+
+def main(argv):
+    rounds = int(argv[1]) if len(argv) > 1 else 5000
+    ops = _make_operations()
+    for agg_cls in (DeepCopyAggregator, quota_request.QuotaOperationAggregator):
+        secs = _measure(agg_cls, ops, rounds)
+        print(u'%-25s %8.1f usec/round %10.0f merges/sec' % (
+            agg_cls.__name__, 1e6 * secs / rounds,
+            rounds * _MERGES_PER_ROUND / secs))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
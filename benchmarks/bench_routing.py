@@ -0,0 +1,101 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares the speed of routing paths to methods as the number of HTTP rules
+grows.
+
+``regex`` is the previous implementation, which tried the regex of each
+template in turn.  ``registry`` is
+:meth:`endpoints_management.control.service.MethodRegistry.lookup`.  The
+synthetic service configs have resources with list, get, custom verb and
+nested collection rules; the looked up paths are spread evenly over them.
+
+Usage::
+
+  PYTHONPATH=. python benchmarks/bench_routing.py [number_of_lookups]
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import logging
+import sys
+import timeit
+
+from endpoints_management.control import path_regex, service, sm_messages
+
+_SIZES = (10, 100, 500, 2000)
+
+
+def _make_service(num_rules):
+    rules = []
+    paths = []
+    for i in range(num_rules // 4):
+        resource = u'resource%d' % (i,)
+        rules.extend([
+            sm_messages.HttpRule(selector=u'bench.List%d' % (i,),
+                                 get=u'/v1/%s' % (resource,)),
+            sm_messages.HttpRule(selector=u'bench.Get%d' % (i,),
+                                 get=u'/v1/%s/{id}' % (resource,)),
+            sm_messages.HttpRule(selector=u'bench.Lock%d' % (i,),
+                                 get=u'/v1/%s/{id}:lock' % (resource,)),
+            sm_messages.HttpRule(selector=u'bench.Items%d' % (i,),
+                                 get=u'/v1/%s/{id}/items/{item}' % (resource,)),
+        ])
+        paths.extend([
+            u'/v1/%s' % (resource,),
+            u'/v1/%s/42' % (resource,),
+            u'/v1/%s/42:lock' % (resource,),
+            u'/v1/%s/42/items/7' % (resource,),
+        ])
+    a_service = sm_messages.Service(
+        name=u'bench-service', http=sm_messages.Http(rules=rules))
+    return a_service, paths
+
+
+def _regex_lookup(regexes, path):
+    path = path[1:]
+    for regex, selector in regexes:
+        if regex.match(path):
+            return selector
+    return None
+
+
+def main(argv):
+    logging.disable(logging.DEBUG)
+    number = int(argv[1]) if len(argv) > 1 else 2000
+    for size in _SIZES:
+        a_service, paths = _make_service(size)
+        registry = service.MethodRegistry(a_service)
+        regexes = [
+            (path_regex.compile_path_pattern(r.get[1:]), r.selector)
+            for r in a_service.http.rules
+        ]
+        candidates = (
+            (u'regex', lambda p: _regex_lookup(regexes, p)),
+            (u'registry', lambda p: registry.lookup(u'GET', p)),
+        )
+        for name, lookup in candidates:
+            def lookup_all(lookup=lookup):
+                for i in range(number):
+                    lookup(paths[i % len(paths)])
+
+            secs = min(timeit.repeat(lookup_all, number=1, repeat=3))
+            print(u'%5d rules %-8s %10.0f lookups/sec' % (
+                size, name, number / secs))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,105 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares the throughput of the check request signing implementations.
+
+``legacy`` is the previous implementation, which converted the labels to a
+dict and made many small updates to an md5 hash.  The others use
+:class:`endpoints_management.control.signing.Signer` with each of the
+available hashes.
+
+Usage::
+
+  PYTHONPATH=. python benchmarks/bench_signing.py [number_of_signatures]
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import hashlib
+import sys
+import timeit
+
+from apitools.base.py import encoding
+
+from endpoints_management.control import (check_request, metric_value,
+                                          sc_messages, signing)
+
+
+def _legacy_sign(req):
+    op = req.operation
+    md5 = hashlib.md5()
+    md5.update(op.operationName.encode('utf-8'))
+    md5.update(b'\x00')
+    md5.update(op.consumerId.encode('utf-8'))
+    if op.labels:
+        signing.add_dict_to_hash(md5, encoding.MessageToPyValue(op.labels))
+    for value_set in op.metricValueSets:
+        md5.update(b'\x00')
+        md5.update(value_set.metricName.encode('utf-8'))
+        for mv in value_set.metricValues:
+            if mv.labels:
+                signing.add_dict_to_hash(
+                    md5, encoding.MessageToPyValue(mv.labels))
+    md5.update(b'\x00')
+    if op.quotaProperties:
+        md5.update(repr(op.quotaProperties).encode('utf-8'))
+    md5.update(b'\x00')
+    return md5.digest()
+
+
+def _make_check_request():
+    info = check_request.Info(
+        android_cert_fingerprint=u'an_android_fingerprint',
+        android_package_name=u'an.android.package',
+        api_key=u'an_api_key',
+        api_key_valid=True,
+        client_ip=u'10.0.0.1',
+        consumer_project_id=u'a_project_id',
+        ios_bundle_id=u'an.ios.bundle',
+        operation_id=u'an_operation_id',
+        operation_name=u'a_service.AMethod',
+        referer=u'https://example.com/a/page',
+        service_name=u'a_service')
+    req = info.as_check_request().checkRequest
+    req.operation.metricValueSets = [
+        sc_messages.MetricValueSet(
+            metricName=u'a_metric',
+            metricValues=[metric_value.create(labels={u'a_label': u'a_value'},
+                                              int64Value=1)])]
+    return req
+
+
+def main(argv):
+    number = int(argv[1]) if len(argv) > 1 else 20000
+    req = _make_check_request()
+    candidates = [(u'legacy', lambda: _legacy_sign(req))]
+    for algorithm in signing.ALGORITHMS:
+        try:
+            signer = signing.Signer(algorithm)
+        except ValueError as e:
+            print(u'%-8s skipped: %s' % (algorithm, e))
+            continue
+        candidates.append(
+            (algorithm,
+             lambda signer=signer: check_request.sign(req, signer)))
+
+    for name, func in candidates:
+        secs = min(timeit.repeat(func, number=number, repeat=3))
+        print(u'%-8s %10.0f signatures/sec' % (name, number / secs))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
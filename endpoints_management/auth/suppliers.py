@@ -17,18 +17,29 @@
 from __future__ import absolute_import
 
 from builtins import object
+import collections
 import datetime
-from dogpile import cache
+import logging
+import re
+import threading
+import time
 from jwkest import jwk
+from jwkest import jws
 import requests
 import ssl
 
 
+_logger = logging.getLogger(__name__)
+
+
 _HTTP_PROTOCOL_PREFIX = u"http://"
 _HTTPS_PROTOCOL_PREFIX = u"https://"
 
 _OPEN_ID_CONFIG_PATH = u".well-known/openid-configuration"
 
+# the maximum number of seconds to wait for a response from an issuer
+_REQUEST_TIMEOUT_SECS = 10
+
 
 class KeyUriSupplier(object):  # pylint: disable=too-few-public-methods
     """A supplier that provides the `jwks_uri` for an issuer."""
@@ -75,18 +86,52 @@ class KeyUriSupplier(object):  # pylint: disable=too-few-public-methods
 
 
 class JwksSupplier(object):  # pylint: disable=too-few-public-methods
-    """A supplier that returns the Json Web Token Set of an issuer."""
-
-    def __init__(self, key_uri_supplier):
+    """A supplier that returns the Json Web Token Set of an issuer.
+
+    Each key set is cached for the ``max-age`` of the ``Cache-Control`` header
+    of the response that supplied it, or for ``expiration`` if there is none.
+    Once ``REFRESH_FRACTION`` of that time has passed, the key set is
+    refreshed by a background thread, while the cached one is still
+    supplied.  If a key set expires anyway, it is retrieved before it is
+    supplied.
+
+    If retrieving a key set fails, the last good one is supplied until it is
+    ``max_age`` old, and the retrieval is retried in the background every
+    ``RETRY_INTERVAL``.  The last good key set is also supplied while another
+    thread is retrieving it, so a slow issuer only delays the callers that
+    have no usable key set.
+
+    Thread safe.
+    """
+    # pylint: disable=too-many-instance-attributes
+    DEFAULT_EXPIRATION = datetime.timedelta(minutes=5)
+    DEFAULT_MAX_AGE = datetime.timedelta(hours=1)
+    MIN_EXPIRATION = datetime.timedelta(seconds=30)
+    RETRY_INTERVAL = datetime.timedelta(seconds=30)
+    REFRESH_FRACTION = 0.8
+
+    def __init__(self, key_uri_supplier, expiration=DEFAULT_EXPIRATION,
+                 max_age=DEFAULT_MAX_AGE, timer=None):
         """Constructs an instance of JwksSupplier.
 
         Args:
           key_uri_supplier: a KeyUriSupplier instance that returns the `jwks_uri`
             based on the given issuer.
+          expiration: a `datetime.timedelta`, the time a key set is cached for
+            if its response has no `Cache-Control` max-age.
+          max_age: a `datetime.timedelta`, the maximum age of a key set that is
+            supplied when it cannot be retrieved again.
+          timer: obtains the current time in seconds; `time.time` is used if it
+            is not set.
         """
         self._key_uri_supplier = key_uri_supplier
-        self._jwks_cache = cache.make_region().configure(
-            u"dogpile.cache.memory", expiration_time=datetime.timedelta(minutes=5))
+        self._expiration = expiration.total_seconds()
+        self._max_age = max_age.total_seconds()
+        self._timer = timer or _now
+        self._lock = threading.Lock()
+        self._cached = {}
+        self._fetch_locks = {}
+        self._refreshing = set()
 
     def supply(self, issuer):
         """Supplies the `Json Web Key Set` for the given issuer.
@@ -102,34 +147,182 @@ class JwksSupplier(object):  # pylint: disable=too-few-public-methods
           UnauthenticatedException: When this method cannot supply JWKS for the
             given issuer (e.g. unknown issuer, HTTP request error).
         """
-        def _retrieve_jwks():
-            """Retrieve the JWKS from the given jwks_uri when cache misses."""
-            jwks_uri = self._key_uri_supplier.supply(issuer)
-
-            if not jwks_uri:
-                raise UnauthenticatedException(u"Cannot find the `jwks_uri` for issuer "
-                                               u"%s: either the issuer is unknown or "
-                                               u"the OpenID discovery failed" % issuer)
-
-            try:
-                response = requests.get(jwks_uri)
-                json_response = response.json()
-            except Exception as exception:
-                message = u"Cannot retrieve valid verification keys from the `jwks_uri`"
-                raise UnauthenticatedException(message, exception)
-
-            if u"keys" in json_response:
-                # De-serialize the JSON as a JWKS object.
-                jwks_keys = jwk.KEYS()
-                jwks_keys.load_jwks(response.text)
-                return jwks_keys._keys
-            else:
-                # The JSON is a dictionary mapping from key id to X.509 certificates.
-                # Thus we extract the public key from the X.509 certificates and
-                # construct a JWKS object.
-                return _extract_x509_certificates(json_response)
+        now = self._timer()
+        cached = self._cached.get(issuer)
+        if cached is not None and now < cached.expires_at:
+            if now >= cached.refresh_at:
+                self._start_refresh(issuer)
+            return cached.keys
+
+        fetch_lock = self._fetch_lock(issuer)
+        if not fetch_lock.acquire(False):
+            if cached is not None and now - cached.fetched_at < self._max_age:
+                # another thread is retrieving it
+                return cached.keys
+            fetch_lock.acquire()
+        try:
+            return self._fetch_expired(issuer)
+        finally:
+            fetch_lock.release()
+
+    def _fetch_expired(self, issuer):
+        # another thread may have retrieved it while this one waited
+        cached = self._cached.get(issuer)
+        now = self._timer()
+        if cached is not None and now < cached.expires_at:
+            return cached.keys
+        try:
+            return self._fetch(issuer).keys
+        except Exception:
+            if cached is None or now - cached.fetched_at >= self._max_age:
+                raise
+            _logger.warn(u"Cannot retrieve the JWKS of %s, using the ones "
+                         u"retrieved %d seconds ago", issuer,
+                         now - cached.fetched_at, exc_info=True)
+            self._retry_later(issuer, cached, now)
+            return cached.keys
+
+    def _fetch_lock(self, issuer):
+        with self._lock:
+            return self._fetch_locks.setdefault(issuer, threading.Lock())
+
+    def _start_refresh(self, issuer):
+        with self._lock:
+            if issuer in self._refreshing:
+                return
+            self._refreshing.add(issuer)
+        thread = threading.Thread(target=self._refresh, args=(issuer,))
+        thread.daemon = True
+        try:
+            thread.start()
+        except Exception:  # pylint: disable=broad-except
+            # the key set will be retrieved when it expires
+            _logger.debug(u"Cannot start a thread to refresh the JWKS of %s",
+                          issuer, exc_info=True)
+            with self._lock:
+                self._refreshing.discard(issuer)
+
+    def _refresh(self, issuer):
+        try:
+            with self._fetch_lock(issuer):
+                self._fetch(issuer)
+        except Exception:  # pylint: disable=broad-except
+            _logger.warn(u"Cannot refresh the JWKS of %s", issuer, exc_info=True)
+            cached = self._cached.get(issuer)
+            if cached is not None:
+                self._retry_later(issuer, cached, self._timer())
+        finally:
+            with self._lock:
+                self._refreshing.discard(issuer)
+
+    def _retry_later(self, issuer, cached, now):
+        # supply the cached keys until they are max_age old, and retrieve them
+        # again in the background from retry_at
+        self._cached[issuer] = cached._replace(
+            expires_at=max(cached.expires_at,
+                           cached.fetched_at + self._max_age),
+            refresh_at=now + self.RETRY_INTERVAL.total_seconds())
+
+    def _fetch(self, issuer):
+        """Retrieves the JWKS from the issuer's jwks_uri, and caches them."""
+        jwks_uri = self._key_uri_supplier.supply(issuer)
+
+        if not jwks_uri:
+            raise UnauthenticatedException(u"Cannot find the `jwks_uri` for issuer "
+                                           u"%s: either the issuer is unknown or "
+                                           u"the OpenID discovery failed" % issuer)
+
+        fetched_at = self._timer()
+        try:
+            response = requests.get(jwks_uri, timeout=_REQUEST_TIMEOUT_SECS)
+            json_response = response.json()
+        except Exception as exception:
+            message = u"Cannot retrieve valid verification keys from the `jwks_uri`"
+            raise UnauthenticatedException(message, exception)
+
+        if u"keys" in json_response:
+            # De-serialize the JSON as a JWKS object.
+            jwks_keys = jwk.KEYS()
+            jwks_keys.load_jwks(response.text)
+            keys = jwks_keys._keys
+        else:
+            # The JSON is a dictionary mapping from key id to X.509 certificates.
+            # Thus we extract the public key from the X.509 certificates and
+            # construct a JWKS object.
+            keys = _extract_x509_certificates(json_response)
+
+        keys = VerificationKeys(keys)
+        expiration = _cache_control_max_age(response)
+        if expiration is None:
+            expiration = self._expiration
+        expiration = max(expiration, self.MIN_EXPIRATION.total_seconds())
+        cached = _CachedJwks(
+            keys=keys,
+            fetched_at=fetched_at,
+            refresh_at=fetched_at + expiration * self.REFRESH_FRACTION,
+            expires_at=fetched_at + expiration)
+        self._cached[issuer] = cached
+        return cached
+
+
+class VerificationKeys(list):
+    """The keys of a JWKS, indexed by key id and key type.
+
+    The index is made once for each retrieved key set, so that verifying the
+    signature of a token only needs the keys that match its header.
+    """
+
+    def __init__(self, keys):
+        """Constructs an instance of VerificationKeys.
+
+        Args:
+          keys: the `jwkest.jwk.Key`s of the key set.
+        """
+        super(VerificationKeys, self).__init__(keys)
+        self._by_kid = {}
+        for key in keys:
+            if key.kid:
+                self._by_kid.setdefault((key.kid, key.kty), []).append(key)
+
+    def matching(self, kid, alg):
+        """Finds the keys that may verify a token.
+
+        Args:
+          kid: the `kid` in the token's header, if any.
+          alg: the `alg` in the token's header.
+
+        Returns:
+          The keys whose type suits `alg`, restricted to those whose id is
+          `kid` if it is set.
+        """
+        key_type = jws.alg2keytype(alg)
+        if kid:
+            return self._by_kid.get((kid, key_type), [])
+        return [key for key in self if key.kty == key_type]
+
+
+_CachedJwks = collections.namedtuple(
+    u"_CachedJwks", [u"keys", u"fetched_at", u"refresh_at", u"expires_at"])
+
+
+_MAX_AGE_DIRECTIVE = re.compile(r"(?:^|,)\s*max-age\s*=\s*\"?(\d+)\"?\s*(?:,|$)",
+                                re.IGNORECASE)
+
+
+def _cache_control_max_age(response):
+    """Obtains the max-age in seconds of a response, or None if it has none."""
+    cache_control = response.headers.get(u"Cache-Control")
+    if not cache_control:
+        return None
+    match = _MAX_AGE_DIRECTIVE.search(cache_control)
+    if match is None:
+        return None
+    return int(match.group(1))
+
 
-        return self._jwks_cache.get_or_create(issuer, _retrieve_jwks)
+def _now():
+    # looks up time.time on each call, so that it can be patched by tests
+    return time.time()
 
 
 def _extract_x509_certificates(x509_certificates):
@@ -154,7 +347,7 @@ def _extract_x509_certificates(x509_certificates):
 def _discover_jwks_uri(issuer):
     open_id_url = _construct_open_id_url(issuer)
     try:
-        response = requests.get(open_id_url)
+        response = requests.get(open_id_url, timeout=_REQUEST_TIMEOUT_SECS)
         return response.json().get(u"jwks_uri")
     except Exception as error:
         raise UnauthenticatedException(u"Cannot discover the jwks uri", error)
@@ -122,11 +122,16 @@ class Authenticator(object):  # pylint: disable=too-few-public-methods
         """
 
         def _decode_and_verify():
-            jwt_claims = jwt.JWT().unpack(auth_token).payload()
+            unpacked = jwt.JWT().unpack(auth_token)
+            jwt_claims = unpacked.payload()
             _verify_required_claims_exist(jwt_claims)
 
             issuer = jwt_claims[u"iss"]
             keys = self._jwks_supplier.supply(issuer)
+            if isinstance(keys, suppliers.VerificationKeys):
+                # only try the keys that match the token's header
+                keys = keys.matching(unpacked.headers.get(u"kid"),
+                                     unpacked.headers.get(u"alg"))
             try:
                 return jws.JWS().verify_compact(auth_token, keys)
             except (jwkest.BadSignature, jws.NoSuitableSigningKeys,
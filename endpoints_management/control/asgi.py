@@ -0,0 +1,369 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""asgi implements behaviour that provides service control as asgi
+middleware.
+
+It is the ASGI counterpart of :mod:`endpoints_management.control.wsgi`, and
+provides :class:`EnvironmentMiddleware`, :class:`Middleware` and
+:class:`AuthenticationMiddleware`.  The values that the WSGI middleware add to
+the environment are added to the ASGI ``scope`` using the same keys.
+
+:class:`Middleware` requires an
+:class:`endpoints_management.control.async_client.AsyncClient`.  Response
+bodies are passed through as they are sent, and the report for each request is
+sent from a background task once the last body chunk has been sent, or once
+the application returns or fails without sending it.
+
+"""
+# pylint: disable=too-many-arguments
+
+from __future__ import absolute_import
+
+from future import standard_library
+standard_library.install_aliases()
+import asyncio
+import functools
+import logging
+import urllib.parse
+import wsgiref.util
+
+from . import service, wsgi
+from .wsgi import (_AppInfo, _LatencyTimer, _create_authenticator,
+                   _extract_auth_token, _request_method)
+
+
+_logger = logging.getLogger(__name__)
+
+
+def add_all(application, project_id, control_client,
+            loader=service.Loaders.FROM_SERVICE_MANAGEMENT,
+            lookup_cache_size=0):
+    """Adds all endpoints middleware to an asgi application.
+
+    Unlike :func:`endpoints_management.control.wsgi.add_all`, the service
+    config is loaded once, when this is called.
+
+    Example:
+
+      >>> application = MyAsgiApp()  # an existing ASGI application
+      >>>
+      >>> # wrap the app for service control
+      >>> from endpoints_management.control import asgi, client
+      >>> control_client = client.Loaders.DEFAULT.load_async(service_name)
+      >>> wrapped_app = asgi.add_all(application, project_id, control_client)
+
+    Args:
+       application: the wrapped asgi application
+       project_id: the project_id thats providing service control support
+       control_client (:class:`endpoints_management.control.async_client.AsyncClient`):
+          the service control client instance
+       loader (:class:`endpoints_management.control.service.Loader`): loads the service
+          instance that configures this instance's behaviour
+       lookup_cache_size (int): the number of method lookups to cache; see
+          :class:`endpoints_management.control.wsgi.EnvironmentMiddleware`
+
+    Raises:
+       ValueError: if the service config could not be loaded
+    """
+    a_service = loader.load()
+    if not a_service:
+        raise ValueError(u'Service config loader returned bad value.')
+    authenticator = _create_authenticator(a_service)
+    wrapped_app = Middleware(application, project_id, control_client)
+    if authenticator:
+        wrapped_app = AuthenticationMiddleware(wrapped_app, authenticator)
+    return EnvironmentMiddleware(wrapped_app, a_service,
+                                 lookup_cache_size=lookup_cache_size)
+
+
+def _environ_from_scope(scope):
+    """Makes a WSGI-style environ from the parts of ``scope`` used here.
+
+    This allows the request inspection helpers shared with the WSGI
+    middleware to be used unchanged.
+    """
+    environ = {
+        u'REQUEST_METHOD': scope.get(u'method', u'GET'),
+        u'SCRIPT_NAME': scope.get(u'root_path', u''),
+        u'PATH_INFO': scope.get(u'path', u'/'),
+        u'QUERY_STRING': scope.get(u'query_string', b'').decode('latin-1'),
+        u'wsgi.url_scheme': scope.get(u'scheme', u'http'),
+    }
+    server = scope.get(u'server')
+    if server:
+        environ[u'SERVER_NAME'] = server[0]
+        environ[u'SERVER_PORT'] = u'%s' % (server[1],)
+    else:
+        environ[u'SERVER_NAME'] = u'localhost'
+        environ[u'SERVER_PORT'] = u'80'
+    client_addr = scope.get(u'client')
+    if client_addr:
+        environ[u'REMOTE_ADDR'] = client_addr[0]
+    for name, value in scope.get(u'headers', ()):
+        name = name.decode('latin-1').upper().replace(u'-', u'_')
+        value = value.decode('latin-1')
+        if name == u'CONTENT_LENGTH' or name == u'CONTENT_TYPE':
+            environ[name] = value
+        else:
+            environ[u'HTTP_' + name] = value
+    for key in (EnvironmentMiddleware.SERVICE, EnvironmentMiddleware.SERVICE_NAME):
+        if key in scope:
+            environ[key] = scope[key]
+    return environ
+
+
+class EnvironmentMiddleware(wsgi.EnvironmentMiddleware):
+    """An ASGI middleware that sets related variables in the scope.
+
+    It attempts to add the following vars:
+
+    - google.api.config.service
+    - google.api.config.service_name
+    - google.api.config.method_registry
+    - google.api.config.reporting_rules
+    - google.api.config.method_info
+    """
+    # pylint: disable=too-few-public-methods
+
+    async def __call__(self, scope, receive, send):
+        if scope.get(u'type') != u'http':
+            await self._application(scope, receive, send)
+            return
+
+        scope[self.SERVICE] = self._service
+        scope[self.SERVICE_NAME] = self._service.name
+        scope[self.METHOD_REGISTRY] = self._method_registry
+        scope[self.REPORTING_RULES] = self._reporting_rules
+        environ = _environ_from_scope(scope)
+        parsed_uri = urllib.parse.urlparse(wsgiref.util.request_uri(environ))
+        http_method = _request_method(environ)
+        method_info = self._method_registry.lookup(http_method, parsed_uri.path)
+        if method_info:
+            scope[self.METHOD_INFO] = method_info
+
+        await self._application(scope, receive, send)
+
+
+class Middleware(wsgi.Middleware):
+    """An ASGI middleware implementation that provides service control.
+
+    It builds its check, quota and report requests in the same way as
+    :class:`endpoints_management.control.wsgi.Middleware`.
+
+    Example:
+
+      >>> app = MyAsgiApp()  # an existing ASGI application
+      >>>
+      >>> # wrap the app for service control
+      >>> from endpoints_management.control import asgi, client, service
+      >>> control_client = client.Loaders.DEFAULT.load_async(service_name)
+      >>> wrapped_app = asgi.Middleware(app, project_id, control_client)
+      >>> env_app = asgi.EnvironmentMiddleware(wrapped_app, a_service)
+      >>>
+      >>> # now use env_app in place of app
+
+    """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, *args, **kw):
+        super(Middleware, self).__init__(*args, **kw)
+        self._report_tasks = set()
+
+    async def __call__(self, scope, receive, send):
+        # pylint: disable=too-many-locals
+        method_info = scope.get(EnvironmentMiddleware.METHOD_INFO)
+        if scope.get(u'type') != u'http' or not method_info:
+            # just allow the wrapped application to handle the request
+            _logger.debug(u'method_info not present in the asgi scope'
+                          u', no service control')
+            await self._application(scope, receive, send)
+            return
+
+        latency_timer = _LatencyTimer(self._timer)
+        latency_timer.start()
+
+        # Determine if the request can proceed
+        environ = _environ_from_scope(scope)
+        http_method = _request_method(environ)
+        parsed_uri = urllib.parse.urlparse(wsgiref.util.request_uri(environ))
+        app_info = _AppInfo()
+        try:
+            app_info.request_size = int(environ.get(u'CONTENT_LENGTH',
+                                                    app_info.request_size))
+        except ValueError:
+            _logger.warn(u'ignored bad content-length: %s', environ.get(u'CONTENT_LENGTH'))
+
+        app_info.http_method = http_method
+        app_info.url = parsed_uri
+
+        # Default to 0 for consumer project number to disable per-consumer
+        # metric reporting if the check request doesn't return one.
+        consumer_project_number = 0
+        error_response = None
+        rules = scope.get(EnvironmentMiddleware.REPORTING_RULES)
+        check_info = self._create_check_info(method_info, parsed_uri, environ)
+        if not check_info.api_key and not method_info.allow_unregistered_calls:
+            _logger.debug(u"skipping %s, no api key was provided", parsed_uri)
+            error_response = self._capture(self._handle_missing_api_key, app_info)
+        else:
+            check_req = check_info.as_check_request()
+            _logger.debug(u'checking %s with %s', method_info, check_req)
+            check_resp = await self._control_client.check(check_req)
+            error_response = self._capture(
+                self._handle_check_response, app_info, check_resp)
+            if (check_resp and check_resp.checkInfo and
+                    check_resp.checkInfo.consumerInfo):
+                consumer_project_number = (
+                    check_resp.checkInfo.consumerInfo.projectNumber)
+            if error_response is None:
+                quota_info = self._create_quota_info(method_info, parsed_uri, environ)
+                if not quota_info.quota_info:
+                    _logger.debug(u'no metric costs for this method')
+                else:
+                    quota_req = self._create_quota_request(method_info, quota_info)
+                    quota_resp = await self._control_client.allocate_quota(quota_req)
+                    error_response = self._capture(
+                        self._handle_quota_response, app_info, quota_resp)
+
+        report = functools.partial(
+            self._report_in_background, method_info, check_info, app_info,
+            latency_timer, rules, consumer_project_number)
+
+        if error_response:
+            # send a report request that indicates that the request failed
+            await _send_captured(send, error_response)
+            latency_timer.end()
+            report()
+            return
+
+        latency_timer.app_start()
+        reporting_send = _ReportingSend(send, app_info, latency_timer, report)
+        try:
+            await self._application(scope, receive, reporting_send)
+        finally:
+            # report requests whose response was not completed, e.g because
+            # the application failed or the client disconnected
+            reporting_send.close()
+
+    def _capture(self, handler, app_info, *args):
+        """Invokes a wsgi response handler, capturing what it would send."""
+        captured = []
+
+        def capturing_start_response(status, response_headers, exc_info=None):
+            # pylint: disable=unused-argument
+            captured.append((status, response_headers))
+
+        body = handler(app_info, *(args + (capturing_start_response,)))
+        if body is None:
+            return None
+        status, headers = captured[0]
+        return int(status.partition(u' ')[0]), headers, b''.join(body)
+
+    def _report_in_background(self, *args):
+        task = asyncio.ensure_future(self._report(*args))
+        self._report_tasks.add(task)
+        task.add_done_callback(self._report_tasks.discard)
+
+    async def _report(self, *args):
+        try:
+            report_req = self._create_report_request(*args)
+            _logger.debug(u'sending report_request %s', report_req)
+            await self._control_client.report(report_req)
+        except Exception:  # pylint: disable=broad-except
+            _logger.error(u'failed to report a request', exc_info=True)
+
+
+class _ReportingSend(object):
+    """Wraps an ASGI ``send``, recording the response on ``app_info``.
+
+    Once the last body chunk has been sent, or when :meth:`close` is called
+    before then, the latency timer is stopped and ``report`` is invoked.
+    """
+
+    def __init__(self, send, app_info, latency_timer, report):
+        self._send = send
+        self._app_info = app_info
+        self._latency_timer = latency_timer
+        self._report = report
+        self._size = 0
+        self._reported = False
+
+    async def __call__(self, message):
+        message_type = message.get(u'type')
+        if message_type == u'http.response.start':
+            self._app_info.response_code = message[u'status']
+        elif message_type == u'http.response.body':
+            self._size += len(message.get(u'body', b''))
+        await self._send(message)
+        if (message_type == u'http.response.body' and
+                not message.get(u'more_body', False)):
+            self.close()
+
+    def close(self):
+        if self._reported:
+            return
+        self._reported = True
+        self._latency_timer.end()
+        self._app_info.response_size = self._size
+        self._report()
+
+
+async def _send_captured(send, captured):
+    code, headers, body = captured
+    await send({
+        u'type': u'http.response.start',
+        u'status': code,
+        u'headers': [(k.lower().encode('latin-1'), v.encode('latin-1'))
+                     for k, v in headers],
+    })
+    await send({u'type': u'http.response.body', u'body': body})
+
+
+class AuthenticationMiddleware(wsgi.AuthenticationMiddleware):
+    """An ASGI middleware that does authentication checks for incoming
+    requests.
+
+    The authentication result is added to the scope under ``USER_INFO``.
+    Authentication may need to fetch verification keys, so it is run in the
+    event loop's default executor.
+    """
+    # pylint: disable=too-few-public-methods
+
+    async def __call__(self, scope, receive, send):
+        method_info = scope.get(EnvironmentMiddleware.METHOD_INFO)
+        if (scope.get(u'type') != u'http' or
+                not method_info or not method_info.auth_info):
+            # No authentication configuration for this method
+            _logger.debug(u"authentication is not configured")
+            await self._application(scope, receive, send)
+            return
+
+        auth_token = _extract_auth_token(_environ_from_scope(scope))
+        user_info = None
+        if not auth_token:
+            _logger.debug(u"No auth token is attached to the request")
+        else:
+            try:
+                service_name = scope.get(EnvironmentMiddleware.SERVICE_NAME)
+                loop = asyncio.get_event_loop()
+                user_info = await loop.run_in_executor(
+                    None, self._authenticator.authenticate, auth_token,
+                    method_info.auth_info, service_name)
+            except Exception:  # pylint: disable=broad-except
+                _logger.debug(u"Cannot decode and verify the auth token. The backend "
+                              u"will not be able to retrieve user info", exc_info=True)
+
+        scope[self.USER_INFO] = user_info
+        await self._application(scope, receive, send)
@@ -0,0 +1,389 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""async_client provides a service control client for asyncio applications.
+
+:class:`AsyncClient` is the asyncio counterpart of
+:class:`endpoints_management.control.client.Client`.  It uses the same
+aggregators, but :meth:`AsyncClient.check`, :meth:`AsyncClient.allocate_quota`
+and :meth:`AsyncClient.report` are coroutines, and the caches are flushed by
+tasks running on the event loop rather than by a scheduler thread.
+
+Requests that cannot be answered from the caches are sent using an *async
+transport*: any object with ``Check``, ``AllocateQuota`` and ``Report``
+coroutine methods that accept the same request messages as the corresponding
+methods of ``ServicecontrolV1.services``.  :class:`ExecutorTransport`, the
+default, runs the blocking apitools client in an executor; applications with a
+native asyncio HTTP stack can supply their own transport instead.
+
+Example:
+
+  >>> from endpoints_management.control import client
+  >>>
+  >>> service_name = 'my-service-name'
+  >>> async_client = client.Loaders.DEFAULT.load_async(service_name)
+  >>>
+  >>> async def handle(check_req):
+  ...     check_resp = await async_client.check(check_req)
+
+"""
+
+from __future__ import absolute_import
+
+from builtins import object
+from apitools.base.py import exceptions
+from datetime import datetime
+import asyncio
+import functools
+import logging
+
+from . import check_request, quota_request, report_request, sc_messages
+from .caches import to_cache_timer, to_clock_timer
+from .client import (_CREATE_THREAD_LOCAL_TRANSPORT, MAX_IDLE_TIME_SECONDS,
+                     _is_coalesced)
+
+
+_logger = logging.getLogger(__name__)
+
+
+class ExecutorTransport(object):
+    """An async transport that runs a blocking transport in an executor.
+
+    This lets :class:`AsyncClient` use the apitools ``ServicecontrolV1``
+    client without blocking the event loop.
+    """
+
+    def __init__(self,
+                 create_transport=_CREATE_THREAD_LOCAL_TRANSPORT,
+                 executor=None):
+        """Constructor.
+
+        Args:
+          create_transport (func): obtains a blocking transport, e.g, a
+            ``ServicecontrolV1`` instance.  It is invoked in the executor
+            threads.
+          executor (:class:`concurrent.futures.Executor`): the executor used
+            to make the blocking calls; ``None`` means the event loop's
+            default executor
+        """
+        self._create_transport = create_transport
+        self._executor = executor
+
+    async def Check(self, req):  # pylint: disable=invalid-name
+        return await self._run_in_executor(u'Check', req)
+
+    async def AllocateQuota(self, req):  # pylint: disable=invalid-name
+        return await self._run_in_executor(u'AllocateQuota', req)
+
+    async def Report(self, req):  # pylint: disable=invalid-name
+        return await self._run_in_executor(u'Report', req)
+
+    async def _run_in_executor(self, method_name, req):
+        loop = asyncio.get_event_loop()
+        func = functools.partial(self._send, method_name, req)
+        return await loop.run_in_executor(self._executor, func)
+
+    def _send(self, method_name, req):
+        transport = self._create_transport()
+        return getattr(transport.services, method_name)(req)
+
+
+class AsyncClient(object):
+    """AsyncClient is the asyncio equivalent of :class:`client.Client`.
+
+    Example:
+
+      >>> from endpoints_management.control import async_client, caches
+      >>> service_name = 'my-service-name'
+      >>>
+      >>> # create an async client using the package default values
+      >>> a_client = async_client.AsyncClient(service_name,
+      ...                                     caches.CheckOptions(),
+      ...                                     caches.QuotaOptions(),
+      ...                                     caches.ReportOptions())
+
+    AsyncClient instances must only be used from the thread running the event
+    loop on which they are started.
+
+    """
+    # pylint: disable=too-many-instance-attributes, too-many-arguments
+
+    def __init__(self,
+                 service_name,
+                 check_options,
+                 quota_options,
+                 report_options,
+                 timer=datetime.utcnow,
+                 transport=None,
+                 clock=None):
+        """
+
+        Args:
+            service_name (str): the name of the service to be controlled
+            check_options (:class:`endpoints_management.control.caches.CheckOptions`):
+              configures checking
+            quota_options (:class:`endpoints_management.control.caches.QuotaOptions`):
+              configures quota allocation
+            report_options (:class:`endpoints_management.control.caches.ReportOptions`):
+              configures reporting
+            timer (:func[[datetime.datetime]]: used to obtain the current time.
+            transport (object): the async transport used to send requests,
+              by default an :class:`ExecutorTransport`
+            clock (:func[[int]]): if set, it obtains the current time in
+              nanoseconds, and is used instead of ``timer`` to measure
+              intervals, e.g
+              :func:`endpoints_management.control.caches.monotonic_nanos`
+        """
+        self._check_aggregator = check_request.Aggregator(service_name,
+                                                          check_options,
+                                                          timer=timer,
+                                                          clock=clock)
+        self._quota_aggregator = quota_request.Aggregator(service_name,
+                                                          quota_options,
+                                                          timer=timer,
+                                                          clock=clock)
+        self._report_aggregator = report_request.Aggregator(service_name,
+                                                            report_options,
+                                                            timer=timer,
+                                                            clock=clock)
+        if transport is None:
+            transport = ExecutorTransport()
+        self._transport = transport
+        if clock is None:
+            self._timer = to_cache_timer(timer)
+        else:
+            self._timer = to_clock_timer(clock)
+        self._running = False
+        self._flush_tasks = []
+        self._idle_timer_started_at = None
+        self._check_calls = {}
+
+    def _start_idle_timer(self):
+        self._idle_timer_started_at = self._timer()
+
+    def _idle_threshold_reached(self):
+        elapsed = self._timer() - self._idle_timer_started_at
+        return elapsed > MAX_IDLE_TIME_SECONDS
+
+    def start(self):
+        """Starts processing.
+
+        Calling this method creates the tasks that regularly flush all enabled
+        caches.  It must be called while the event loop is running; it is
+        invoked automatically by :meth:`check`, :meth:`allocate_quota` and
+        :meth:`report`.
+        """
+        if self._running:
+            return
+
+        self._running = True
+        self._start_idle_timer()
+        loop = asyncio.get_event_loop()
+        flushes = (
+            (u'check', self._check_aggregator, self._flush_check_aggregator),
+            (u'quota', self._quota_aggregator, self._flush_quota_aggregator),
+            (u'report', self._report_aggregator, self._flush_report_aggregator),
+        )
+        for kind, aggregator, flush in flushes:
+            flush_interval = aggregator.flush_interval
+            if not flush_interval or flush_interval.total_seconds() < 0:
+                _logger.debug(u'did not schedule %s flush: caching is disabled',
+                              kind)
+                continue
+            self._flush_tasks.append(loop.create_task(
+                self._flush_periodically(flush, flush_interval.total_seconds())))
+
+    async def stop(self):
+        """Halts processing
+
+        This will lead to the reports being flushed, the caches being cleared
+        and the flush tasks being cancelled.
+
+        """
+        if not self._running:
+            _logger.debug(u'%s is already stopped', self)
+            return
+
+        self._running = False
+        tasks, self._flush_tasks = self._flush_tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self._flush_all_reports()
+        self._check_aggregator.clear()
+        self._quota_aggregator.clear()
+
+    async def check(self, check_req):
+        """Process a check_request.
+
+        The req is first passed to the check_aggregator.  If there is a valid
+        cached response, that is returned, otherwise a response is obtained from
+        the transport.
+
+        Args:
+          check_req (``ServicecontrolServicesCheckRequest``): to be sent to
+            the service control service
+
+        Returns:
+           ``CheckResponse``: either the cached response if one is applicable
+            or a response from making a transport request, or None if
+            if the request to the transport fails
+
+        """
+        self.start()
+        res = self._check_aggregator.check(check_req)
+        if res:
+            _logger.debug(u'using cached check response for %s: %s',
+                          check_req, res)
+            return res
+
+        # Concurrent misses for the same operation share a single request, as
+        # in client.Client
+        if not _is_coalesced(check_req):
+            return await self._send_check(check_req)
+        signature = check_request.sign(check_req.checkRequest)
+        in_flight = self._check_calls.get(signature)
+        if in_flight is None:
+            in_flight = asyncio.ensure_future(self._send_check(check_req))
+            self._check_calls[signature] = in_flight
+            in_flight.add_done_callback(
+                lambda _: self._check_calls.pop(signature, None))
+        return await asyncio.shield(in_flight)
+
+    async def _send_check(self, check_req):
+        # Fail open, as in client.Client
+        try:
+            resp = await self._transport.Check(check_req)
+            self._check_aggregator.add_response(check_req, resp)
+            return resp
+        except exceptions.Error:  # only sink apitools errors
+            _logger.error(u'direct send of check request failed %s',
+                          check_req, exc_info=True)
+            return None
+
+    async def allocate_quota(self, allocate_quota_req):
+        """Process an allocate_quota_request.
+
+        Args:
+          allocate_quota_req (``ServicecontrolServicesAllocateQuotaRequest``):
+            to be sent to the service control service
+
+        Returns:
+           ``AllocateQuotaResponse``: either the cached response if one is
+             applicable, a response from making a transport request, or an
+             empty response if the request to the transport fails
+
+        """
+        self.start()
+        res = self._quota_aggregator.allocate_quota(allocate_quota_req)
+        if res:
+            _logger.debug(u'using cached quota response for %s: %s',
+                          allocate_quota_req, res)
+            return res
+
+        # no cache, making direct request
+        try:
+            resp = await self._transport.AllocateQuota(allocate_quota_req)
+            self._quota_aggregator.add_response(allocate_quota_req, resp)
+            return resp
+        except exceptions.Error:  # only sink apitools errors
+            _logger.error(u'direct send of quota request failed %s',
+                          allocate_quota_req, exc_info=True)
+            # fail open
+            dummy_resp = sc_messages.AllocateQuotaResponse()
+            self._quota_aggregator.add_response(allocate_quota_req, dummy_resp)
+            return dummy_resp
+
+    async def report(self, report_req):
+        """Processes a report request.
+
+        It will aggregate it with prior report_requests to be send later
+        or it will send it immediately if that's appropriate.
+        """
+        self.start()
+        if not self._report_aggregator.report(report_req):
+            _logger.debug(u'need to send a report request directly')
+            try:
+                await self._transport.Report(report_req)
+            except exceptions.Error:  # only sink apitools errors
+                _logger.error(u'direct send for report request failed',
+                              exc_info=True)
+
+    async def _flush_periodically(self, flush, interval_secs):
+        # flush returns False once no further flushes are needed
+        while await flush():
+            await asyncio.sleep(interval_secs)
+
+    async def _flush_check_aggregator(self):
+        _logger.debug(u'flushing the check aggregator')
+        reqs = self._check_aggregator.flush()
+        resps = await asyncio.gather(
+            *[self._transport.Check(req) for req in reqs],
+            return_exceptions=True)
+        for req, resp in zip(reqs, resps):
+            if isinstance(resp, Exception):
+                _logger.error(u'failed to flush check_req %s', req, exc_info=resp)
+            else:
+                self._check_aggregator.add_response(req, resp)
+        return True
+
+    async def _flush_quota_aggregator(self):
+        _logger.debug(u'flushing the quota aggregator')
+        reqs = self._quota_aggregator.flush()
+        resps = await asyncio.gather(
+            *[self._transport.AllocateQuota(req) for req in reqs],
+            return_exceptions=True)
+        for req, resp in zip(reqs, resps):
+            if isinstance(resp, Exception):
+                _logger.error(u'failed to flush quota_req %s', req, exc_info=resp)
+            else:
+                self._quota_aggregator.add_response(req, resp)
+        return True
+
+    async def _flush_report_aggregator(self):
+        reqs = self._report_aggregator.flush()
+        _logger.debug(u'will flush %d report requests', len(reqs))
+        await self._send_reports(reqs)
+        if len(reqs) > 0:
+            self._start_idle_timer()
+        elif self._idle_threshold_reached():
+            _logger.debug(
+                u'Shutting down after no reports in the last %d seconds',
+                MAX_IDLE_TIME_SECONDS)
+            asyncio.ensure_future(self.stop())
+            return False
+        return True
+
+    async def _flush_all_reports(self):
+        all_ops = self._report_aggregator.clear()
+        _logger.debug(u'flushing all reports (count=%d)', len(all_ops))
+        service_name = self._report_aggregator.service_name
+        max_ops = report_request.Aggregator.MAX_OPERATION_COUNT
+        all_requests = [
+            sc_messages.ServicecontrolServicesReportRequest(
+                serviceName=service_name,
+                reportRequest=sc_messages.ReportRequest(
+                    operations=all_ops[x:x + max_ops]))
+            for x in range(0, len(all_ops), max_ops)
+        ]
+        await self._send_reports(all_requests)
+
+    async def _send_reports(self, reqs):
+        results = await asyncio.gather(
+            *[self._transport.Report(req) for req in reqs],
+            return_exceptions=True)
+        for req, result in zip(reqs, results):
+            if isinstance(result, Exception):
+                _logger.error(u'failed to flush report_req %s', req,
+                              exc_info=result)
@@ -15,7 +15,8 @@
 """caches provide functions and classes used to support caching.
 
 caching is provide by extensions of the cache classes provided by the
-cachetools open-source library.
+cachetools open-source library, or by :class:`TinyLFUCache` when its eviction
+policy is selected.
 
 :func:`create` creates a cache instance specifed by either
 :class:`endpoints_management.control.CheckAggregationOptions` or a
@@ -35,21 +36,34 @@ from __future__ import absolute_import
 
 from builtins import object
 import collections
+import collections.abc
 import logging
 import threading
+import time
 from datetime import datetime, timedelta
 
 import cachetools
 
+from . import signing
+
 _logger = logging.getLogger(__name__)
 
 
+LRU = u'lru'
+TINY_LFU = u'tiny_lfu'
+EVICTION_POLICIES = (LRU, TINY_LFU)
+
+
 class CheckOptions(
         collections.namedtuple(
             u'CheckOptions',
             [u'num_entries',
              u'flush_interval',
-             u'expiration'])):
+             u'expiration',
+             u'num_shards',
+             u'signing_algorithm',
+             u'max_staleness',
+             u'eviction_policy'])):
     """Holds values used to control report check behavior.
 
     Attributes:
@@ -63,27 +77,57 @@ class CheckOptions(
           check response should be deleted.  This value should be larger than
           ``flush_interval``, otherwise it will be ignored, and instead a value
           equivalent to flush_interval + 1ms will be used.
+        num_shards (int): the number of independently locked segments the
+          aggregation cache is split into; see :class:`ShardedCache`
+        signing_algorithm (string): names the hash used to sign cached
+          requests, one of :data:`endpoints_management.control.signing.ALGORITHMS`
+        max_staleness (:class:`datetime.timedelta`): if set, a cached response
+          without errors that is older than ``flush_interval`` continues to be
+          used until it is this old, while a request to refresh it is sent by
+          the next flush, which is then due every ``flush_interval``.  An
+          entry is evicted ``expiration`` after its refresh is queued, so
+          there is no benefit in it being longer than ``flush_interval`` plus
+          ``expiration``.  If ``None``, the first request after the flush
+          interval is sent directly.
+        eviction_policy (string): selects the entries evicted when the
+          aggregation cache is full, one of :data:`EVICTION_POLICIES`; see
+          :class:`TinyLFUCache`
     """
     # pylint: disable=too-few-public-methods
     DEFAULT_NUM_ENTRIES = 200
     DEFAULT_FLUSH_INTERVAL = timedelta(milliseconds=500)
     DEFAULT_EXPIRATION = timedelta(seconds=1)
+    DEFAULT_NUM_SHARDS = 1
 
     def __new__(cls,
                 num_entries=DEFAULT_NUM_ENTRIES,
                 flush_interval=DEFAULT_FLUSH_INTERVAL,
-                expiration=DEFAULT_EXPIRATION):
+                expiration=DEFAULT_EXPIRATION,
+                num_shards=DEFAULT_NUM_SHARDS,
+                signing_algorithm=signing.MD5,
+                max_staleness=None,
+                eviction_policy=LRU):
         """Invokes the base constructor with default values."""
         assert isinstance(num_entries, int), u'should be an int'
         assert isinstance(flush_interval, timedelta), u'should be a timedelta'
         assert isinstance(expiration, timedelta), u'should be a timedelta'
+        assert isinstance(num_shards, int), u'should be an int'
+        assert num_shards > 0, u'should be positive'
+        assert signing_algorithm in signing.ALGORITHMS, u'should be known'
+        assert max_staleness is None or isinstance(max_staleness, timedelta), (
+            u'should be a timedelta')
+        assert eviction_policy in EVICTION_POLICIES, u'should be known'
         if expiration <= flush_interval:
             expiration = flush_interval + timedelta(milliseconds=1)
         return super(cls, CheckOptions).__new__(
             cls,
             num_entries,
             flush_interval,
-            expiration)
+            expiration,
+            num_shards,
+            signing_algorithm,
+            max_staleness,
+            eviction_policy)
 
 
 class QuotaOptions(
@@ -91,7 +135,12 @@ class QuotaOptions(
             u'QuotaOptions',
             [u'num_entries',
              u'flush_interval',
-             u'expiration'])):
+             u'expiration',
+             u'num_shards',
+             u'signing_algorithm',
+             u'eviction_policy',
+             u'lease_size',
+             u'lease_refill_threshold'])):
     """Holds values used to control report quota behavior.
 
     Attributes:
@@ -105,34 +154,73 @@ class QuotaOptions(
           quota response should be deleted.  This value should be larger than
           ``flush_interval``, otherwise it will be ignored, and instead a value
           equivalent to flush_interval + 1ms will be used.
+        num_shards (int): the number of independently locked segments the
+          aggregation cache is split into; see :class:`ShardedCache`
+        signing_algorithm (string): names the hash used to sign cached
+          requests, one of :data:`endpoints_management.control.signing.ALGORITHMS`
+        eviction_policy (string): selects the entries evicted when the
+          aggregation cache is full, one of :data:`EVICTION_POLICIES`; see
+          :class:`TinyLFUCache`
+        lease_size (int): if set, quota is leased in blocks of this many
+          units per consumer and metric, and allocated locally from the
+          leased blocks; see
+          :class:`endpoints_management.control.quota_request.QuotaLease`
+        lease_refill_threshold (float): the fraction of ``lease_size`` below
+          which the remaining units of a lease are refilled
     """
     # pylint: disable=too-few-public-methods
     DEFAULT_NUM_ENTRIES = 1000
     DEFAULT_FLUSH_INTERVAL = timedelta(seconds=1)
     DEFAULT_EXPIRATION = timedelta(minutes=1)
+    DEFAULT_NUM_SHARDS = 1
+    DEFAULT_LEASE_REFILL_THRESHOLD = 0.5
 
     def __new__(cls,
                 num_entries=DEFAULT_NUM_ENTRIES,
                 flush_interval=DEFAULT_FLUSH_INTERVAL,
-                expiration=DEFAULT_EXPIRATION):
+                expiration=DEFAULT_EXPIRATION,
+                num_shards=DEFAULT_NUM_SHARDS,
+                signing_algorithm=signing.MD5,
+                eviction_policy=LRU,
+                lease_size=None,
+                lease_refill_threshold=DEFAULT_LEASE_REFILL_THRESHOLD):
         """Invokes the base constructor with default values."""
         assert isinstance(num_entries, int), u'should be an int'
         assert isinstance(flush_interval, timedelta), u'should be a timedelta'
         assert isinstance(expiration, timedelta), u'should be a timedelta'
+        assert isinstance(num_shards, int), u'should be an int'
+        assert num_shards > 0, u'should be positive'
+        assert signing_algorithm in signing.ALGORITHMS, u'should be known'
+        assert eviction_policy in EVICTION_POLICIES, u'should be known'
+        assert lease_size is None or isinstance(lease_size, int), (
+            u'should be an int')
+        assert lease_size is None or lease_size > 0, u'should be positive'
+        assert 0.0 <= lease_refill_threshold < 1.0, u'should be a fraction'
         if expiration <= flush_interval:
             expiration = flush_interval + timedelta(milliseconds=1)
         return super(cls, QuotaOptions).__new__(
             cls,
             num_entries,
             flush_interval,
-            expiration)
+            expiration,
+            num_shards,
+            signing_algorithm,
+            eviction_policy,
+            lease_size,
+            lease_refill_threshold)
 
 
 class ReportOptions(
         collections.namedtuple(
             u'ReportOptions',
             [u'num_entries',
-             u'flush_interval'])):
+             u'flush_interval',
+             u'num_shards',
+             u'signing_algorithm',
+             u'max_log_entries',
+             u'dedupe_log_entries',
+             u'log_sample_rate',
+             u'max_request_bytes'])):
     """Holds values used to control report aggregation behavior.
 
     Attributes:
@@ -143,28 +231,72 @@ class ReportOptions(
         flush_interval (:class:`datetime.timedelta`): the maximum delta before
           aggregated report requests are flushed to the server.  The cache
           entry is deleted after the flush
+
+        num_shards (int): the number of independently locked segments the
+          aggregation cache is split into; see :class:`ShardedCache`
+        signing_algorithm (string): names the hash used to sign cached
+          requests, one of :data:`endpoints_management.control.signing.ALGORITHMS`
+        max_log_entries (int): if set, the maximum number of log entries kept
+          for each aggregated operation; once it is reached, a random sample
+          of the entries is kept, and the others are counted by
+          :attr:`endpoints_management.control.report_request.Aggregator.dropped_log_entries`
+        dedupe_log_entries (bool): if ``True``, log entries of an aggregated
+          operation that differ only in their timestamps and latency are
+          reported as one entry, labelled with their count
+        log_sample_rate (float): the probability that each log entry is kept;
+          the entries that are not kept are counted by
+          :attr:`endpoints_management.control.report_request.Aggregator.dropped_log_entries`
+        max_request_bytes (int): if set, flushed operations are packed into
+          report requests whose estimated serialized size is at most this
+          many bytes.  An operation that is larger on its own is sent in a
+          request of its own
     """
     # pylint: disable=too-few-public-methods
     DEFAULT_NUM_ENTRIES = 200
     DEFAULT_FLUSH_INTERVAL = timedelta(seconds=1)
+    DEFAULT_NUM_SHARDS = 1
 
     def __new__(cls,
                 num_entries=DEFAULT_NUM_ENTRIES,
-                flush_interval=DEFAULT_FLUSH_INTERVAL):
+                flush_interval=DEFAULT_FLUSH_INTERVAL,
+                num_shards=DEFAULT_NUM_SHARDS,
+                signing_algorithm=signing.MD5,
+                max_log_entries=None,
+                dedupe_log_entries=False,
+                log_sample_rate=1.0,
+                max_request_bytes=None):
         """Invokes the base constructor with default values."""
         assert isinstance(num_entries, int), u'should be an int'
         assert isinstance(flush_interval, timedelta), u'should be a timedelta'
+        assert isinstance(num_shards, int), u'should be an int'
+        assert num_shards > 0, u'should be positive'
+        assert signing_algorithm in signing.ALGORITHMS, u'should be known'
+        assert max_log_entries is None or isinstance(max_log_entries, int), (
+            u'should be an int')
+        assert max_log_entries is None or max_log_entries >= 0, (
+            u'should not be negative')
+        assert 0.0 <= log_sample_rate <= 1.0, u'should be a probability'
+        assert max_request_bytes is None or isinstance(max_request_bytes, int), (
+            u'should be an int')
+        assert max_request_bytes is None or max_request_bytes > 0, (
+            u'should be positive')
 
         return super(cls, ReportOptions).__new__(
             cls,
             num_entries,
-            flush_interval)
+            flush_interval,
+            num_shards,
+            signing_algorithm,
+            max_log_entries,
+            dedupe_log_entries,
+            log_sample_rate,
+            max_request_bytes)
 
 
 ZERO_INTERVAL = timedelta()
 
 
-def create(options, timer=None, use_deque=True):
+def create(options, timer=None, use_deque=True, clock=None):
     """Create a cache specified by ``options``
 
     ``options`` is an instance of either
@@ -180,8 +312,17 @@ def create(options, timer=None, use_deque=True):
       >>> with synced_cache as cache:  #  acquire the lock
       ...    cache['a_key'] = 'a_value'
 
+    If ``options.num_shards`` is greater than one, a :class:`ShardedCache` of
+    that many :class:`LockedObject` shards is returned instead.  The
+    ``num_entries`` are divided between the shards.
+
     Args:
       options (object): an instance of either of the options classes
+      timer (func[[datetime.datetime]]): obtains the current time
+      use_deque (bool): if True, expired or evicted entries are added to the
+        cache's ``out_deque``
+      clock (func[[int]]): if set, it is used instead of ``timer``; see
+        :func:`to_clock_timer`
 
     Returns:
       :class:`cachetools.Cache`: the cache implementation specified by options
@@ -203,21 +344,59 @@ def create(options, timer=None, use_deque=True):
         return None
 
     _logger.debug(u"creating a cache from %s", options)
+    num_shards = options.num_shards
+    max_size = -(-options.num_entries // num_shards)  # rounds up
+    make_cache = _cache_factory(options, max_size, timer, use_deque, clock)
+    if num_shards == 1:
+        return LockedObject(make_cache())
+    return ShardedCache([LockedObject(make_cache()) for _ in range(num_shards)])
+
+
+def _cache_factory(options, max_size, timer, use_deque, clock):
+    """Selects the cache implementation specified by ``options``.
+
+    Returns:
+      func[[], :class:`cachetools.Cache`]: makes a cache, or a shard of one,
+        that holds at most ``max_size`` entries
+    """
+    eviction_policy = getattr(options, u'eviction_policy', LRU)
     if (options.flush_interval > ZERO_INTERVAL):
         # options always has a flush_interval, but may have an expiration
         # field. If the expiration is present, use that instead of the
         # flush_interval for the ttl
         ttl = getattr(options, u'expiration', options.flush_interval)
-        cache_cls = DequeOutTTLCache if use_deque else cachetools.TTLCache
-        return LockedObject(
-            cache_cls(
-                options.num_entries,
-                ttl=ttl.total_seconds(),
-                timer=to_cache_timer(timer)
-            ))
-
-    cache_cls = DequeOutLRUCache if use_deque else cachetools.LRUCache
-    return LockedObject(cache_cls(options.num_entries))
+        if clock is None:
+            cache_timer = to_cache_timer(timer)
+        else:
+            cache_timer = to_clock_timer(clock)
+        if eviction_policy == TINY_LFU:
+            def make_cache():
+                return TinyLFUCache(
+                    max_size,
+                    ttl=ttl.total_seconds(),
+                    timer=cache_timer,
+                    out_deque=collections.deque() if use_deque else None
+                )
+        else:
+            cache_cls = DequeOutTTLCache if use_deque else cachetools.TTLCache
+
+            def make_cache():
+                return cache_cls(
+                    max_size,
+                    ttl=ttl.total_seconds(),
+                    timer=cache_timer
+                )
+    elif eviction_policy == TINY_LFU:
+        def make_cache():
+            return TinyLFUCache(
+                max_size,
+                out_deque=collections.deque() if use_deque else None)
+    else:
+        cache_cls = DequeOutLRUCache if use_deque else cachetools.LRUCache
+
+        def make_cache():
+            return cache_cls(max_size)
+    return make_cache
 
 
 class DequeOutTTLCache(cachetools.TTLCache):
@@ -260,6 +439,20 @@ class DequeOutTTLCache(cachetools.TTLCache):
             self._out_deque.append(v)
         return self._out_deque
 
+    def swap_out_deque(self):
+        """Replaces ``out_deque`` with an empty ``deque``.
+
+        This allows the items in it to be processed once the lock on the
+        cache is released.
+
+        Returns:
+          :class:`collections.deque`: the previous ``out_deque``, including
+            any items that expired since it was last obtained
+        """
+        out_deque = self.out_deque
+        self._out_deque = collections.deque()
+        return out_deque
+
 
 class DequeOutLRUCache(cachetools.LRUCache):
     """Extends ``LRUCache`` so that expired items are placed in a ``deque``."""
@@ -299,6 +492,267 @@ class DequeOutLRUCache(cachetools.LRUCache):
             self._out_deque.append(v)
         return self._out_deque
 
+    def swap_out_deque(self):
+        """Replaces ``out_deque`` with an empty ``deque``.
+
+        This allows the items in it to be processed once the lock on the
+        cache is released.
+
+        Returns:
+          :class:`collections.deque`: the previous ``out_deque``, including
+            any items that expired since it was last obtained
+        """
+        out_deque = self.out_deque
+        self._out_deque = collections.deque()
+        return out_deque
+
+
+class FrequencySketch(object):
+    """FrequencySketch estimates how often keys have been used recently.
+
+    It is a count-min sketch of four rows of small counters.  The estimate for
+    a key is the lowest of its counters, so it may be too high when keys
+    collide, but is never too low.  Once a number of uses proportional to the
+    capacity have been recorded, all the counters are halved, so that the
+    estimates favour recent use.
+    """
+    DEPTH = 4
+    MAX_COUNT = 15
+    _MIX = 0x9E3779B97F4A7C15
+    _MASK_64 = 0xFFFFFFFFFFFFFFFF
+
+    def __init__(self, capacity):
+        """Constructor.
+
+        Args:
+          capacity (int): the number of keys whose use is expected to be
+            tracked, usually the size of the cache
+        """
+        width = 16
+        while width < 2 * capacity:
+            width *= 2
+        self._mask = width - 1
+        self._rows = [bytearray(width) for _ in range(self.DEPTH)]
+        self._sample_size = 10 * max(capacity, 1)
+        self._additions = 0
+
+    def _indexes(self, key):
+        h = (hash(key) * self._MIX) & self._MASK_64
+        h1 = h & 0xFFFFFFFF
+        h2 = (h >> 32) | 1
+        mask = self._mask
+        return [(h1 + i * h2) & mask for i in range(self.DEPTH)]
+
+    def increment(self, key):
+        """Records a use of ``key``."""
+        for row, index in zip(self._rows, self._indexes(key)):
+            if row[index] < self.MAX_COUNT:
+                row[index] += 1
+        self._additions += 1
+        if self._additions >= self._sample_size:
+            self._age()
+
+    def frequency(self, key):
+        """Obtains the estimated number of recent uses of ``key``."""
+        return min(row[index]
+                   for row, index in zip(self._rows, self._indexes(key)))
+
+    def _age(self):
+        self._rows = [bytearray(count >> 1 for count in row)
+                      for row in self._rows]
+        self._additions //= 2
+
+
+class TinyLFUCache(collections.abc.MutableMapping):
+    """TinyLFUCache is a cache that resists eviction of its popular entries.
+
+    New entries are added to a small LRU window.  When the window is full, its
+    least recently used entry is a candidate for the main segment, which holds
+    most of the entries.  If the main segment is also full, the candidate is
+    only admitted if a :class:`FrequencySketch` shows that it has been used
+    more often than the least recently used entry of the main segment, which
+    is evicted in its place; otherwise the candidate is evicted.  A burst of
+    keys that are used once each, as from a scan, passes through the window
+    without evicting the entries that are used often.
+
+    Like ``cachetools.TTLCache``, entries expire once their ttl has elapsed
+    since they were last set.  Entries that expire or are evicted are added to
+    ``out_deque``, if there is one.  Entries that are deleted are not.
+
+    Reading an entry with ``get`` or ``[]`` records a use of its key, even if
+    it is not present.
+
+    """
+    WINDOW_RATIO = 0.01
+
+    def __init__(self, maxsize, ttl=None, timer=time.time, out_deque=None):
+        """Constructor.
+
+        Args:
+          maxsize (int): the maximum number of entries in the cache
+          ttl (float): the ttl for entries added to the cache, or ``None`` if
+            entries do not expire
+          timer (func[[float]]): obtains the current time, in the units of
+            ``ttl``
+          out_deque :class:`collections.deque`: a `deque` in which to add items
+            that expire or are evicted from the cache
+
+        Raises:
+          ValueError: if out_deque is not a collections.deque
+
+        """
+        if out_deque is not None and not isinstance(out_deque, collections.deque):
+            raise ValueError(u'out_deque should be a collections.deque')
+        self._maxsize = maxsize
+        self._window_size = max(1, int(maxsize * self.WINDOW_RATIO))
+        self._main_size = max(0, maxsize - self._window_size)
+        self._window = collections.OrderedDict()
+        self._main = collections.OrderedDict()
+        self._expiries = collections.OrderedDict()  # earliest first
+        self._sketch = FrequencySketch(maxsize)
+        self._out_deque = out_deque
+        self.ttl = ttl
+        self.timer = timer
+
+    def __repr__(self):
+        return u'%s(maxsize=%d, currsize=%d)' % (
+            self.__class__.__name__, self._maxsize, self.currsize)
+
+    @property
+    def maxsize(self):
+        """The maximum number of entries in the cache."""
+        return self._maxsize
+
+    @property
+    def currsize(self):
+        """The number of entries in the cache, including any expired ones."""
+        return len(self._window) + len(self._main)
+
+    @property
+    def out_deque(self):
+        """The :class:`collections.deque` to which evicted items are added."""
+        self.expire()
+        return self._out_deque
+
+    def swap_out_deque(self):
+        """Replaces ``out_deque`` with an empty ``deque``.
+
+        Returns:
+          :class:`collections.deque`: the previous ``out_deque``, including
+            any items that expired since it was last obtained
+
+        Raises:
+          ValueError: if this instance has no ``out_deque``
+        """
+        out_deque = self.out_deque
+        if out_deque is None:
+            raise ValueError(u'there is no out_deque to swap')
+        self._out_deque = collections.deque()
+        return out_deque
+
+    def __getitem__(self, key):
+        self._sketch.increment(key)
+        segment = self._segment_of(key)
+        if segment is None:
+            raise KeyError(key)
+        if self._has_expired(key):
+            self._evict(key, segment.pop(key))
+            raise KeyError(key)
+        segment.move_to_end(key)
+        return segment[key]
+
+    def __contains__(self, key):
+        return self._segment_of(key) is not None and not self._has_expired(key)
+
+    def __setitem__(self, key, value):
+        self.expire()
+        segment = self._segment_of(key)
+        if segment is None:
+            segment = self._window
+        segment[key] = value
+        segment.move_to_end(key)
+        if self.ttl is not None:
+            self._expiries.pop(key, None)
+            self._expiries[key] = self.timer() + self.ttl
+        if len(self._window) > self._window_size:
+            self._evict_from_window()
+
+    def __delitem__(self, key):
+        segment = self._segment_of(key)
+        if segment is None:
+            raise KeyError(key)
+        del segment[key]
+        self._expiries.pop(key, None)
+
+    def __iter__(self):
+        self.expire()
+        for key in list(self._window) + list(self._main):
+            yield key
+
+    def __len__(self):
+        self.expire()
+        return self.currsize
+
+    def values(self):
+        """Obtains the values in the cache, without recording their use."""
+        self.expire()
+        return list(self._window.values()) + list(self._main.values())
+
+    def items(self):
+        """Obtains the items in the cache, without recording their use."""
+        self.expire()
+        return list(self._window.items()) + list(self._main.items())
+
+    def clear(self):
+        self._window.clear()
+        self._main.clear()
+        self._expiries.clear()
+
+    def expire(self):
+        """Removes the expired entries, adding them to ``out_deque``."""
+        if self.ttl is None:
+            return
+        now = self.timer()
+        expiries = self._expiries
+        while expiries:
+            key, expiry = next(iter(expiries.items()))
+            if not expiry < now:
+                return
+            segment = self._segment_of(key)
+            self._evict(key, segment.pop(key))
+
+    def _segment_of(self, key):
+        if key in self._window:
+            return self._window
+        if key in self._main:
+            return self._main
+        return None
+
+    def _has_expired(self, key):
+        if self.ttl is None:
+            return False
+        return self._expiries[key] < self.timer()
+
+    def _evict_from_window(self):
+        candidate_key, candidate = self._window.popitem(last=False)
+        main = self._main
+        if len(main) < self._main_size:
+            main[candidate_key] = candidate
+            return
+        if main:
+            victim_key = next(iter(main))
+            sketch = self._sketch
+            if sketch.frequency(candidate_key) > sketch.frequency(victim_key):
+                self._evict(victim_key, main.pop(victim_key))
+                main[candidate_key] = candidate
+                return
+        self._evict(candidate_key, candidate)
+
+    def _evict(self, key, value):
+        self._expiries.pop(key, None)
+        if self._out_deque is not None:
+            self._out_deque.append(value)
+
 
 class LockedObject(object):
     """LockedObject protects an object with a re-entrant lock.
@@ -319,6 +773,52 @@ class LockedObject(object):
         self._lock.release()
 
 
+class ShardedCache(object):
+    """ShardedCache splits a cache into independently locked shards.
+
+    Each key is held by the shard selected by its hash, so threads using keys
+    in different shards do not contend for the same lock.
+    """
+
+    def __init__(self, shards):
+        """Constructor.
+
+        Args:
+          shards (list[:class:`LockedObject`]): the locked caches used as shards
+        """
+        self._shards = tuple(shards)
+
+    @property
+    def shards(self):
+        """The :class:`LockedObject` shards of this instance."""
+        return self._shards
+
+    def shard(self, key):
+        """Obtains the :class:`LockedObject` shard that holds ``key``."""
+        return self._shards[hash(key) % len(self._shards)]
+
+
+def shard_for(cache, key):
+    """Obtains the locked shard of ``cache`` that holds ``key``.
+
+    Args:
+      cache: a cache returned by :func:`create`
+
+    Returns:
+      :class:`LockedObject`: ``cache`` itself, unless it's a :class:`ShardedCache`
+    """
+    if isinstance(cache, ShardedCache):
+        return cache.shard(key)
+    return cache
+
+
+def shards_of(cache):
+    """Obtains all the locked shards of a cache returned by :func:`create`."""
+    if isinstance(cache, ShardedCache):
+        return cache.shards
+    return (cache,)
+
+
 def to_cache_timer(datetime_func):
     """Converts a datetime_func to a timestamp_func.
 
@@ -338,3 +838,51 @@ def to_cache_timer(datetime_func):
         return (datetime_func() - datetime(1970, 1, 1)).total_seconds()
 
     return _timer
+
+
+NANOS_PER_SECOND = 1000000000
+
+
+monotonic_nanos = time.monotonic_ns
+"""Obtains the number of nanoseconds from an arbitrary point as an int.
+
+Unlike :func:`datetime.datetime.utcnow`, it is not affected by changes to the
+system clock, so it can be used as the ``clock`` of the aggregators and
+:class:`endpoints_management.control.client.Client`.
+"""
+
+
+def to_clock_timer(clock):
+    """Converts a clock to a timestamp_func.
+
+    Args:
+       clock (callable[[int]]): a func that returns the current time in
+         nanoseconds, e.g :func:`monotonic_nanos`
+
+    Returns:
+       time_func (callable[[float]): a func that returns the time in seconds
+    """
+    def _timer():
+        """Return the clock's time in seconds."""
+        return clock() / NANOS_PER_SECOND
+
+    return _timer
+
+
+def to_clock_interval(delta, clock):
+    """Converts an interval to the units used with a clock.
+
+    Args:
+       delta (:class:`datetime.timedelta`): the interval, or ``None``
+       clock (callable[[int]]): a func that returns the current time in
+         nanoseconds, or ``None`` if the interval is compared with the
+         differences of :class:`datetime.datetime` values
+
+    Returns:
+       the interval as a ``timedelta`` if ``clock`` is None, otherwise as an
+       int number of nanoseconds
+    """
+    if delta is None or clock is None:
+        return delta
+    return ((delta.days * 86400 + delta.seconds) * NANOS_PER_SECOND +
+            delta.microseconds * 1000)
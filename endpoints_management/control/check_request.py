@@ -31,15 +31,11 @@ from future import standard_library
 standard_library.install_aliases()
 from builtins import object
 import collections
-import hashlib
 import http.client
 import logging
 from datetime import datetime
 
-from apitools.base.py import encoding
-
-from . import (caches, label_descriptor, metric_value, operation, sc_messages,
-               signing)
+from . import caches, label_descriptor, operation, sc_messages, signing
 from .. import USER_AGENT, SERVICE_AGENT
 
 _logger = logging.getLogger(__name__)
@@ -155,12 +151,14 @@ def convert_response(check_response, project_id):
     return error_tuple[0], updated_msg, error_tuple[2]
 
 
-def sign(check_request):
+def sign(check_request, signer=signing.DEFAULT_SIGNER):
     """Obtains a signature for an operation in a `CheckRequest`
 
     Args:
        op (:class:`endpoints_management.gen.servicecontrol_v1_messages.Operation`): an
          operation used in a `CheckRequest`
+       signer (:class:`endpoints_management.control.signing.Signer`): computes
+         the signature
 
     Returns:
        string: a secure hash generated from the operation
@@ -171,32 +169,37 @@ def sign(check_request):
     if op is None or op.operationName is None or op.consumerId is None:
         logging.error(u'Bad %s: not initialized => not signed', check_request)
         raise ValueError(u'check request must be initialized with an operation')
-    md5 = hashlib.md5()
-    md5.update(op.operationName.encode('utf-8'))
-    md5.update(b'\x00')
-    md5.update(op.consumerId.encode('utf-8'))
+    parts = [op.operationName.encode('utf-8'), b'\x00', op.consumerId.encode('utf-8')]
     if op.labels:
-        signing.add_dict_to_hash(md5, encoding.MessageToPyValue(op.labels))
+        signer.add_labels(parts, op.labels)
     for value_set in op.metricValueSets:
-        md5.update(b'\x00')
-        md5.update(value_set.metricName.encode('utf-8'))
+        parts.append(b'\x00')
+        parts.append(value_set.metricName.encode('utf-8'))
         for mv in value_set.metricValues:
-            metric_value.update_hash(md5, mv)
+            signer.add_metric_value(parts, mv)
 
-    md5.update(b'\x00')
-    if op.quotaProperties:
+    parts.append(b'\x00')
+    if op.quotaProperties is not None:
         # N.B: this differs form cxx implementation, which serializes the
         # protobuf. This should be OK as the exact hash used does not need to
         # match across implementations.
-        md5.update(repr(op.quotaProperties).encode('utf-8'))
+        signer.add_quota_properties(parts, op.quotaProperties)
 
-    md5.update(b'\x00')
-    return md5.digest()
+    parts.append(b'\x00')
+    return signer.digest(parts)
 
 
 _KNOWN_LABELS = label_descriptor.KnownLabels
 
 
+# Forcibly add system label reporting to every request, as the base service
+# config does not specify it as a label.
+_SYSTEM_LABELS = (
+    (_KNOWN_LABELS.SCC_SERVICE_AGENT.label_name, SERVICE_AGENT),
+    (_KNOWN_LABELS.SCC_USER_AGENT.label_name, USER_AGENT),
+)
+
+
 class Info(collections.namedtuple(u'Info',
                                   (u'client_ip',) + operation.Info._fields),
            operation.Info):
@@ -231,28 +234,27 @@ class Info(collections.namedtuple(u'Info',
         if not self.operation_name:
             raise ValueError(u'the operation name must be set')
         op = super(Info, self).as_operation(timer=timer)
-        labels = {}
+        labels = []
         if self.android_cert_fingerprint:
-            labels[_KNOWN_LABELS.SCC_ANDROID_CERT_FINGERPRINT.label_name] = self.android_cert_fingerprint
+            labels.append((_KNOWN_LABELS.SCC_ANDROID_CERT_FINGERPRINT.label_name,
+                           self.android_cert_fingerprint))
 
         if self.android_package_name:
-            labels[_KNOWN_LABELS.SCC_ANDROID_PACKAGE_NAME.label_name] = self.android_package_name
+            labels.append((_KNOWN_LABELS.SCC_ANDROID_PACKAGE_NAME.label_name,
+                           self.android_package_name))
 
         if self.client_ip:
-            labels[_KNOWN_LABELS.SCC_CALLER_IP.label_name] = self.client_ip
+            labels.append((_KNOWN_LABELS.SCC_CALLER_IP.label_name, self.client_ip))
 
         if self.ios_bundle_id:
-            labels[_KNOWN_LABELS.SCC_IOS_BUNDLE_ID.label_name] = self.ios_bundle_id
+            labels.append((_KNOWN_LABELS.SCC_IOS_BUNDLE_ID.label_name,
+                           self.ios_bundle_id))
 
         if self.referer:
-            labels[_KNOWN_LABELS.SCC_REFERER.label_name] = self.referer
-
-        # Forcibly add system label reporting here, as the base service
-        # config does not specify it as a label.
-        labels[_KNOWN_LABELS.SCC_SERVICE_AGENT.label_name] = SERVICE_AGENT
-        labels[_KNOWN_LABELS.SCC_USER_AGENT.label_name] = USER_AGENT
+            labels.append((_KNOWN_LABELS.SCC_REFERER.label_name, self.referer))
 
-        op.labels = encoding.PyValueToMessage(
+        labels.extend(_SYSTEM_LABELS)
+        op.labels = label_descriptor.labels_message(
             sc_messages.Operation.LabelsValue, labels)
         check_request = sc_messages.CheckRequest(operation=op)
         return sc_messages.ServicecontrolServicesCheckRequest(
@@ -297,6 +299,18 @@ class Aggregator(object):
       >>> agg.check(req)  # next call returns the cached response
       <CheckResponse ....>
 
+    Serving stale responses while they are refreshed
+
+    If ``options.max_staleness`` is set, a cached response without errors
+    continues to be returned after the flush interval.  The first call after
+    the flush interval queues a request that refreshes it, which is returned
+    by the next call to :meth:`flush`.  :meth:`flush` is then due every flush
+    interval rather than every expiration, and the response stays cached for
+    ``expiration`` after its refresh is queued, so that the refreshed
+    response arrives before it is evicted.  Once the response is older than
+    ``max_staleness``, e.g because the refresh failed, the caller is signalled
+    to send the request as before.
+
     Flushing the cache
 
     Once a response is expired, if there is an outstanding, cached CheckRequest
@@ -314,7 +328,7 @@ class Aggregator(object):
     """
 
     def __init__(self, service_name, options, kinds=None,
-                 timer=datetime.utcnow):
+                 timer=datetime.utcnow, clock=None):
         """Constructor.
 
         Args:
@@ -326,12 +340,24 @@ class Aggregator(object):
             kind of metric for each each metric name.
           timer (function([[datetime]]): a function that returns the current
             as a time as a datetime instance
+          clock (function([[int]]): if set, a function that returns the
+            current time in nanoseconds, e.g
+            :func:`endpoints_management.control.caches.monotonic_nanos`.  It
+            is used instead of ``timer`` to determine the age of cached items
         """
         self._service_name = service_name
         self._options = options
-        self._cache = caches.create(options, timer=timer)
+        self._cache = caches.create(options, timer=timer, clock=clock)
+        self._signer = signing.create(options)
         self._kinds = {} if kinds is None else dict(kinds)
-        self._timer = timer
+        self._timer = timer if clock is None else clock
+        if options is not None:
+            # in the units of the differences of the values from self._timer
+            self._flush_interval = caches.to_clock_interval(
+                options.flush_interval, clock)
+            self._max_staleness = caches.to_clock_interval(
+                options.max_staleness, clock)
+        self._refresh_reqs = collections.deque()
 
     @property
     def service_name(self):
@@ -344,10 +370,15 @@ class Aggregator(object):
 
         Returns:
            timedelta: the period between calls to flush if, or ``None`` if no
-           cache is set
+           cache is set.  If stale responses are refreshed, it is the flush
+           interval, so that the refreshes are sent promptly
 
         """
-        return None if self._cache is None else self._options.expiration
+        if self._cache is None:
+            return None
+        if self._max_staleness is not None:
+            return self._options.flush_interval
+        return self._options.expiration
 
     def flush(self):
         """Flushes this instance's cache.
@@ -357,24 +388,32 @@ class Aggregator(object):
 
         Returns:
           list['CheckRequest']: corresponding to CheckRequests that were
-          pending
+          pending, including those that refresh stale responses
 
         """
         if self._cache is None:
             return []
-        with self._cache as c:
-            flushed_items = list(c.out_deque)
-            c.out_deque.clear()
-            cached_reqs = [item.extract_request() for item in flushed_items]
-            cached_reqs = [req for req in cached_reqs if req is not None]
-            return cached_reqs
+        cached_reqs = []
+        while self._refresh_reqs:
+            cached_reqs.append(self._refresh_reqs.popleft())
+        # As in report_request.Aggregator.flush, the requests are extracted
+        # from the evicted items once the locks are released
+        out_deques = []
+        for shard in caches.shards_of(self._cache):
+            with shard as c:
+                out_deques.append(c.swap_out_deque())
+        cached_reqs.extend(item.extract_request()
+                           for d in out_deques for item in d)
+        return [req for req in cached_reqs if req is not None]
 
     def clear(self):
         """Clears this instance's cache."""
         if self._cache is not None:
-            with self._cache as c:
-                c.clear()
-                c.out_deque.clear()
+            for shard in caches.shards_of(self._cache):
+                with shard as c:
+                    c.clear()
+                    c.out_deque.clear()
+            self._refresh_reqs.clear()
 
     def add_response(self, req, resp):
         """Adds the response from sending to `req` to this instance's cache.
@@ -385,8 +424,8 @@ class Aggregator(object):
         """
         if self._cache is None:
             return
-        signature = sign(req.checkRequest)
-        with self._cache as c:
+        signature = sign(req.checkRequest, self._signer)
+        with caches.shard_for(self._cache, signature) as c:
             now = self._timer()
             quota_scale = 0  # WIP
             item = c.get(signature)
@@ -460,39 +499,55 @@ class Aggregator(object):
         if op.importance != sc_messages.Operation.ImportanceValueValuesEnum.LOW:
             return None  # op is important, send request now
 
-        signature = sign(check_request)
-        with self._cache as cache:
+        signature = sign(check_request, self._signer)
+        with caches.shard_for(self._cache, signature) as cache:
             _logger.debug(u'checking the cache for %r\n%s', signature, cache)
             item = cache.get(signature)
             if item is None:
                 return None  # signal to caller to send req
             else:
-                return self._handle_cached_response(req, item)
-
-    def _handle_cached_response(self, req, item):
-        with self._cache:  # defensive, this re-entrant lock should be held
-            if len(item.response.checkErrors) > 0:
-                if self._is_current(item):
-                    return item.response
-
-                # There are errors, but now it's ok to send a new request
-                item.last_check_time = self._timer()
-                return None  # signal caller to send req
-            else:
-                item.update_request(req, self._kinds)
-                if self._is_current(item):
-                    return item.response
+                return self._handle_cached_response(req, item, cache, signature)
 
-                if (item.is_flushing):
-                    _logger.warn(u'last refresh request did not complete')
+    def _handle_cached_response(self, req, item, cache, signature):
+        # the lock on cache, the shard holding item, must be held by the caller
+        if len(item.response.checkErrors) > 0:
+            if self._is_current(item):
+                return item.response
 
-                item.is_flushing = True
-                item.last_check_time = self._timer()
-                return None  # signal caller to send req
+            # There are errors, but now it's ok to send a new request
+            item.last_check_time = self._timer()
+            return None  # signal caller to send req
+        else:
+            item.update_request(req, self._kinds)
+            if self._is_current(item):
+                return item.response
+
+            if self._may_be_stale(item):
+                if not item.is_flushing:
+                    # refresh the response in the next flush, and restart its
+                    # expiration so it is not evicted before the refresh ends
+                    item.is_flushing = True
+                    self._refresh_reqs.append(item.extract_request())
+                    cache[signature] = item
+                return item.response
+
+            if (item.is_flushing):
+                _logger.warn(u'last refresh request did not complete')
+
+            item.is_flushing = True
+            item.last_check_time = self._timer()
+            return None  # signal caller to send req
 
     def _is_current(self, item):
         age = self._timer() - item.last_check_time
-        return age < self._options.flush_interval
+        return age < self._flush_interval
+
+    def _may_be_stale(self, item):
+        max_staleness = self._max_staleness
+        if max_staleness is None:
+            return False
+        age = self._timer() - item.last_check_time
+        return age < max_staleness
 
 
 class CachedItem(object):
@@ -506,7 +561,8 @@ class CachedItem(object):
          is stale, and needs to be flushed
        quota_scale (int): WIP, used to determine quota
        last_check_time (datetime.datetime): the last time this instance
-         was checked
+         was checked, or the clock's time in nanoseconds if the aggregator
+         has a clock
 
     """
 
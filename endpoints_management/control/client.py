@@ -49,9 +49,11 @@ import os
 import threading
 import time
 
-from . import api_client, check_request, quota_request, report_request, sc_messages
+from . import (api_client, check_request, flush_dispatch, quota_request,
+               report_request, sc_messages)
 from .. import USER_AGENT
-from .caches import CheckOptions, QuotaOptions, ReportOptions, to_cache_timer
+from .caches import (CheckOptions, QuotaOptions, ReportOptions, to_cache_timer,
+                     to_clock_timer)
 from .vendor.py3 import sched
 
 
@@ -128,6 +130,13 @@ class Loaders(Enum):
         check_opts, quota_opts, report_opts = self._load_func()
         return Client(service_name, check_opts, quota_opts, report_opts, **kw)
 
+    def load_async(self, service_name, **kw):
+        """Loads an :class:`endpoints_management.control.async_client.AsyncClient`."""
+        # imported here as async_client depends on this module
+        from .async_client import AsyncClient
+        check_opts, quota_opts, report_opts = self._load_func()
+        return AsyncClient(service_name, check_opts, quota_opts, report_opts, **kw)
+
 
 _THREAD_CLASS = threading.Thread
 
@@ -188,7 +197,9 @@ class Client(object):
                  quota_options,
                  report_options,
                  timer=datetime.utcnow,
-                 create_transport=_CREATE_THREAD_LOCAL_TRANSPORT):
+                 create_transport=_CREATE_THREAD_LOCAL_TRANSPORT,
+                 flush_options=None,
+                 clock=None):
         """
 
         Args:
@@ -200,24 +211,47 @@ class Client(object):
             report_options (:class:`endpoints_management.control.caches.ReportOptions`):
               configures reporting
             timer (:func[[datetime.datetime]]: used to obtain the current time.
+            create_transport (func[[]]): obtains the transport used to send
+              requests; if it has a ``prewarm`` method, e.g it is a
+              :class:`endpoints_management.control.transport_pool.TransportPool`,
+              that is called by the flushing thread when it starts
+            flush_options (:class:`endpoints_management.control.flush_dispatch.FlushOptions`):
+              if set, flushed requests are sent concurrently as configured.
+              Otherwise, they are sent one after another by the flushing
+              thread
+            clock (:func[[int]]): if set, it obtains the current time in
+              nanoseconds, and is used instead of ``timer`` to measure
+              intervals, e.g
+              :func:`endpoints_management.control.caches.monotonic_nanos`
         """
         self._check_aggregator = check_request.Aggregator(service_name,
                                                           check_options,
-                                                          timer=timer)
+                                                          timer=timer,
+                                                          clock=clock)
         self._quota_aggregator = quota_request.Aggregator(service_name,
                                                           quota_options,
-                                                          timer=timer)
+                                                          timer=timer,
+                                                          clock=clock)
         self._report_aggregator = report_request.Aggregator(service_name,
                                                             report_options,
-                                                            timer=timer)
+                                                            timer=timer,
+                                                            clock=clock)
         self._running = False
         self._scheduler = None
         self._stopped = False
-        self._timer = to_cache_timer(timer)
+        if clock is None:
+            self._timer = to_cache_timer(timer)
+        else:
+            self._timer = to_clock_timer(clock)
         self._thread = None
         self._create_transport = create_transport
         self._lock = threading.RLock()
         self._idle_timer_started_at = None
+        self._check_calls = _SingleFlight()
+        self._flush_options = flush_options
+        self._flush_dispatcher = None
+        if flush_options is not None:
+            self._flush_dispatcher = flush_dispatch.Dispatcher(flush_options)
 
     def _start_idle_timer(self):
         self._idle_timer_started_at = self._timer()
@@ -231,7 +265,8 @@ class Client(object):
 
         Calling this method
 
-        - starts the thread that regularly flushes all enabled caches.
+        - starts the thread that regularly flushes all enabled caches, after
+          pre-warming the transport's connections if it supports that
         - enables the other methods on the instance to be called successfully
         """
         with self._lock:
@@ -240,6 +275,10 @@ class Client(object):
 
             self._stopped = False
             self._running = True
+            if (self._flush_options is not None and
+                    self._flush_dispatcher is None):
+                self._flush_dispatcher = flush_dispatch.Dispatcher(
+                    self._flush_options)
             self._start_idle_timer()
             _logger.debug(u'starting thread of type %s to run the scheduler',
                           _THREAD_CLASS)
@@ -257,7 +296,8 @@ class Client(object):
         """Halts processing
 
         This will lead to the reports being flushed, the caches being cleared
-        and a stop to the current processing thread.
+        and a stop to the current processing thread.  The threads that send
+        flushed requests are stopped once their queued requests are sent.
 
         """
         with self._lock:
@@ -267,6 +307,7 @@ class Client(object):
 
             self._flush_all_reports()
             self._stopped = True
+            dispatcher, self._flush_dispatcher = self._flush_dispatcher, None
             if self._run_scheduler_directly:
                 self._cleanup_if_stopped()
 
@@ -278,6 +319,9 @@ class Client(object):
                 self._running = False
             self._scheduler = None
 
+        if dispatcher is not None:
+            dispatcher.shutdown()
+
     def check(self, check_req):
         """Process a check_request.
 
@@ -303,6 +347,15 @@ class Client(object):
                           check_request, res)
             return res
 
+        # Concurrent misses for the same operation share a single request, so
+        # that the expiry of a popular cache entry does not lead to a burst of
+        # identical requests
+        if _is_coalesced(check_req):
+            signature = check_request.sign(check_req.checkRequest)
+            return self._check_calls.call(signature, self._send_check, check_req)
+        return self._send_check(check_req)
+
+    def _send_check(self, check_req):
         # Application code should not fail because check request's don't
         # complete, They should fail open, so here simply log the error and
         # return None to indicate that no response was obtained
@@ -375,6 +428,9 @@ class Client(object):
 
     def _schedule_flushes(self):
         # the method expects to be run in the thread created in start()
+        prewarm = getattr(self._create_transport, u'prewarm', None)
+        if prewarm is not None:
+            prewarm()
         self._initialize_flushing()
         self._scheduler.run()  # should block until self._stopped is set
         _logger.debug(u'scheduler.run completed, %s will exit', threading.current_thread())
@@ -403,13 +459,8 @@ class Client(object):
             return
 
         _logger.debug(u'flushing the check aggregator')
-        transport = self._create_transport()
-        for req in self._check_aggregator.flush():
-            try:
-                resp = transport.services.Check(req)
-                self._check_aggregator.add_response(req, resp)
-            except Exception:  # pylint: disable=broad-except
-                _logger.error(u'failed to flush check_req %s', req, exc_info=True)
+        self._send_flushed(flush_dispatch.CHECK, self._send_flushed_check,
+                           self._check_aggregator.flush(), flush_interval)
 
         # schedule a repeat of this method
         self._scheduler.enter(
@@ -434,15 +485,11 @@ class Client(object):
             return
 
         _logger.debug(u'flushing the quota aggregator')
-        transport = self._create_transport()
         reqs = self._quota_aggregator.flush()
         _logger.debug(u'flushing %d quota from the quota aggregator', len(reqs))
-        for req in reqs:
-            try:
-                resp = transport.services.AllocateQuota(req)
-                self._quota_aggregator.add_response(req, resp)
-            except Exception:  # pylint: disable=broad-except
-                _logger.error(u'failed to flush quota_req %s', req, exc_info=True)
+        self._send_flushed(flush_dispatch.QUOTA, self._send_flushed_quota,
+                           reqs, flush_interval,
+                           on_unsent=self._quota_aggregator.add_unsent)
 
         # schedule a repeat of this method
         self._scheduler.enter(
@@ -463,14 +510,10 @@ class Client(object):
             return
 
         # flush reports and schedule a repeat of this method
-        transport = self._create_transport()
         reqs = self._report_aggregator.flush()
         _logger.debug(u"will flush %d report requests", len(reqs))
-        for req in reqs:
-            try:
-                transport.services.Report(req)
-            except exceptions.Error:  # only sink apitools errors
-                _logger.error(u'failed to flush report_req %s', req, exc_info=True)
+        self._send_flushed(flush_dispatch.REPORT, self._send_flushed_report,
+                           reqs, flush_interval)
 
         if len(reqs) > 0:
             self._start_idle_timer()
@@ -490,12 +533,106 @@ class Client(object):
     def _flush_all_reports(self):
         all_requests = self._report_aggregator.clear()
         _logger.debug(u'flushing all reports (count=%d)', len(all_requests))
-        transport = self._create_transport()
         for req in all_requests:
-            try:
-                transport.services.Report(req)
-            except exceptions.Error:  # only sink apitools errors
-                _logger.error(u'failed to flush report_req %s', req, exc_info=True)
+            self._send_flushed_report(req)
+
+    def _send_flushed(self, kind, send, reqs, flush_interval, on_unsent=None):
+        dispatcher = self._flush_dispatcher
+        if dispatcher is None:
+            for req in reqs:
+                send(req)
+        else:
+            dispatcher.send_all(kind, send, reqs, flush_interval,
+                                on_unsent=on_unsent)
+
+    def _send_flushed_check(self, req):
+        try:
+            transport = self._create_transport()
+            resp = transport.services.Check(req)
+            self._check_aggregator.add_response(req, resp)
+        except Exception:  # pylint: disable=broad-except
+            _logger.error(u'failed to flush check_req %s', req, exc_info=True)
+
+    def _send_flushed_quota(self, req):
+        try:
+            transport = self._create_transport()
+            resp = transport.services.AllocateQuota(req)
+            self._quota_aggregator.add_response(req, resp)
+        except Exception:  # pylint: disable=broad-except
+            _logger.error(u'failed to flush quota_req %s', req, exc_info=True)
+
+    def _send_flushed_report(self, req):
+        try:
+            transport = self._create_transport()
+            transport.services.Report(req)
+        except exceptions.Error:  # only sink apitools errors
+            _logger.error(u'failed to flush report_req %s', req, exc_info=True)
+
+
+def _is_coalesced(check_req):
+    """Determines if concurrent sends of ``check_req`` may share one request.
+
+    Only the low importance operations that may be cached are coalesced; other
+    operations are always sent.
+    """
+    op = check_req.checkRequest.operation
+    return op.importance == sc_messages.Operation.ImportanceValueValuesEnum.LOW
+
+
+class _SingleFlight(object):
+    """Coalesces concurrent calls that have the same key.
+
+    While a call for a key is in progress, other calls with that key wait for
+    it to complete and share its result instead of making the call themselves.
+
+    Thread safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight = {}
+
+    def call(self, key, func, *args):
+        """Invokes ``func(*args)``, unless a call for ``key`` is in progress.
+
+        Returns:
+          the result of the call made for ``key``
+
+        Raises:
+          Exception: any exception raised by the call made for ``key``
+        """
+        with self._lock:
+            in_flight = self._in_flight.get(key)
+            is_leader = in_flight is None
+            if is_leader:
+                in_flight = _InFlightCall()
+                self._in_flight[key] = in_flight
+
+        if not is_leader:
+            in_flight.done.wait()
+            if in_flight.error is not None:
+                raise in_flight.error  # pylint: disable=raising-bad-type
+            return in_flight.result
+
+        try:
+            in_flight.result = func(*args)
+            return in_flight.result
+        except Exception as e:
+            in_flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            in_flight.done.set()
+
+
+class _InFlightCall(object):
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
 
 
 def use_default_thread():
@@ -22,6 +22,9 @@ in the correct state.
 
 :func:`add_sample` adds a sample to an existing distribution instance
 
+:func:`exponential_sampler` makes a func that creates distributions holding a
+single sample, with the bucket options resolved in advance
+
 :func:`merge` merges two distribution instances
 
 """
@@ -71,6 +74,53 @@ def create_exponential(num_finite_buckets, growth_factor, scale):
             scale=scale))
 
 
+def exponential_sampler(num_finite_buckets, growth_factor, scale):
+    """Makes a func that creates single sample distributions with exponential
+    buckets.
+
+    The args are validated, and the values used to find a sample's bucket are
+    computed, once when this is called.
+
+    Args:
+       num_finite_buckets (int): initializes number of finite buckets
+       growth_factor (float): initializes the growth factor
+       scale (float): initializes the scale
+
+    Return:
+       func(float): that returns the same
+       :class:`endpoints_management.gen.servicecontrol_v1_messages.Distribution`
+       as a call to :func:`create_exponential` followed by :func:`add_sample`
+
+    Raises:
+       ValueError: if the args are invalid for creating an instance
+    """
+    create_exponential(num_finite_buckets, growth_factor, scale)
+    log_factor = math.log(growth_factor)
+    overflow_index = num_finite_buckets + 1
+
+    def sampler(a_float):
+        if a_float <= scale:
+            index = 0
+        else:
+            index = 1 + int(math.log(a_float / scale) / log_factor)
+            index = min(index, overflow_index)
+        bucket_counts = [0] * (overflow_index + 1)
+        bucket_counts[index] = 1
+        return sc_messages.Distribution(
+            count=1,
+            maximum=a_float,
+            minimum=a_float,
+            mean=a_float,
+            sumOfSquaredDeviation=0,
+            bucketCounts=bucket_counts,
+            exponentialBuckets=sc_messages.ExponentialBuckets(
+                numFiniteBuckets=num_finite_buckets,
+                growthFactor=growth_factor,
+                scale=scale))
+
+    return sampler
+
+
 def create_linear(num_finite_buckets, width, offset):
     """Creates a new instance of distribution with linear buckets.
 
@@ -254,6 +304,10 @@ def _buckets_nearly_equal(a_dist, b_dist):
     """
     a_type, a_buckets = _detect_bucket_option(a_dist)
     b_type, b_buckets = _detect_bucket_option(b_dist)
+    return _bucket_options_nearly_equal(a_type, a_buckets, b_type, b_buckets)
+
+
+def _bucket_options_nearly_equal(a_type, a_buckets, b_type, b_buckets):
     if a_type != b_type:
         return False
     elif a_type == u'linearBuckets':
@@ -0,0 +1,208 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""flush_dispatch sends the requests flushed from the aggregators in parallel.
+
+By default, :class:`endpoints_management.control.client.Client` sends the
+requests flushed from its aggregators one after another on its scheduler
+thread.  Given :class:`FlushOptions`, it uses a :class:`Dispatcher` instead.
+
+Each kind of request is sent by its own bounded pool of worker threads, so
+check and quota refreshes are never queued behind a backlog of reports.  A flush
+does not wait for its requests to be sent, so a slow upstream does not delay
+later flushes.  Each send has a deadline, but only quota refreshes are
+cancelled when they have not started by then, because only their requests can
+be returned to their aggregator.  Overdue checks and reports are logged and
+still sent, so that they are never lost; their queues are not bounded.  The
+requests are sent in the order they are given, so the flushed requests that
+matter most should come first.
+
+"""
+
+from __future__ import absolute_import
+
+import collections
+import logging
+import threading
+import time
+from concurrent import futures
+from datetime import timedelta
+
+
+_logger = logging.getLogger(__name__)
+
+
+CHECK = u'check'
+QUOTA = u'quota'
+REPORT = u'report'
+KINDS = (CHECK, QUOTA, REPORT)
+
+
+class FlushOptions(
+        collections.namedtuple(
+            u'FlushOptions',
+            [u'check_concurrency',
+             u'quota_concurrency',
+             u'report_concurrency',
+             u'deadline'])):
+    """Holds values used to control how flushed requests are sent.
+
+    Attributes:
+
+        check_concurrency (int): the maximum number of flushed check requests
+          that are sent concurrently
+        quota_concurrency (int): the maximum number of flushed quota requests
+          that are sent concurrently
+        report_concurrency (int): the maximum number of flushed report
+          requests that are sent concurrently
+        deadline (:class:`datetime.timedelta`): the time a flushed
+          request may wait to be sent before it is overdue.  It only limits
+          quota refreshes: those that have not started by then are cancelled
+          and returned to the quota aggregator.  Overdue checks and reports
+          are only logged, and are still sent.  If ``None``, the flush
+          interval of the aggregator being flushed is used
+    """
+    # pylint: disable=too-few-public-methods
+    DEFAULT_CHECK_CONCURRENCY = 4
+    DEFAULT_QUOTA_CONCURRENCY = 4
+    DEFAULT_REPORT_CONCURRENCY = 2
+
+    def __new__(cls,
+                check_concurrency=DEFAULT_CHECK_CONCURRENCY,
+                quota_concurrency=DEFAULT_QUOTA_CONCURRENCY,
+                report_concurrency=DEFAULT_REPORT_CONCURRENCY,
+                deadline=None):
+        """Invokes the base constructor with default values."""
+        assert isinstance(check_concurrency, int), u'should be an int'
+        assert check_concurrency > 0, u'should be positive'
+        assert isinstance(quota_concurrency, int), u'should be an int'
+        assert quota_concurrency > 0, u'should be positive'
+        assert isinstance(report_concurrency, int), u'should be an int'
+        assert report_concurrency > 0, u'should be positive'
+        assert deadline is None or isinstance(deadline, timedelta), (
+            u'should be a timedelta')
+        return super(cls, FlushOptions).__new__(
+            cls,
+            check_concurrency,
+            quota_concurrency,
+            report_concurrency,
+            deadline)
+
+
+class Dispatcher(object):
+    """Dispatcher sends flushed requests using a worker pool per kind.
+
+    :meth:`send_all` does not wait for the requests to be sent.  Instead, each
+    send is given a deadline, and the sends of a kind that are still pending
+    after their deadline are dealt with when that kind is next flushed.
+
+    The worker threads are started when they are first needed.
+
+    Thread safe.
+
+    """
+
+    def __init__(self, options, timer=time.time):
+        """Constructor.
+
+        Args:
+          options (:class:`FlushOptions`): configures this instance
+          timer (func[[], float]): returns the current time in seconds
+        """
+        self._options = options
+        self._timer = timer
+        self._lock = threading.Lock()
+        self._pending = dict((kind, []) for kind in KINDS)
+        concurrency = {
+            CHECK: options.check_concurrency,
+            QUOTA: options.quota_concurrency,
+            REPORT: options.report_concurrency,
+        }
+        self._executors = dict(
+            (kind, futures.ThreadPoolExecutor(
+                max_workers=concurrency[kind],
+                thread_name_prefix=u'endpoints-flush-%s' % (kind,)))
+            for kind in KINDS)
+
+    def send_all(self, kind, send, reqs, flush_interval=None, on_unsent=None):
+        """Queues flushed requests to be sent, without waiting for them.
+
+        Before the requests are queued, the earlier sends of the same kind
+        that are still pending after their deadline are logged.  Those of them
+        that have not started are cancelled if ``on_unsent`` was given with
+        them, and each of their requests is passed to it; otherwise they are
+        left to be sent, so that no request is lost.
+
+        If this instance has been shut down, the requests are sent by the
+        calling thread.
+
+        Args:
+          kind (string): the kind of the requests, one of :data:`KINDS`
+          send (func[[request]]): sends one request, handling any errors
+          reqs (list): the requests to send
+          flush_interval (:class:`datetime.timedelta`): the deadline to use if
+            none is configured
+          on_unsent (func[[request]]): if set, it is called with each request
+            whose send is cancelled
+
+        Returns:
+          int: the number of earlier sends of ``kind`` that were still pending
+          after their deadline
+        """
+        overdue = self._reap(kind)
+        if not reqs:
+            return overdue
+        deadline = self._options.deadline
+        if deadline is None:
+            deadline = flush_interval
+        expires_at = (None if deadline is None
+                      else self._timer() + deadline.total_seconds())
+        executor = self._executors[kind]
+        submitted = []
+        for req in reqs:
+            try:
+                future = executor.submit(send, req)
+            except RuntimeError:  # the executor has been shut down
+                send(req)
+                continue
+            submitted.append((future, req, expires_at, on_unsent))
+        with self._lock:
+            self._pending[kind].extend(submitted)
+        return overdue
+
+    def shutdown(self):
+        """Stops the worker threads once the queued requests are sent."""
+        for executor in self._executors.values():
+            executor.shutdown(wait=True)
+        with self._lock:
+            for kind in KINDS:
+                self._pending[kind] = []
+
+    def _reap(self, kind):
+        now = self._timer()
+        with self._lock:
+            pending = [p for p in self._pending[kind] if not p[0].done()]
+            overdue = [p for p in pending
+                       if p[2] is not None and p[2] <= now]
+            cancelled = [(req, on_unsent)
+                         for future, req, _, on_unsent in overdue
+                         if on_unsent is not None and future.cancel()]
+            self._pending[kind] = [p for p in pending if not p[0].cancelled()]
+        if overdue:
+            _logger.warning(u'%d %s requests were not sent before their'
+                            u' deadline; %d of them were cancelled',
+                            len(overdue), kind, len(cancelled))
+        for req, on_unsent in cancelled:
+            on_unsent(req)
+        return len(overdue)
@@ -27,9 +27,9 @@ attributes including
 
 from __future__ import absolute_import
 
-
+import functools
 from enum import Enum
-from . import distribution, metric_value, sc_messages, MetricKind, ValueType
+from . import distribution, sc_messages, MetricKind, ValueType
 
 
 def _add_metric_value(name, value, an_op):
@@ -39,7 +39,7 @@ def _add_metric_value(name, value, an_op):
 
 def _add_int64_metric_value(name, value, an_op):
     _add_metric_value(
-        name, metric_value.create(int64Value=value), an_op)
+        name, sc_messages.MetricValue(int64Value=value), an_op)
 
 
 def _set_int64_metric_to_constant_1(name, dummy_info, op):
@@ -51,47 +51,47 @@ def _set_int64_metric_to_constant_1_if_http_error(name, info, op):
         _add_int64_metric_value(name, 1, op)
 
 
-def _add_distribution_metric_value(name, value, an_op, distribution_args):
-    d = distribution.create_exponential(*distribution_args)
-    distribution.add_sample(value, d)
+def _add_distribution_metric_value(name, value, an_op, sampler):
     _add_metric_value(
-        name, metric_value.create(distributionValue=d), an_op)
+        name, sc_messages.MetricValue(distributionValue=sampler(value)), an_op)
 
 
 _SIZE_DISTRIBUTION_ARGS = (8, 10.0, 1.0)
+_SIZE_SAMPLER = distribution.exponential_sampler(*_SIZE_DISTRIBUTION_ARGS)
 
 
 def _set_distribution_metric_to_request_size(name, info, an_op):
     if info.request_size >= 0:
         _add_distribution_metric_value(name, info.request_size, an_op,
-                                       _SIZE_DISTRIBUTION_ARGS)
+                                       _SIZE_SAMPLER)
 
 
 def _set_distribution_metric_to_response_size(name, info, an_op):
     if info.response_size >= 0:
         _add_distribution_metric_value(name, info.response_size, an_op,
-                                       _SIZE_DISTRIBUTION_ARGS)
+                                       _SIZE_SAMPLER)
 
 
 _TIME_DISTRIBUTION_ARGS = (8, 10.0, 1e-6)
+_TIME_SAMPLER = distribution.exponential_sampler(*_TIME_DISTRIBUTION_ARGS)
 
 
 def _set_distribution_metric_to_request_time(name, info, an_op):
     if info.request_time:
         _add_distribution_metric_value(name, info.request_time.total_seconds(),
-                                       an_op, _TIME_DISTRIBUTION_ARGS)
+                                       an_op, _TIME_SAMPLER)
 
 
 def _set_distribution_metric_to_backend_time(name, info, an_op):
     if info.backend_time:
         _add_distribution_metric_value(name, info.backend_time.total_seconds(),
-                                       an_op, _TIME_DISTRIBUTION_ARGS)
+                                       an_op, _TIME_SAMPLER)
 
 
 def _set_distribution_metric_to_overhead_time(name, info, an_op):
     if info.overhead_time:
         _add_distribution_metric_value(name, info.overhead_time.total_seconds(),
-                                       an_op, _TIME_DISTRIBUTION_ARGS)
+                                       an_op, _TIME_SAMPLER)
 
 
 class Mark(Enum):
@@ -303,6 +303,19 @@ class KnownMetrics(Enum):
         """
         self.update_op_func(self.metric_name, info, an_op)
 
+    def bind(self):
+        """Binds the metric name to the assigned update_op_func
+
+        This allows the update to be made without looking up the attributes of
+        this enum instance.
+
+        Return:
+           func(info, an_op): that has the same effect as
+           ``self.do_operation_update(info, an_op)``
+
+        """
+        return functools.partial(self.update_op_func, self.metric_name)
+
     def _consumer_metric(self, update_op_func):
         def resulting_updater(metric_name, info, an_op):
             if info.api_key_valid:
@@ -22,7 +22,6 @@
 
 from __future__ import absolute_import
 
-import hashlib
 import logging
 
 from apitools.base.py import encoding
@@ -90,12 +89,9 @@ def update_hash(a_hash, mv):
        mv (:class:`MetricValue`): the instance to add to the hash
 
     """
-    if mv.labels:
-        signing.add_dict_to_hash(a_hash, encoding.MessageToPyValue(mv.labels))
-    money_value = mv.get_assigned_value(u'moneyValue')
-    if money_value is not None:
-        a_hash.update(b'\x00')
-        a_hash.update(money_value.currencyCode.encode('utf-8'))
+    parts = []
+    signing.DEFAULT_SIGNER.add_metric_value(parts, mv)
+    a_hash.update(b''.join(parts))
 
 
 def sign(mv):
@@ -108,9 +104,9 @@ def sign(mv):
     Returns:
        string: a unique signature for that operation
     """
-    md5 = hashlib.md5()
-    update_hash(md5, mv)
-    return md5.digest()
+    parts = []
+    signing.DEFAULT_SIGNER.add_metric_value(parts, mv)
+    return signing.DEFAULT_SIGNER.digest(parts)
 
 
 def _merge_cumulative_or_gauge_metrics(prior, latest):
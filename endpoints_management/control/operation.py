@@ -19,20 +19,27 @@ information regarding an operation, and is a key constituent of
 :class:`~endpoints_management.gen.servicecontrol_v1_message.CheckRequest` and
 :class:`~endpoints_management.gen.servicecontrol_v1_message.ReportRequests.
 
-The :class:`.Aggregator` support this.
+The :class:`.Aggregator` support this.  :class:`.CompactAggregator` does
+the same, holding the aggregated values in a compact form until they are
+needed as an ``Operation``.
 
 """
 
 from __future__ import absolute_import
 
 from builtins import object
+import array
 import collections
 import logging
+import random
+import sys
 from datetime import datetime
 
+from apitools.base.protorpclite import messages
 from apitools.base.py import encoding
 
-from . import metric_value, sc_messages, timestamp, MetricKind
+from . import (distribution, metric_value, money, sc_messages, timestamp,
+               MetricKind)
 
 _logger = logging.getLogger(__name__)
 
@@ -215,3 +222,435 @@ class Aggregator(object):
             (self._op.endTime is None or timestamp.compare(
                 self._op.endTime, other_op.endTime) == -1)):
             self._op.endTime = other_op.endTime
+
+
+class LogEntryLimits(
+        collections.namedtuple(
+            u'LogEntryLimits',
+            [u'max_entries',
+             u'dedupe',
+             u'sample_rate'])):
+    """Limits the log entries kept by a :class:`CompactAggregator`.
+
+    Attributes:
+        max_entries (int): if set, the maximum number of log entries kept.
+          Once it is reached, the entries kept are a uniformly random sample
+          of those added, chosen by reservoir sampling
+        dedupe (bool): if ``True``, entries that differ only in when they
+          occurred, and in their latency, are kept as one entry, labelled with
+          their count using :data:`LOG_ENTRY_COUNT_LABEL`
+        sample_rate (float): the probability that each entry is kept
+    """
+    # pylint: disable=too-few-public-methods
+
+    def __new__(cls, max_entries=None, dedupe=False, sample_rate=1.0):
+        """Invokes the base constructor with default values."""
+        assert max_entries is None or isinstance(max_entries, int), (
+            u'should be an int')
+        assert max_entries is None or max_entries >= 0, (
+            u'should not be negative')
+        assert 0.0 <= sample_rate <= 1.0, u'should be a probability'
+        return super(cls, LogEntryLimits).__new__(
+            cls, max_entries, dedupe, sample_rate)
+
+
+LOG_ENTRY_COUNT_LABEL = u'log_entry_count'
+"""Labels a log entry that stands for several identical ones with their count."""
+
+# the struct payload fields ignored when comparing log entries
+_VARYING_LOG_FIELDS = frozenset([u'timestamp', u'request_latency_in_ms'])
+
+
+def _json_value_key(value):
+    if value.object_value is None and not value.array_value:
+        return (value.is_null, value.boolean_value, value.integer_value,
+                value.double_value, value.string_value)
+    return encoding.MessageToJson(value)
+
+
+def _log_entry_key(entry):
+    """Obtains a key that is the same for log entries that differ only in
+    when they occurred, and in their latency."""
+    labels = None
+    if entry.labels is not None:
+        labels = tuple((p.key, p.value) for p in entry.labels.additionalProperties)
+    payload = None
+    if entry.structPayload is not None:
+        payload = tuple((p.key, _json_value_key(p.value))
+                        for p in entry.structPayload.additionalProperties
+                        if p.key not in _VARYING_LOG_FIELDS)
+    elif entry.protoPayload is not None:
+        payload = encoding.MessageToJson(entry.protoPayload)
+    return (entry.name, entry.severity, entry.textPayload, labels, payload)
+
+
+def _with_count(entry, count):
+    entry = encoding.CopyProtoMessage(entry)
+    if entry.labels is None:
+        entry.labels = sc_messages.LogEntry.LabelsValue()
+    entry.labels.additionalProperties.append(
+        sc_messages.LogEntry.LabelsValue.AdditionalProperty(
+            key=LOG_ENTRY_COUNT_LABEL, value=u'%d' % (count,)))
+    return entry
+
+
+# Operation fields whose aggregated values are held separately from the
+# header fields by CompactAggregator
+_AGGREGATED_FIELDS = frozenset(
+    [u'startTime', u'endTime', u'logEntries', u'metricValueSets'])
+
+_LABELS_FIELDS = {
+    u'labels': sc_messages.Operation.LabelsValue,
+    u'userLabels': sc_messages.Operation.UserLabelsValue,
+}
+
+_MAX_INTERNED_LABELS = 10000
+_interned_labels = {}
+
+
+def _intern_labels(labels):
+    """Obtains a shared tuple of the (key, value) pairs of a labels message."""
+    pairs = tuple((sys.intern(p.key), sys.intern(p.value))
+                  for p in labels.additionalProperties)
+    interned = _interned_labels.get(pairs)
+    if interned is None:
+        if len(_interned_labels) >= _MAX_INTERNED_LABELS:
+            _interned_labels.clear()
+        interned = _interned_labels.setdefault(pairs, pairs)
+    return interned
+
+
+def _to_labels_message(message_cls, pairs):
+    return message_cls(additionalProperties=[
+        message_cls.AdditionalProperty(key=k, value=v) for k, v in pairs])
+
+
+class CompactAggregator(object):
+    """Aggregates operations like :class:`Aggregator`, using less memory.
+
+    The fields of the initial operation are held as a tuple, labels as shared
+    tuples of pairs, and each metric value as a :class:`_CompactMetricValue`.
+    They are only made into protorpc messages by :meth:`as_operation`.
+
+    Thread compatible.
+    """
+    __slots__ = (u'_kinds', u'_header', u'_start_time', u'_end_time',
+                 u'_log_entries', u'_metric_values', u'_log_limits',
+                 u'_log_counts', u'_logs_seen', u'_dropped_log_entries')
+
+    DEFAULT_KIND = Aggregator.DEFAULT_KIND
+
+    def __init__(self, initial_op, kinds=None, log_limits=None):
+        """Constructor.
+
+        Args:
+           initial_op (
+             :class:`endpoints_management.gen.servicecontrol_v1_messages.Operation`): the
+               initial version of the operation
+           kinds (dict[string,[string]]): specifies the metric kind for
+              each metric name
+           log_limits (:class:`LogEntryLimits`): limits the log entries that
+              are kept; if ``None``, all of them are kept
+
+        """
+        assert isinstance(initial_op, sc_messages.Operation)
+        self._kinds = {} if kinds is None else kinds
+        header = []
+        for field in initial_op.all_fields():
+            name = field.name
+            if name in _AGGREGATED_FIELDS:
+                continue
+            value = initial_op.get_assigned_value(name)
+            if value is None or (field.repeated and not value):
+                continue
+            if name in _LABELS_FIELDS:
+                value = _intern_labels(value)
+            elif field.repeated:
+                value = tuple(value)
+            header.append((name, value))
+        self._header = tuple(header)
+        self._start_time = initial_op.startTime
+        self._end_time = initial_op.endTime
+        self._log_entries = []
+        self._log_limits = log_limits
+        # log entry key => count, when they are deduplicated
+        self._log_counts = {} if log_limits and log_limits.dedupe else None
+        self._logs_seen = 0
+        self._dropped_log_entries = 0
+        self._add_log_entries(initial_op.logEntries)
+        # (metric name, labels, currency code) => _CompactMetricValue
+        self._metric_values = {}
+        self._merge_metric_values(initial_op)
+
+    def as_operation(self):
+        """Obtains a single `Operation` representing this instances contents.
+
+        Returns:
+           :class:`endpoints_management.gen.servicecontrol_v1_messages.Operation`
+        """
+        fields = {}
+        for name, value in self._header:
+            if name in _LABELS_FIELDS:
+                value = _to_labels_message(_LABELS_FIELDS[name], value)
+            elif isinstance(value, tuple):
+                value = list(value)
+            elif isinstance(value, messages.Message):
+                value = encoding.CopyProtoMessage(value)
+            fields[name] = value
+        result = sc_messages.Operation(**fields)
+        result.startTime = self._start_time
+        result.endTime = self._end_time
+        if self._log_counts:
+            counts = self._log_counts
+            for entry in self._log_entries:
+                count = counts[_log_entry_key(entry)]
+                result.logEntries.append(
+                    entry if count == 1 else _with_count(entry, count))
+        else:
+            result.logEntries = list(self._log_entries)
+        values_by_name = collections.defaultdict(list)
+        for key, value in self._metric_values.items():
+            values_by_name[key[0]].append(value.as_metric_value())
+        for name in sorted(values_by_name.keys()):
+            result.metricValueSets.append(
+                sc_messages.MetricValueSet(
+                    metricName=name, metricValues=values_by_name[name]))
+        return result
+
+    def add(self, other_op):
+        """Combines `other_op` with the operation held by this aggregator.
+
+        As with :meth:`Aggregator.add`, it's the callers responsibility to
+        ensure that the operations are consistent.
+
+        Args:
+           other_op (
+             class:`endpoints_management.gen.servicecontrol_v1_messages.Operation`):
+             an operation merge into this one
+
+        """
+        self._add_log_entries(other_op.logEntries)
+        self._merge_timestamps(other_op)
+        self._merge_metric_values(other_op)
+
+    @property
+    def dropped_log_entries(self):
+        """The number of log entries that were not kept."""
+        return self._dropped_log_entries
+
+    def _add_log_entries(self, entries):
+        limits = self._log_limits
+        if limits is None:
+            self._log_entries.extend(entries)
+            return
+        kept = self._log_entries
+        counts = self._log_counts
+        for entry in entries:
+            if limits.sample_rate < 1.0 and random.random() >= limits.sample_rate:
+                self._dropped_log_entries += 1
+                continue
+            key = None
+            if counts is not None:
+                key = _log_entry_key(entry)
+                if key in counts:
+                    counts[key] += 1
+                    continue
+            self._logs_seen += 1
+            if limits.max_entries is None or len(kept) < limits.max_entries:
+                kept.append(entry)
+            else:
+                index = random.randrange(self._logs_seen)
+                if index >= limits.max_entries:
+                    self._dropped_log_entries += 1
+                    continue
+                replaced = kept[index]
+                kept[index] = entry
+                if counts is None:
+                    self._dropped_log_entries += 1
+                else:
+                    self._dropped_log_entries += counts.pop(
+                        _log_entry_key(replaced))
+            if counts is not None:
+                counts[key] = 1
+
+    def _merge_metric_values(self, other_op):
+        metric_values = self._metric_values
+        for value_set in other_op.metricValueSets:
+            name = value_set.metricName
+            kind = self._kinds.get(name, self.DEFAULT_KIND)
+            for mv in value_set.metricValues:
+                labels = None if mv.labels is None else _intern_labels(mv.labels)
+                currency = None
+                if mv.moneyValue is not None:
+                    currency = mv.moneyValue.currencyCode
+                key = (name, labels, currency)
+                prior = metric_values.get(key)
+                if prior is None:
+                    metric_values[key] = _CompactMetricValue(mv, labels)
+                else:
+                    prior.merge(kind, mv)
+
+    def _merge_timestamps(self, other_op):
+        if (other_op.startTime and
+            (self._start_time is None or
+             timestamp.compare(other_op.startTime, self._start_time) == -1)):
+            self._start_time = other_op.startTime
+
+        if (other_op.endTime and
+            (self._end_time is None or timestamp.compare(
+                self._end_time, other_op.endTime) == -1)):
+            self._end_time = other_op.endTime
+
+
+class _CompactMetricValue(object):
+    """Holds an aggregated ``MetricValue`` as python values.
+
+    Numbers are held as python numbers, and distributions as a
+    :class:`_CompactDistribution`.  Other values are held as they are.
+    """
+    __slots__ = (u'labels', u'value_type', u'value', u'start_time',
+                 u'end_time')
+
+    def __init__(self, mv, labels):
+        self.labels = labels
+        self.value_type, value = metric_value._detect_value(mv)  # pylint: disable=protected-access
+        if self.value_type == u'distributionValue':
+            value = _CompactDistribution(value)
+        self.value = value
+        self.start_time = mv.startTime
+        self.end_time = mv.endTime
+
+    def merge(self, kind, latest):
+        """Merges ``latest`` into this value, as ``metric_value.merge`` does.
+
+        As in :class:`Aggregator`, the latest value replaces this one unless
+        ``kind`` is ``DELTA``.
+
+        Raises:
+           ValueError: if the values cannot be merged
+        """
+        latest_type, latest_value = metric_value._detect_value(latest)  # pylint: disable=protected-access
+        if self.value_type != latest_type:
+            _logger.warn(u'Metric values are not compatible: %s, %s',
+                         self.as_metric_value(), latest)
+            raise ValueError(u'Incompatible delta metric values')
+        if latest_type is None:
+            _logger.warn(u'Bad metric values, types not known for : %s, %s',
+                         self.as_metric_value(), latest)
+            raise ValueError(u'Unsupported delta metric types')
+
+        if kind != MetricKind.DELTA:
+            self.__init__(latest, self.labels)
+            return
+
+        if latest_type in (u'int64Value', u'doubleValue'):
+            self.value = self.value + latest_value
+        elif latest_type == u'moneyValue':
+            self.value = money.add(self.value, latest_value, allow_overflow=True)
+        elif latest_type == u'distributionValue':
+            self.value.merge(latest_value)
+        else:
+            _logger.error(u'Unmergeable metric type %s', latest_type)
+            raise ValueError(u'Could not merge unmergeable metric type')
+
+        if not (self.start_time and (
+                latest.startTime is None or
+                timestamp.compare(self.start_time, latest.startTime) == -1)):
+            self.start_time = latest.startTime
+        if not (self.end_time and (
+                latest.endTime is None or
+                timestamp.compare(latest.endTime, self.end_time) == -1)):
+            self.end_time = latest.endTime
+
+    def as_metric_value(self):
+        """Makes a ``MetricValue`` from this instance."""
+        mv = sc_messages.MetricValue(startTime=self.start_time,
+                                     endTime=self.end_time)
+        if self.labels is not None:
+            mv.labels = _to_labels_message(sc_messages.MetricValue.LabelsValue,
+                                           self.labels)
+        value = self.value
+        if self.value_type == u'distributionValue':
+            value = value.as_distribution()
+        elif self.value_type == u'moneyValue':
+            value = encoding.CopyProtoMessage(value)
+        if self.value_type is not None:
+            setattr(mv, self.value_type, value)
+        return mv
+
+
+class _CompactDistribution(object):
+    """Holds the statistics and bucket counts of a ``Distribution``.
+
+    The bucket options message is shared with the ``Distribution`` it was
+    made from, and with those made by :meth:`as_distribution`.
+    """
+    __slots__ = (u'count', u'mean', u'minimum', u'maximum',
+                 u'sum_of_squared_deviation', u'bucket_counts', u'bucket_type',
+                 u'bucket_options')
+
+    def __init__(self, dist):
+        self._set(dist)
+        # pylint: disable=protected-access
+        self.bucket_type, self.bucket_options = (
+            distribution._detect_bucket_option(dist))
+
+    def _set(self, dist):
+        self.count = dist.count
+        self.mean = dist.mean
+        self.minimum = dist.minimum
+        self.maximum = dist.maximum
+        self.sum_of_squared_deviation = dist.sumOfSquaredDeviation
+        self.bucket_counts = array.array('q', dist.bucketCounts)
+
+    def merge(self, latest):
+        """Merges ``latest`` into this instance, as ``distribution.merge`` does.
+
+        Raises:
+          ValueError: if the bucket options or bucket counts do not match
+        """
+        # pylint: disable=protected-access
+        latest_type, latest_options = distribution._detect_bucket_option(latest)
+        if not distribution._bucket_options_nearly_equal(
+                self.bucket_type, self.bucket_options,
+                latest_type, latest_options):
+            _logger.error(u'Bucket options do not match. From %s To: %s',
+                          self.as_distribution(), latest)
+            raise ValueError(u'Bucket options do not match')
+        if len(self.bucket_counts) != len(latest.bucketCounts):
+            _logger.error(u'Bucket count sizes do not match. From %s To: %s',
+                          self.as_distribution(), latest)
+            raise ValueError(u'Bucket count sizes do not match')
+        if self.count <= 0:
+            self._set(latest)
+            return
+
+        # the same arithmetic as distribution.merge(self, latest)
+        old_count = latest.count
+        old_mean = latest.mean
+        count = old_count + self.count
+        mean = (old_count * old_mean + self.count * self.mean) / count
+        self.sum_of_squared_deviation = (
+            latest.sumOfSquaredDeviation + self.sum_of_squared_deviation +
+            old_count * (mean - old_mean) ** 2 +
+            self.count * (mean - self.mean) ** 2)
+        self.count = count
+        self.mean = mean
+        self.maximum = max(self.maximum, latest.maximum)
+        self.minimum = min(self.minimum, latest.minimum)
+        bucket_counts = self.bucket_counts
+        for i, x in enumerate(latest.bucketCounts):
+            bucket_counts[i] += x
+
+    def as_distribution(self):
+        """Makes a ``Distribution`` from this instance."""
+        dist = sc_messages.Distribution(
+            count=self.count,
+            mean=self.mean,
+            minimum=self.minimum,
+            maximum=self.maximum,
+            sumOfSquaredDeviation=self.sum_of_squared_deviation,
+            bucketCounts=list(self.bucket_counts))
+        if self.bucket_type is not None:
+            setattr(dist, self.bucket_type, self.bucket_options)
+        return dist
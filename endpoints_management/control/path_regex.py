@@ -12,15 +12,27 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Implements a utility for parsing path templates."""
+"""Implements a utility for parsing path templates.
 
-# This is ported over from endpoints.api_config_manager.
+:func:`compile_path_pattern` converts a path template to a regex.
+
+:class:`PathRouter` finds the first of many path templates that matches a
+path.  It stores the templates in a segment trie, and only uses regexes for the
+templates that the trie cannot represent.
+
+"""
+
+# compile_path_pattern is ported over from endpoints.api_config_manager.
 
 from __future__ import absolute_import
 
+from builtins import object
 import base64
+import logging
 import re
 
+_logger = logging.getLogger(__name__)
+
 # Internal constants
 _PATH_VARIABLE_PATTERN = r'[a-zA-Z_][a-zA-Z_.\d]*'
 _PATH_VALUE_PATTERN = r'[^/?#\[\]{}]*'
@@ -45,7 +57,8 @@ def _to_safe_path_param_name(matched_parameter):
     Returns:
       A string that's safe to be used as a regex group name.
     """
-    return '_' + base64.b32encode(matched_parameter).rstrip('=')
+    encoded = base64.b32encode(matched_parameter.encode('utf-8'))
+    return '_' + encoded.decode('ascii').rstrip('=')
 
 def compile_path_pattern(pattern):
     r"""Generates a compiled regex pattern for a path pattern.
@@ -85,3 +98,188 @@ def compile_path_pattern(pattern):
     pattern = re.sub('(/|^){(%s)}(?=/|$|:)' % _PATH_VARIABLE_PATTERN,
                      replace_variable, pattern)
     return re.compile(pattern + '/?$')
+
+
+# The segment forms that PathRouter can store in its trie
+_VARIABLE_SEGMENT = re.compile(r'^{(%s)}(:.*)?$' % _PATH_VARIABLE_PATTERN)
+_REGEX_CHARS = frozenset('.^$*+?()[]{}|\\')
+_NOT_IN_VALUES = re.compile(r'[?#\[\]{}]')
+_ONE_SEGMENT = '*'
+_ANY_SEGMENTS = '**'
+
+
+def _is_literal(text):
+    return not _REGEX_CHARS.intersection(text)
+
+
+def _is_value(segment):
+    return _NOT_IN_VALUES.search(segment) is None
+
+
+class _TrieNode(object):
+    """A node in the segment trie used by :class:`PathRouter`."""
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self):
+        self.literals = {}  # child nodes, by literal segment
+        self.variable = None  # child node for a {variable} or *
+        self.verbs = {}  # child nodes, by the verb after a {variable}
+        self.any_segments = None  # (index, value) for a final **
+        self.end = None  # (index, value) for templates that end here
+        self.min_index = None  # the lowest index of templates below here
+
+    def _update_min_index(self, index):
+        if self.min_index is None or index < self.min_index:
+            self.min_index = index
+
+
+def _parse_template(template):
+    """Splits a template into trie segments.
+
+    Returns:
+      list[tuple]: each (kind, text) for the template's segments, or None if
+        the template cannot be stored in the trie
+    """
+    segments = template.split('/')
+    parsed = []
+    names = set()
+    for i, segment in enumerate(segments):
+        if segment == _ANY_SEGMENTS and i == len(segments) - 1:
+            parsed.append((_ANY_SEGMENTS, None))
+            continue
+        if segment == _ONE_SEGMENT:
+            parsed.append((_ONE_SEGMENT, None))
+            continue
+        if _is_literal(segment):
+            parsed.append((None, segment))
+            continue
+        match = _VARIABLE_SEGMENT.match(segment)
+        if not match or match.group(1) in names:
+            return None
+        verb = match.group(2)
+        if verb and not _is_literal(verb):
+            return None
+        names.add(match.group(1))
+        parsed.append((_ONE_SEGMENT, verb))
+    return parsed
+
+
+class PathRouter(object):
+    """Finds the value added with the first path template that matches a path.
+
+    A path matches a template if it matches the regex made from the template by
+    :func:`compile_path_pattern`.  In addition, templates may have ``*``
+    segments, which match any single segment, and a final ``**`` segment, which
+    matches any number of segments.
+
+    Templates made of literals, variables, ``*`` and ``**`` are stored in a
+    segment trie, so the time taken to find a match does not grow with the
+    number of templates.  The others are matched using their regex.
+
+    Thread compatible.
+    """
+
+    def __init__(self):
+        self._root = _TrieNode()
+        self._regexes = []  # (index, regex, value) in order of addition
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, template, value):
+        """Adds a path template.
+
+        Args:
+          template (string): the path template, without a leading '/'
+          value (object): the value to find for paths that match ``template``
+
+        Raises:
+          RegexError: if ``template`` cannot be stored in the trie, and is not a
+            valid regex
+        """
+        index = self._count
+        parsed = _parse_template(template)
+        if parsed is None:
+            regex = compile_path_pattern(template)
+            _logger.debug(u'template %s will be matched as regex %s',
+                          template, regex.pattern)
+            self._regexes.append((index, regex, value))
+        else:
+            self._insert(parsed, (index, value))
+        self._count += 1
+
+    def _insert(self, parsed, entry):
+        node = self._root
+        index = entry[0]
+        node._update_min_index(index)  # pylint: disable=protected-access
+        for kind, text in parsed:
+            if kind == _ANY_SEGMENTS:
+                if node.any_segments is None:
+                    node.any_segments = entry
+                return
+            if kind is None:
+                node = node.literals.setdefault(text, _TrieNode())
+            elif text:
+                node = node.verbs.setdefault(text, _TrieNode())
+            else:
+                if node.variable is None:
+                    node.variable = _TrieNode()
+                node = node.variable
+            node._update_min_index(index)  # pylint: disable=protected-access
+        if node.end is None:
+            node.end = entry
+
+    def lookup(self, path):
+        """Finds the value added with the first template that matches ``path``.
+
+        Args:
+          path (string): the path, without a leading '/'
+
+        Returns:
+          the value, or None if no template matches
+        """
+        segments = path.split('/')
+        found = _find(self._root, segments, 0, None)
+        if len(segments) > 1 and segments[-1] == '':
+            # templates match with or without a trailing '/'
+            found = _find(self._root, segments[:-1], 0, found)
+        for index, regex, value in self._regexes:
+            if found is not None and found[0] < index:
+                break
+            if regex.match(path):
+                return value
+        return found[1] if found is not None else None
+
+
+def _better(found, entry):
+    if entry is not None and (found is None or entry[0] < found[0]):
+        return entry
+    return found
+
+
+def _find(node, segments, i, found):
+    """Finds the lowest index entry below ``node`` that matches ``segments[i:]``.
+
+    ``found`` is the best entry found so far; subtrees that only contain later
+    templates are skipped.
+    """
+    if found is not None and found[0] <= node.min_index:
+        return found
+    if node.any_segments is not None and all(
+            _is_value(s) for s in segments[i:]):
+        found = _better(found, node.any_segments)
+    if i == len(segments):
+        return _better(found, node.end)
+
+    segment = segments[i]
+    child = node.literals.get(segment)
+    if child is not None:
+        found = _find(child, segments, i + 1, found)
+    if node.variable is not None and _is_value(segment):
+        found = _find(node.variable, segments, i + 1, found)
+    if node.verbs:
+        for verb, child in node.verbs.items():
+            if segment.endswith(verb) and _is_value(segment[:-len(verb)]):
+                found = _find(child, segments, i + 1, found)
+    return found
@@ -22,6 +22,10 @@ information regarding an operation, and is a key constituent of
 The :class:`.Aggregator` implements the strategy for aggregating AllocateQuotaRequests
 and caching their responses.
 
+If :class:`~endpoints_management.control.caches.QuotaOptions` has a
+``lease_size``, the :class:`.Aggregator` instead leases blocks of quota from
+the server and allocates quota locally from them; see :class:`.QuotaLease`.
+
 """
 
 from __future__ import absolute_import
@@ -31,13 +35,11 @@ standard_library.install_aliases()
 from builtins import object
 import collections
 import copy
-import hashlib
 import http.client
 import logging
+import uuid
 from datetime import datetime
 
-from apitools.base.py import encoding
-
 from . import (caches, label_descriptor, metric_value, operation, sc_messages,
                signing)
 from .. import USER_AGENT, SERVICE_AGENT
@@ -110,12 +112,14 @@ def convert_response(allocate_quota_response, project_id):
     return error_tuple[0], updated_msg
 
 
-def sign(allocate_quota_request):
+def sign(allocate_quota_request, signer=signing.DEFAULT_SIGNER):
     """Obtains a signature for an operation in a `AllocateQuotaRequest`
 
     Args:
        op (:class:`endpoints_management.gen.servicecontrol_v1_messages.Operation`): an
          operation used in a `AllocateQuotaRequest`
+       signer (:class:`endpoints_management.control.signing.Signer`): computes
+         the signature
 
     Returns:
        string: a secure hash generated from the operation
@@ -126,20 +130,17 @@ def sign(allocate_quota_request):
     if op is None or op.methodName is None or op.consumerId is None:
         logging.error(u'Bad %s: not initialized => not signed', allocate_quota_request)
         raise ValueError(u'allocate_quota request must be initialized with an operation')
-    md5 = hashlib.md5()
-    md5.update(op.methodName.encode('utf-8'))
-    md5.update(b'\x00')
-    md5.update(op.consumerId.encode('utf-8'))
+    parts = [op.methodName.encode('utf-8'), b'\x00', op.consumerId.encode('utf-8')]
     if op.labels:
-        signing.add_dict_to_hash(md5, encoding.MessageToPyValue(op.labels))
+        signer.add_labels(parts, op.labels)
     for value_set in op.quotaMetrics:
-        md5.update(b'\x00')
-        md5.update(value_set.metricName.encode('utf-8'))
+        parts.append(b'\x00')
+        parts.append(value_set.metricName.encode('utf-8'))
         for mv in value_set.metricValues:
-            metric_value.update_hash(md5, mv)
+            signer.add_metric_value(parts, mv)
 
-    md5.update(b'\x00')
-    return md5.digest()
+    parts.append(b'\x00')
+    return signer.digest(parts)
 
 
 _KNOWN_LABELS = label_descriptor.KnownLabels
@@ -163,9 +164,15 @@ class Info(collections.namedtuple(u'Info', _INFO_FIELDS), operation.Info):
         op_info = operation.Info(**kw)
         return super(Info, cls).__new__(cls, client_ip, quota_info, config_id, **op_info._asdict())
 
-    def as_allocate_quota_request(self, timer=datetime.utcnow):
+    def as_allocate_quota_request(self, timer=datetime.utcnow, template=None):
         """Makes a `ServicecontrolServicesAllocateQuotaRequest` from this instance
 
+        Args:
+          timer: a function that determines the current time
+          template (:class:`Template`): holds the parts of the request that
+            are the same for every call to the method.  If it is not given, one
+            is made from this instance's ``quota_info`` and ``config_id``
+
         Returns:
           a ``ServicecontrolServicesAllocateQuotaRequest``
 
@@ -180,13 +187,15 @@ class Info(collections.namedtuple(u'Info', _INFO_FIELDS), operation.Info):
             raise ValueError(u'the operation id must be set')
         if not self.operation_name:
             raise ValueError(u'the operation name must be set')
+        if template is None:
+            template = Template(self.quota_info, self.config_id)
         op = super(Info, self).as_operation(timer=timer)
-        labels = {}
+        labels = []
         if self.client_ip:
-            labels[_KNOWN_LABELS.SCC_CALLER_IP.label_name] = self.client_ip
+            labels.append((_KNOWN_LABELS.SCC_CALLER_IP.label_name, self.client_ip))
 
         if self.referer:
-            labels[_KNOWN_LABELS.SCC_REFERER.label_name] = self.referer
+            labels.append((_KNOWN_LABELS.SCC_REFERER.label_name, self.referer))
 
         qop = sc_messages.QuotaOperation(
             operationId=op.operationId,
@@ -194,24 +203,55 @@ class Info(collections.namedtuple(u'Info', _INFO_FIELDS), operation.Info):
             consumerId=op.consumerId,
             quotaMode=sc_messages.QuotaOperation.QuotaModeValueValuesEnum.BEST_EFFORT,
         )
-        qop.labels = encoding.PyValueToMessage(
+        qop.labels = label_descriptor.labels_message(
             sc_messages.QuotaOperation.LabelsValue, labels)
-
-        quota_info = self.quota_info if self.quota_info else {}
-        qop.quotaMetrics = [
-            sc_messages.MetricValueSet(
-                metricName=name, metricValues=[sc_messages.MetricValue(int64Value=cost)])
-            for name, cost in list(quota_info.items())
-        ]
+        qop.quotaMetrics = template.quota_metrics()
 
         allocate_quota_request = sc_messages.AllocateQuotaRequest(allocateOperation=qop)
-        if self.config_id:
-            allocate_quota_request.serviceConfigId = self.config_id
+        if template.config_id:
+            allocate_quota_request.serviceConfigId = template.config_id
         return sc_messages.ServicecontrolServicesAllocateQuotaRequest(
             serviceName=self.service_name,
             allocateQuotaRequest=allocate_quota_request)
 
 
+class Template(object):
+    """Holds the parts of an ``AllocateQuotaRequest`` that are the same for
+    every call to a method.
+
+    Instances are immutable, and are cached per method by
+    :meth:`endpoints_management.control.service.MethodInfo.request_template`.
+
+    Attributes:
+       config_id (string): the service config id
+       costs (tuple[tuple]): the (metric name, cost) of each quota metric
+
+    """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, quota_info, config_id):
+        """Constructor.
+
+        Args:
+          quota_info (dict[string, int]): the quota info from the method
+          config_id (string): the service config id
+        """
+        self.config_id = config_id
+        self.costs = tuple(quota_info.items()) if quota_info else ()
+
+    def quota_metrics(self):
+        """Makes the ``quotaMetrics`` of a new ``QuotaOperation``.
+
+        Returns:
+          list[``MetricValueSet``]: a new metric value set for each cost
+        """
+        return [
+            sc_messages.MetricValueSet(
+                metricName=name, metricValues=[sc_messages.MetricValue(int64Value=cost)])
+            for name, cost in self.costs
+        ]
+
+
 class Aggregator(object):
     """Caches and aggregates ``AllocateQuotaRequests``.
 
@@ -220,7 +260,7 @@ class Aggregator(object):
     """
 
     def __init__(self, service_name, options, kinds=None,
-                 timer=datetime.utcnow):
+                 timer=datetime.utcnow, clock=None):
         """Constructor.
 
         Args:
@@ -232,18 +272,32 @@ class Aggregator(object):
             kind of metric for each each metric name.
           timer (function([[datetime]]): a function that returns the current
             as a time as a datetime instance
+          clock (function([[int]]): if set, a function that returns the
+            current time in nanoseconds, e.g
+            :func:`endpoints_management.control.caches.monotonic_nanos`.  It
+            is used instead of ``timer`` to determine the age of cached items
         """
         self._service_name = service_name
         self._options = options
-        self._cache = caches.create(options, timer=timer, use_deque=False)
-        # When using the result of `with self._out as out`, you must disable no-member
-        # in pyflakes. Known issue with no fix ETA:
-        # https://github.com/PyCQA/astroid/issues/347
-        # https://github.com/PyCQA/pylint/issues/1437
-        self._out = caches.LockedObject(collections.deque())
+        self._cache = caches.create(options, timer=timer, use_deque=False,
+                                    clock=clock)
+        self._signer = signing.create(options)
+        # deque's append, appendleft and popleft are atomic, so requests are
+        # queued while only the lock of their cache shard is held
+        self._out = collections.deque()
         self._kinds = {} if kinds is None else dict(kinds)
-        self._timer = timer
+        self._timer = timer if clock is None else clock
+        if options is not None:
+            # in the units of the differences of the values from self._timer
+            self._flush_interval = caches.to_clock_interval(
+                options.flush_interval, clock)
+            self._expiration = caches.to_clock_interval(
+                options.expiration, clock)
         self._in_flush_all = False
+        self._lease_size = getattr(options, u'lease_size', None)
+        if self._lease_size is not None:
+            self._lease_low_water = int(
+                self._lease_size * options.lease_refill_threshold)
 
     @property
     def service_name(self):
@@ -269,34 +323,42 @@ class Aggregator(object):
 
         Returns:
           list['ServicecontrolServicesAllocateQuotaRequest']: corresponding
-          to AllocateQuotaRequests that were pending
+          to AllocateQuotaRequests that were pending.  The refreshes of
+          negative responses come first
 
         """
         if self._cache is None:
             return []
-        with self._cache as c, self._out as out:
-            c.expire()
-            now = self._timer()
-            for item in list(c.values()):
-                if (not self._in_flush_all) and (not self._should_expire(item)):
-                    if (not item.is_in_flight) and item._op_aggregator is not None:
-                        item.is_in_flight = True
-                        item.last_refresh_timestamp = now
-                        out.append(item.extract_request())  # pylint: disable=no-member
-            flushed_items = list(out)
-            out.clear()  # pylint: disable=no-member
-            for req in flushed_items:
-                assert isinstance(req, sc_messages.ServicecontrolServicesAllocateQuotaRequest)
-            return flushed_items
+        if self._lease_size is None:  # leases are refilled by allocate_quota
+            for shard in caches.shards_of(self._cache):
+                with shard as c:
+                    c.expire()
+                    now = self._timer()
+                    for item in list(c.values()):
+                        if (not self._in_flush_all) and (not self._should_expire(item)):
+                            if (not item.is_in_flight) and item._op_aggregator is not None:
+                                item.is_in_flight = True
+                                item.last_refresh_timestamp = now
+                                self._out.append(item.extract_request())
+        flushed_items = []
+        while self._out:
+            try:
+                flushed_items.append(self._out.popleft())
+            except IndexError:  # emptied by clear()
+                break
+        for req in flushed_items:
+            assert isinstance(req, sc_messages.ServicecontrolServicesAllocateQuotaRequest)
+        return flushed_items
 
     def clear(self):
         """Clears this instance's cache."""
         if self._cache is not None:
-            with self._cache as c, self._out as out:
-                self.in_flush_all = True
-                c.clear()
-                out.clear()  # pylint: disable=no-member
-                self.in_flush_all = False
+            for shard in caches.shards_of(self._cache):
+                with shard as c:
+                    self.in_flush_all = True
+                    c.clear()
+                    self._out.clear()
+                    self.in_flush_all = False
 
     def add_response(self, req, resp):
         """Adds the response from sending to `req` to this instance's cache.
@@ -307,8 +369,11 @@ class Aggregator(object):
         """
         if self._cache is None:
             return
-        signature = sign(req.allocateQuotaRequest)
-        with self._cache as c:
+        if self._lease_size is not None:
+            self._add_lease_response(req, resp)
+            return
+        signature = sign(req.allocateQuotaRequest, self._signer)
+        with caches.shard_for(self._cache, signature) as c:
             now = self._timer()
             item = c.get(signature)
             if item is None:
@@ -321,6 +386,29 @@ class Aggregator(object):
                 item.is_in_flight = False
                 c[signature] = item
 
+    def add_unsent(self, req):
+        """Records that a request returned by :meth:`flush` was not sent.
+
+        Its signature may then be refreshed again, and the quota it
+        allocates is included in the next refresh.
+
+        Args:
+          req (`ServicecontrolServicesAllocateQuotaRequest`): the request
+        """
+        if self._cache is None:
+            return
+        if self._lease_size is not None:
+            self._add_unsent_lease_refill(req)
+            return
+        signature = sign(req.allocateQuotaRequest, self._signer)
+        with caches.shard_for(self._cache, signature) as c:
+            item = c.get(signature)
+            if item is None:
+                return
+            item.is_in_flight = False
+            if item.is_positive_response():
+                item.aggregate(req.allocateQuotaRequest)
+
     def allocate_quota(self, req):
         if self._cache is None:
             return None  # no cache, send request now
@@ -338,9 +426,11 @@ class Aggregator(object):
         if op is None:
             _logger.error(u'bad allocate_quota(): no operation in %s', req)
             raise ValueError(u'Expected operation not set')
+        if self._lease_size is not None:
+            return self._allocate_leased_quota(req, op)
 
-        signature = sign(allocate_quota_request)
-        with self._cache as cache, self._out as out:
+        signature = sign(allocate_quota_request, self._signer)
+        with caches.shard_for(self._cache, signature) as cache:
             now = self._timer()
             _logger.debug(u'checking the cache for %r\n%s', signature, cache)
             item = cache.get(signature)
@@ -356,7 +446,7 @@ class Aggregator(object):
                 item.signature = signature
                 item.is_in_flight = True
                 cache[signature] = item
-                out.append(req)  # pylint: disable=no-member
+                self._out.append(req)
                 return temp_response  # positive response
             if not item.is_in_flight and self._should_refresh(item):
                 item.is_in_flight = True
@@ -367,18 +457,85 @@ class Aggregator(object):
                     # if the cached response is negative, then use NORMAL QuotaMode instead of BEST_EFFORT
                     normal = sc_messages.QuotaOperation.QuotaModeValueValuesEnum.NORMAL
                     refresh_request.allocateQuotaRequest.allocateOperation.quotaMode = normal
-                out.append(refresh_request)  # pylint: disable=no-member
+                    # flush these first, so blocked consumers are unblocked quickly
+                    self._out.appendleft(refresh_request)
+                else:
+                    self._out.append(refresh_request)
             if item.is_positive_response():
                 item.aggregate(allocate_quota_request)
             return item.response
 
     def _should_refresh(self, item):
         age = self._timer() - item.last_check_time
-        return age >= self._options.flush_interval
+        return age >= self._flush_interval
+
+    def _allocate_leased_quota(self, req, op):
+        costs = [(mv_set.metricName, _int_cost(mv_set))
+                 for mv_set in op.quotaMetrics]
+        key = op.consumerId
+        with caches.shard_for(self._cache, key) as cache:
+            now = self._timer()
+            lease = cache.get(key)
+            if lease is None:
+                lease = QuotaLease(now)
+                cache[key] = lease
+            for metric_name, cost in costs:
+                if self._should_refill(lease, metric_name, cost, now):
+                    lease.refill_times[metric_name] = now
+                    self._out.append(self._make_refill_request(
+                        req, metric_name, max(cost, self._lease_size)))
+            return lease.allocate(op.operationId, costs)
+
+    def _should_refill(self, lease, metric_name, cost, now):
+        refill_time = lease.refill_times.get(metric_name)
+        if refill_time is not None and now - refill_time < self._expiration:
+            return False  # a refill is in flight, and has not been lost
+        if lease.response is not None:
+            return now - lease.last_check_time >= self._flush_interval
+        if metric_name not in lease.remaining:
+            return True
+        return lease.remaining[metric_name] - cost < self._lease_low_water
+
+    def _make_refill_request(self, req, metric_name, units):
+        op = req.allocateQuotaRequest.allocateOperation
+        qop = sc_messages.QuotaOperation(
+            operationId=uuid.uuid4().hex,
+            methodName=op.methodName,
+            consumerId=op.consumerId,
+            labels=op.labels,
+            quotaMode=sc_messages.QuotaOperation.QuotaModeValueValuesEnum.BEST_EFFORT,
+            quotaMetrics=[sc_messages.MetricValueSet(
+                metricName=metric_name,
+                metricValues=[sc_messages.MetricValue(int64Value=units)])])
+        allocate_quota_request = sc_messages.AllocateQuotaRequest(
+            allocateOperation=qop,
+            serviceConfigId=req.allocateQuotaRequest.serviceConfigId)
+        return sc_messages.ServicecontrolServicesAllocateQuotaRequest(
+            serviceName=self.service_name,
+            allocateQuotaRequest=allocate_quota_request)
+
+    def _add_unsent_lease_refill(self, req):
+        op = req.allocateQuotaRequest.allocateOperation
+        with caches.shard_for(self._cache, op.consumerId) as c:
+            lease = c.get(op.consumerId)
+            if lease is None:
+                return
+            for mv_set in op.quotaMetrics:
+                lease.refill_times.pop(mv_set.metricName, None)
+
+    def _add_lease_response(self, req, resp):
+        op = req.allocateQuotaRequest.allocateOperation
+        key = op.consumerId
+        with caches.shard_for(self._cache, key) as c:
+            lease = c.get(key)
+            if lease is None:
+                return  # the lease expired while the refill was in flight
+            lease.add_response(op, resp, self._timer())
+            c[key] = lease
 
     def _should_expire(self, item):
         age = self._timer() - item.last_check_time
-        return age >= self._options.expiration
+        return age >= self._expiration
 
 
 class CachedItem(object):
@@ -392,7 +549,8 @@ class CachedItem(object):
          is stale, and needs to be flushed
        quota_scale (int): WIP, used to determine quota
        last_check_time (datetime.datetime): the last time this instance
-         was checked
+         was checked, or the clock's time in nanoseconds if the aggregator
+         has a clock
 
     """
 
@@ -429,30 +587,165 @@ class CachedItem(object):
         return len(self.response.allocateErrors) == 0
 
 
+class QuotaLease(object):
+    """QuotaLease holds the quota leased for a consumer.
+
+    The units of each metric are leased from the server in blocks, using
+    ``BEST_EFFORT`` allocations, and are counted down locally as quota is
+    allocated.  Before a lease runs out, the :class:`Aggregator` requests
+    another block; if it runs out anyway, allocations fail with
+    ``RESOURCE_EXHAUSTED`` until a block is added.  Until the first block of a
+    metric is added, allocations succeed and their units are deducted from
+    the block once it arrives, so that new consumers are not delayed.
+
+    The amount allocated for each metric is taken from the ``quotaMetrics``
+    of the server's response, if it has any for the metric, and otherwise is
+    the whole block.  Errors that fail open also allocate the whole block;
+    other errors are returned for every allocation until the lease is
+    refreshed.
+
+    Thread compatible; the :class:`Aggregator` holds the lock of its cache
+    while using it.
+
+    Attributes:
+       remaining (dict[string, int]): the units remaining for each metric
+       refill_times (dict[string, object]): when the refill of each metric
+         that is in flight was requested
+       response (``AllocateQuotaResponse``): the last response, if it had an
+         error that does not fail open
+       last_check_time (datetime.datetime): the last time a response was
+         added, or the clock's time in nanoseconds if the aggregator has a
+         clock
+
+    """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, last_check_time):
+        self.remaining = {}
+        self.refill_times = {}
+        self.response = None
+        self.last_check_time = last_check_time
+        self._owed = {}
+
+    def allocate(self, operation_id, costs):
+        """Allocates quota from this lease.
+
+        Args:
+          operation_id (string): the id of the allocating operation
+          costs (list[tuple]): the (metric name, cost) of each quota metric
+
+        Returns:
+          ``AllocateQuotaResponse``: the response to the allocation
+        """
+        if self.response is not None:
+            return self.response
+        for metric_name, cost in costs:
+            remaining = self.remaining.get(metric_name)
+            if remaining is not None and remaining < cost:
+                return sc_messages.AllocateQuotaResponse(
+                    operationId=operation_id,
+                    allocateErrors=[sc_messages.QuotaError(
+                        code=_QuotaErrors.RESOURCE_EXHAUSTED,
+                        subject=metric_name,
+                        description=u'the leased quota is exhausted')])
+        for metric_name, cost in costs:
+            if metric_name in self.remaining:
+                self.remaining[metric_name] -= cost
+            else:
+                self._owed[metric_name] = self._owed.get(metric_name, 0) + cost
+        return sc_messages.AllocateQuotaResponse(operationId=operation_id)
+
+    def add_response(self, op, resp, now):
+        """Adds the blocks allocated by the response to a refill request.
+
+        Args:
+          op (``QuotaOperation``): the operation of the refill request
+          resp (``AllocateQuotaResponse``): the server's response
+          now: the current time
+        """
+        self.last_check_time = now
+        code, _ = convert_response(resp, u'')
+        is_exhausted = (resp.allocateErrors and resp.allocateErrors[0].code ==
+                        _QuotaErrors.RESOURCE_EXHAUSTED)
+        self.response = None if code == http.client.OK or is_exhausted else resp
+        granted_by_name = {}
+        for mv_set in resp.quotaMetrics:
+            granted_by_name[mv_set.metricName] = _int_cost(mv_set)
+        for mv_set in op.quotaMetrics:
+            metric_name = mv_set.metricName
+            self.refill_times.pop(metric_name, None)
+            granted = 0
+            if code == http.client.OK:
+                granted = granted_by_name.get(metric_name, _int_cost(mv_set))
+            self.remaining[metric_name] = (
+                self.remaining.get(metric_name, 0) + granted -
+                self._owed.pop(metric_name, 0))
+
+
+def _int_cost(mv_set):
+    return sum(mv.int64Value or 0 for mv in mv_set.metricValues)
+
+
 class QuotaOperationAggregator(object):
+    """Sums the quota metrics of operations with the same signature.
+
+    Quota metric values are almost always plain ``int64Value`` costs, so they
+    are summed as ints, and only other values are merged using
+    :func:`endpoints_management.control.metric_value.merge`, using copies
+    of them.  The
+    ``QuotaOperation`` is made once, by :meth:`as_quota_operation`, sharing
+    the fields of the first operation other than its quota metrics; they
+    are never modified.
+
+    """
+
     def __init__(self, op):
-        # The protorpc version used here lacks MergeFrom
-        self.op = copy.deepcopy(op)
-        self.op.quotaMetrics = []
-        self.metric_value_sets = {}
+        assert isinstance(op, sc_messages.QuotaOperation)
+        self.op = op
+        self._values = {}  # int sums, or merged ``MetricValues``, by name
         self.merge_operation(op)
 
     def merge_operation(self, op):
         assert isinstance(op, sc_messages.QuotaOperation)
+        values = self._values
         for mv_set in op.quotaMetrics:
             metric_name = mv_set.metricName
-            if metric_name not in self.metric_value_sets:
-                self.metric_value_sets[metric_name] = mv_set.metricValues[0]
-            else:
-                self.metric_value_sets[metric_name] = metric_value.merge(
-                    metric_value.MetricKind.DELTA,
-                    self.metric_value_sets[metric_name],
-                    mv_set.metricValues[0]
-                )
+            mv = mv_set.metricValues[0]
+            current = values.get(metric_name)
+            if _is_plain_int(mv):
+                if current is None:
+                    values[metric_name] = mv.int64Value
+                    continue
+                if not isinstance(current, sc_messages.MetricValue):
+                    values[metric_name] = current + mv.int64Value
+                    continue
+            if current is None:
+                values[metric_name] = copy.deepcopy(mv)
+                continue
+            if not isinstance(current, sc_messages.MetricValue):
+                current = sc_messages.MetricValue(int64Value=current)
+            # merge updates and returns its latest value, so it is given a
+            # copy of the caller's
+            values[metric_name] = metric_value.merge(
+                metric_value.MetricKind.DELTA, current, copy.deepcopy(mv))
 
     def as_quota_operation(self):
-        op = copy.deepcopy(self.op)
-        for m_name, m_value in list(self.metric_value_sets.items()):
-            op.quotaMetrics.append(sc_messages.MetricValueSet(
+        template = self.op
+        quota_metrics = []
+        for m_name, m_value in self._values.items():
+            if not isinstance(m_value, sc_messages.MetricValue):
+                m_value = sc_messages.MetricValue(int64Value=m_value)
+            quota_metrics.append(sc_messages.MetricValueSet(
                 metricName=m_name, metricValues=[m_value]))
-        return op
+        return sc_messages.QuotaOperation(
+            consumerId=template.consumerId,
+            labels=template.labels,
+            methodName=template.methodName,
+            operationId=template.operationId,
+            quotaMetrics=quota_metrics,
+            quotaMode=template.quotaMode)
+
+
+def _is_plain_int(mv):
+    return (mv.int64Value is not None and mv.labels is None and
+            mv.startTime is None and mv.endTime is None)
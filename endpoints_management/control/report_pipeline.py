@@ -0,0 +1,264 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""report_pipeline moves the making of report requests off request threads.
+
+:class:`Pipeline` holds a bounded queue of the :class:`report_request.Info`
+describing each request, along with the rules that govern how it is reported.
+Adding to the queue only holds a lock while the value is appended.  A worker
+thread takes the queued
+values in batches, makes a ``ReportRequest`` from each, and passes them to a
+report function, usually :meth:`endpoints_management.control.client.Client.report`,
+which signs and aggregates them.
+
+Example:
+
+  >>> from endpoints_management.control import client, report_pipeline, wsgi
+  >>> control_client = client.Loaders.DEFAULT.load(service_name)
+  >>> pipeline = report_pipeline.Pipeline(control_client.report)
+  >>> wrapped_app = wsgi.add_all(application, project_id, control_client,
+  ...                            report_pipeline=pipeline)
+
+Overflow
+
+When the worker falls behind, what is dropped is determined by the overflow
+policy:
+
+- :data:`DROP_LOGS_THEN_OPERATIONS`, the default: once the queue is half full,
+  values are queued without their log entries; once it is full, values are
+  dropped
+- :data:`DROP_OPERATIONS`: values are dropped once the queue is full
+
+The number of values dropped in each way is counted.
+
+"""
+
+from __future__ import absolute_import
+
+from builtins import object
+from builtins import range
+import collections
+import logging
+import threading
+from datetime import datetime
+
+from . import client, report_request
+
+
+_logger = logging.getLogger(__name__)
+
+
+DROP_LOGS_THEN_OPERATIONS = u'drop_logs_then_operations'
+DROP_OPERATIONS = u'drop_operations'
+OVERFLOW_POLICIES = (DROP_LOGS_THEN_OPERATIONS, DROP_OPERATIONS)
+
+
+class Pipeline(object):
+    """Pipeline makes and reports ``ReportRequests`` from a worker thread.
+
+    The queue is a ``collections.deque``.  Its bound is checked and values are
+    appended under a lock, while the worker pops values without one, as
+    ``popleft`` is atomic.
+
+    The worker thread is a daemon, so :meth:`stop` should be called to report
+    any queued values before exiting.  Once it is stopped, values passed to
+    :meth:`put` are dropped until :meth:`start` is called again.  If the worker thread cannot be started,
+    e.g on appengine without background threads, the queue is drained by
+    :meth:`put`.
+
+    Thread safe.
+
+    """
+    # pylint: disable=too-many-instance-attributes
+    DEFAULT_MAX_QUEUED = 10000
+    DEFAULT_BATCH_SIZE = 100
+
+    def __init__(self,
+                 report_func,
+                 max_queued=DEFAULT_MAX_QUEUED,
+                 overflow_policy=DROP_LOGS_THEN_OPERATIONS,
+                 batch_size=DEFAULT_BATCH_SIZE,
+                 timer=datetime.utcnow):
+        """Constructor.
+
+        Args:
+          report_func (func[[``ServicecontrolServicesReportRequest``]]):
+            called with each report request, usually the ``report`` method of
+            a :class:`endpoints_management.control.client.Client`
+          max_queued (int): the maximum number of values that may be queued
+          overflow_policy (string): determines what is dropped when the queue
+            is full, one of :data:`OVERFLOW_POLICIES`
+          batch_size (int): the number of values the worker takes from the
+            queue at a time
+          timer (func[[datetime.datetime]]): used to obtain the current time;
+            it is called when a value is queued, so that the reported times
+            do not include the time spent on the queue
+        """
+        assert isinstance(max_queued, int), u'should be an int'
+        assert max_queued > 0, u'should be positive'
+        assert overflow_policy in OVERFLOW_POLICIES, u'should be known'
+        assert isinstance(batch_size, int), u'should be an int'
+        assert batch_size > 0, u'should be positive'
+        self._report_func = report_func
+        self._max_queued = max_queued
+        if overflow_policy == DROP_LOGS_THEN_OPERATIONS:
+            self._max_queued_with_logs = max_queued // 2
+        else:
+            self._max_queued_with_logs = max_queued
+        self._batch_size = batch_size
+        self._timer = timer
+        self._queue = collections.deque()
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._running = False
+        self._stopped = False
+        self._dropped_logs = 0
+        self._dropped_operations = 0
+
+    @property
+    def dropped_logs(self):
+        """The number of values that were reported without their logs."""
+        return self._dropped_logs
+
+    @property
+    def dropped_operations(self):
+        """The number of values that were dropped."""
+        return self._dropped_operations
+
+    def __len__(self):
+        return len(self._queue)
+
+    def put(self, info, rules, template=None):
+        """Queues a value to be reported.
+
+        Args:
+          info (:class:`endpoints_management.control.report_request.Info`):
+            describes the request to be reported
+          rules (:class:`endpoints_management.control.report_request.ReportingRules`):
+            determines what labels, metrics and logs to report
+          template (:class:`endpoints_management.control.report_request.Template`):
+            the template for the reported method, if any
+
+        Returns:
+          bool: ``True`` if the value was queued, ``False`` if it was dropped
+            because the queue is full or this instance is stopped
+        """
+        when = self._timer()
+        with self._lock:
+            queued = len(self._queue)
+            if self._stopped or queued >= self._max_queued:
+                self._dropped_operations += 1
+                return False
+            with_logs = queued < self._max_queued_with_logs
+            if not with_logs:
+                self._dropped_logs += 1
+            self._queue.append((info, rules, template, with_logs, when))
+
+        self._start_worker()
+        if self._thread is None:
+            self.drain()
+        elif not self._wakeup.is_set():
+            self._wakeup.set()
+        return True
+
+    def start(self):
+        """Starts the worker thread, if it is not already running."""
+        with self._lock:
+            self._stopped = False
+        self._start_worker()
+
+    def _start_worker(self):
+        if self._running:
+            return
+        with self._lock:
+            if self._running or self._stopped:
+                return
+            self._running = True
+            self._thread = client.create_thread(target=self._work)
+            try:
+                # queued values are reported by stop(); don't block exit
+                self._thread.daemon = True
+                self._thread.start()
+            except Exception:  # pylint: disable=broad-except
+                _logger.warn(
+                    u'no report pipeline thread, reports will be made by put(...)',
+                    exc_info=True)
+                self._thread = None
+
+    def stop(self):
+        """Stops the worker thread, then reports any queued values."""
+        with self._lock:
+            thread = self._thread
+            self._stopped = True
+            self._running = False
+            self._thread = None
+        if thread is not None:
+            self._wakeup.set()
+            thread.join()
+        self.drain()
+
+    def drain(self):
+        """Reports the queued values from the calling thread.
+
+        Returns:
+          int: the number of values that were taken from the queue
+        """
+        total = 0
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                return total
+            total += len(batch)
+            for req in self._make_requests(batch):
+                try:
+                    self._report_func(req)
+                except Exception:  # pylint: disable=broad-except
+                    _logger.error(u'failed to report %s', req, exc_info=True)
+
+    def _work(self):
+        # the method expects to be run in the thread created in start()
+        while not self._stopped:
+            self._wakeup.wait()
+            # clear before draining, so values queued while draining are not
+            # missed
+            self._wakeup.clear()
+            self.drain()
+        _logger.debug(u'report pipeline stopped, %s will exit',
+                      threading.current_thread())
+
+    def _take_batch(self):
+        queue = self._queue
+        batch = []
+        try:
+            for _ in range(self._batch_size):
+                batch.append(queue.popleft())
+        except IndexError:
+            pass
+        return batch
+
+    def _make_requests(self, batch):
+        reqs = []
+        for info, rules, template, with_logs, when in batch:
+            if template is None:
+                template = report_request.Template(rules, info.platform)
+            if not with_logs:
+                template = template.without_logs()
+            try:
+                reqs.append(info.as_report_request(
+                    rules, timer=lambda when=when: when, template=template))
+            except ValueError:
+                _logger.error(u'could not make a report request from %s', info,
+                              exc_info=True)
+        return reqs
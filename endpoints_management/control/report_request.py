@@ -25,14 +25,18 @@ from __future__ import absolute_import
 from builtins import range
 from builtins import object
 import collections
+import copy
 import functools
-import hashlib
 import logging
+import re
+import threading
 import time
 from datetime import datetime, timedelta
 
-from apitools.base.py import encoding
+from apitools.base.protorpclite import messages
+from apitools.base.py import encoding, extra_types
 from enum import Enum
+from past.builtins import unicode
 from . import caches, label_descriptor, operation, sc_messages
 from . import metric_descriptor, signing, timestamp
 from .. import USER_AGENT, SERVICE_AGENT
@@ -343,13 +347,16 @@ class Info(
             severity=severity,
             structPayload=_struct_payload_from(d))
 
-    def as_report_request(self, rules, timer=datetime.utcnow):
+    def as_report_request(self, rules, timer=datetime.utcnow, template=None):
         """Makes a `ServicecontrolServicesReportRequest` from this instance
 
         Args:
           rules (:class:`ReportingRules`): determines what labels, metrics and
             logs to include in the report request.
           timer: a function that determines the current time
+          template (:class:`Template`): holds the parts of the request that
+            are the same for every call to the method.  If it is not given, one
+            is made from ``rules`` and this instance's ``platform``
 
         Return:
           a ``ServicecontrolServicesReportRequest`` generated from this instance
@@ -362,39 +369,90 @@ class Info(
         """
         if not self.service_name:
             raise ValueError(u'the service name must be set')
+        if template is None:
+            template = Template(rules, self.platform)
         op = super(Info, self).as_operation(timer=timer)
 
         # Populate metrics and labels if they can be associated with a
         # method/operation
         if op.operationId and op.operationName:
             labels = {}
-            for known_label in rules.labels:
-                known_label.do_labels_update(self, labels)
-
-            # Forcibly add system label reporting here, as the base service
-            # config does not specify it as a label.
-            labels[_KNOWN_LABELS.SCC_PLATFORM.label_name] = (
-                self.platform.friendly_string())
-            labels[_KNOWN_LABELS.SCC_SERVICE_AGENT.label_name] = (
-                SERVICE_AGENT)
-            labels[_KNOWN_LABELS.SCC_USER_AGENT.label_name] = USER_AGENT
-
-            if labels:
-                op.labels = encoding.PyValueToMessage(
-                    sc_messages.Operation.LabelsValue,
-                    labels)
-            for known_metric in rules.metrics:
-                known_metric.do_operation_update(self, op)
+            for set_label in template.label_setters:
+                set_label(self, labels)
+            labels.update(template.system_labels)
+            op.labels = label_descriptor.labels_message(
+                sc_messages.Operation.LabelsValue, labels)
+            for set_metric in template.metric_setters:
+                set_metric(self, op)
 
         # Populate the log entries
         now = timer()
-        op.logEntries = [self._as_log_entry(l, now) for l in rules.logs]
+        op.logEntries = [self._as_log_entry(l, now) for l in template.logs]
 
         return sc_messages.ServicecontrolServicesReportRequest(
             serviceName=self.service_name,
             reportRequest=sc_messages.ReportRequest(operations=[op]))
 
 
+class Template(object):
+    """Holds the parts of a ``ReportRequest`` that are the same for every call
+    to a method.
+
+    Instances are immutable, and are cached per method by
+    :meth:`endpoints_management.control.service.MethodInfo.request_template`.
+
+    The labels and metrics in the rules are compiled into flat tuples of
+    setters, obtained using their ``bind`` methods.
+
+    Attributes:
+       label_setters (tuple[func]): each updates the labels dict from an
+         :class:`Info`
+       metric_setters (tuple[func]): each adds a metric from an :class:`Info`
+         to an ``Operation``
+       logs (tuple[string]): the name of logs to be included
+       system_labels (tuple[tuple]): the (name, value) of the labels that are
+         added to every operation
+
+    """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, rules, platform):
+        """Constructor.
+
+        Args:
+          rules (:class:`ReportingRules`): determines what labels, metrics and
+            logs to include in the report request.
+          platform (:class:`ReportedPlatforms`): the platform in use
+        """
+        self.label_setters = tuple(
+            l.bind() for l in rules.labels if l.update_label_func)
+        self.metric_setters = tuple(m.bind() for m in rules.metrics)
+        self.logs = tuple(rules.logs)
+        # Forcibly add system label reporting here, as the base service
+        # config does not specify it as a label.
+        self.system_labels = (
+            (_KNOWN_LABELS.SCC_PLATFORM.label_name, platform.friendly_string()),
+            (_KNOWN_LABELS.SCC_SERVICE_AGENT.label_name, SERVICE_AGENT),
+            (_KNOWN_LABELS.SCC_USER_AGENT.label_name, USER_AGENT),
+        )
+        self._without_logs = None
+
+    def without_logs(self):
+        """Obtains a copy of this instance that adds no log entries.
+
+        Returns:
+          :class:`Template`: this instance if it has no logs, otherwise a
+          copy without them
+        """
+        if not self.logs:
+            return self
+        if self._without_logs is None:
+            stripped = copy.copy(self)
+            stripped.logs = tuple()
+            self._without_logs = stripped
+        return self._without_logs
+
+
 _NO_RESULTS = tuple()
 
 
@@ -413,7 +471,7 @@ class Aggregator(object):
     """The maximum number of operations to send in a report request."""
 
     def __init__(self, service_name, options, kinds=None,
-                 timer=datetime.utcnow):
+                 timer=datetime.utcnow, clock=None):
         """
         Constructor
 
@@ -425,12 +483,19 @@ class Aggregator(object):
             type of metrics used during aggregation
           timer (function([[datetime]]): a function that returns the current
             as a time as a datetime instance
+          clock (function([[int]]): if set, a function that returns the
+            current time in nanoseconds, used instead of ``timer`` by the
+            cache
 
         """
-        self._cache = caches.create(options, timer=timer)
+        self._cache = caches.create(options, timer=timer, clock=clock)
+        self._signer = signing.create(options)
         self._options = options
         self._kinds = kinds
         self._service_name = service_name
+        self._log_limits = _create_log_limits(options)
+        self._dropped_log_entries = 0
+        self._dropped_log_entries_lock = threading.Lock()
 
     @property
     def flush_interval(self):
@@ -448,6 +513,15 @@ class Aggregator(object):
         """The service to which all requests being aggregated should belong."""
         return self._service_name
 
+    @property
+    def dropped_log_entries(self):
+        """The number of log entries that were not reported.
+
+        They are limited by the options of this instance, and are counted
+        when the operations they belonged to are flushed or cleared.
+        """
+        return self._dropped_log_entries
+
     def flush(self):
         """Flushes this instance's cache.
 
@@ -461,31 +535,44 @@ class Aggregator(object):
         """
         if self._cache is None:
             return _NO_RESULTS
-        with self._cache as c:
-            flushed_ops = [x.as_operation() for x in c.out_deque]
-            c.out_deque.clear()
-            reqs = []
-            max_ops = self.MAX_OPERATION_COUNT
-            for x in range(0, len(flushed_ops), max_ops):
-                report_request = sc_messages.ReportRequest(
-                    operations=flushed_ops[x:x + max_ops])
-                reqs.append(
-                    sc_messages.ServicecontrolServicesReportRequest(
-                        serviceName=self.service_name,
-                        reportRequest=report_request))
-
-            return reqs
+        # The out_deques are swapped for empty ones while holding the locks,
+        # so that the operations are made without blocking report().  Nothing
+        # else refers to the evicted aggregators, so this is safe.
+        out_deques = []
+        for shard in caches.shards_of(self._cache):
+            with shard as c:
+                out_deques.append(c.swap_out_deque())
+        flushed_aggs = [x for d in out_deques for x in d]
+        flushed_ops = [x.as_operation() for x in flushed_aggs]
+        self._count_dropped_log_entries(flushed_aggs)
+        reqs = []
+        batches = _batch_operations(
+            flushed_ops,
+            self.MAX_OPERATION_COUNT,
+            getattr(self._options, u'max_request_bytes', None))
+        for ops in batches:
+            report_request = sc_messages.ReportRequest(operations=ops)
+            reqs.append(
+                sc_messages.ServicecontrolServicesReportRequest(
+                    serviceName=self.service_name,
+                    reportRequest=report_request))
+
+        return reqs
 
     def clear(self):
         """Clears the cache."""
         if self._cache is None:
             return _NO_RESULTS
         if self._cache is not None:
-            with self._cache as k:
-                res = [x.as_operation() for x in list(k.values())]
-                k.clear()
-                k.out_deque.clear()
-                return res
+            res = []
+            for shard in caches.shards_of(self._cache):
+                with shard as k:
+                    aggs = list(k.values())
+                    res.extend(x.as_operation() for x in aggs)
+                    self._count_dropped_log_entries(aggs)
+                    k.clear()
+                    k.out_deque.clear()
+            return res
 
     def report(self, req):
         """Adds a report request to the cache.
@@ -516,22 +603,180 @@ class Aggregator(object):
         if _has_high_important_operation(report_req) or self._cache is None:
             return None
         ops_by_signature = _key_by_signature(report_req.operations,
-                                             _sign_operation)
+                                             self._sign_operation)
 
         # Concurrency:
         #
-        # This holds a lock on the cache while updating it.  No i/o operations
-        # are performed, so any waiting threads see minimal delays
-        with self._cache as cache:
-            for key, op in list(ops_by_signature.items()):
+        # This holds a lock on the cache shard for each operation while
+        # updating it.  No i/o operations are performed, so any waiting threads
+        # see minimal delays
+        for key, op in list(ops_by_signature.items()):
+            with caches.shard_for(self._cache, key) as cache:
                 agg = cache.get(key)
                 if agg is None:
-                    cache[key] = operation.Aggregator(op, self._kinds)
+                    cache[key] = operation.CompactAggregator(
+                        op, self._kinds, log_limits=self._log_limits)
                 else:
                     agg.add(op)
 
         return self.CACHED_OK
 
+    def _sign_operation(self, op):
+        return _sign_operation(op, self._signer)
+
+    def _count_dropped_log_entries(self, aggs):
+        dropped = sum(x.dropped_log_entries for x in aggs)
+        if dropped:
+            _logger.debug(u'dropped %d log entries', dropped)
+            with self._dropped_log_entries_lock:
+                self._dropped_log_entries += dropped
+
+
+def _create_log_limits(options):
+    max_entries = getattr(options, u'max_log_entries', None)
+    dedupe = getattr(options, u'dedupe_log_entries', False)
+    sample_rate = getattr(options, u'log_sample_rate', 1.0)
+    if max_entries is None and not dedupe and sample_rate >= 1.0:
+        return None
+    return operation.LogEntryLimits(max_entries=max_entries,
+                                    dedupe=dedupe,
+                                    sample_rate=sample_rate)
+
+
+_REQUEST_OVERHEAD_BYTES = 32
+"""Allows for the JSON enclosing the operations of a report request."""
+
+
+def _batch_operations(ops, max_count, max_bytes=None):
+    """Splits operations into the batches sent in each report request.
+
+    Each batch has at most ``max_count`` operations.  If ``max_bytes`` is set,
+    the operations are also packed so that the estimated serialized size of
+    each batch is at most ``max_bytes``.
+
+    Args:
+      ops (list[Operation]): the operations to send
+      max_count (int): the maximum number of operations in a batch
+      max_bytes (int): the maximum estimated size of a batch, or ``None``
+
+    Returns:
+      list[list[Operation]]: the batches
+    """
+    if max_bytes is None:
+        return [ops[x:x + max_count] for x in range(0, len(ops), max_count)]
+    batches = []
+    batch = []
+    batch_size = _REQUEST_OVERHEAD_BYTES
+    for op in ops:
+        op_size = _estimate_size(op) + 2  # allow for the separating comma
+        if batch and (len(batch) >= max_count or
+                      batch_size + op_size > max_bytes):
+            batches.append(batch)
+            batch = []
+            batch_size = _REQUEST_OVERHEAD_BYTES
+        if batch_size + op_size > max_bytes:
+            _logger.warn(u'operation %s is about %d bytes, which exceeds the'
+                         u' report request limit of %d bytes',
+                         op.operationId, op_size, max_bytes)
+        batch.append(op)
+        batch_size += op_size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+_FIELD_SIZES = {}
+
+_MAP_FIELD_NAME = u'additionalProperties'
+"""The field that holds the entries of messages serialized as JSON objects."""
+
+_JSON_VALUE_FIELD_NAMES = (u'boolean_value', u'string_value', u'double_value',
+                           u'integer_value', u'object_value', u'array_value')
+
+_ESCAPED_CHARS = re.compile(r'[\\"]|[^ -~]')
+"""Matches the characters that ``json.dumps`` escapes in ASCII output."""
+
+
+def _field_sizes(message_type):
+    sizes = _FIELD_SIZES.get(message_type)
+    if sizes is None:
+        # allows for the quoted field name, its colon and separating comma,
+        # each followed by a space
+        sizes = tuple((f.name, len(f.name) + 6)
+                      for f in message_type.all_fields())
+        _FIELD_SIZES[message_type] = sizes
+    return sizes
+
+
+def _estimate_size(value):
+    """Estimates the size of a message when it is serialized as JSON.
+
+    This is several times quicker than serializing it.  It may overestimate
+    a little, e.g, by including fields set to their default values.
+
+    Args:
+      value: a message, or the value of one of its fields
+
+    Returns:
+      int: the estimated size in bytes
+    """
+    if isinstance(value, messages.Message):
+        return _estimate_message_size(value)
+    if isinstance(value, list):
+        return 2 + sum(_estimate_size(x) + 2 for x in value)
+    if isinstance(value, unicode):
+        return _estimate_string_size(value)
+    if isinstance(value, bytes):
+        return 4 * ((len(value) + 2) // 3) + 2  # serialized as base64
+    if isinstance(value, messages.Enum):
+        return len(value.name) + 2
+    return len(str(value)) + 2
+
+
+def _estimate_message_size(msg):
+    if isinstance(msg, extra_types.JsonValue):
+        # serialized as the value that is set
+        if msg.is_null:
+            return 4
+        for name in _JSON_VALUE_FIELD_NAMES:
+            field_value = getattr(msg, name)
+            if field_value is not None:
+                return _estimate_size(field_value)
+        return 4
+    if isinstance(msg, extra_types.JsonArray):
+        return _estimate_size(msg.entries)
+    if isinstance(msg, extra_types.JsonObject):
+        return _estimate_map_size(msg.properties)
+    sizes = _field_sizes(type(msg))
+    if sizes and sizes[0][0] == _MAP_FIELD_NAME:
+        return _estimate_map_size(getattr(msg, _MAP_FIELD_NAME))
+    total = 2
+    for name, field_size in sizes:
+        field_value = getattr(msg, name)
+        if field_value is None or field_value == []:
+            continue
+        total += field_size + _estimate_size(field_value)
+    return total
+
+
+def _estimate_map_size(entries):
+    # each entry is serialized as "key": value,
+    return 2 + sum(_estimate_string_size(entry.key) +
+                   _estimate_size(entry.value) + 4
+                   for entry in entries)
+
+
+def _estimate_string_size(value):
+    size = len(value) + 2
+    for char in _ESCAPED_CHARS.findall(value):
+        if ord(char) > 0xffff:
+            size += 11  # a surrogate pair, e.g. \ud83d\ude00
+        elif char in u'"\\\b\f\n\r\t':
+            size += 1  # e.g. \n
+        else:
+            size += 5  # e.g. \u00e9
+    return size
+
 
 def _has_high_important_operation(req):
     def is_important(op):
@@ -554,20 +799,19 @@ def _key_by_signature(operations, signature_func):
     return dict((signature_func(op), op) for op in operations)
 
 
-def _sign_operation(op):
+def _sign_operation(op, signer=signing.DEFAULT_SIGNER):
     """Obtains a signature for an operation in a ReportRequest.
 
     Args:
        op (:class:`endpoints_management.gen.servicecontrol_v1_messages.Operation`): an
          operation used in a `ReportRequest`
+       signer (:class:`endpoints_management.control.signing.Signer`): computes
+         the signature
 
     Returns:
        string: a unique signature for that operation
     """
-    md5 = hashlib.md5()
-    md5.update(op.consumerId.encode('utf-8'))
-    md5.update(b'\x00')
-    md5.update(op.operationName.encode('utf-8'))
+    parts = [op.consumerId.encode('utf-8'), b'\x00', op.operationName.encode('utf-8')]
     if op.labels:
-        signing.add_dict_to_hash(md5, encoding.MessageToPyValue(op.labels))
-    return md5.digest()
+        signer.add_labels(parts, op.labels)
+    return signer.digest(parts)
@@ -37,11 +37,13 @@ import os
 import urllib.request, urllib.parse, urllib.error
 
 
+import cachetools
 from apitools.base.py import encoding
 from enum import Enum
 
 from ..config import service_config
-from . import label_descriptor, metric_descriptor, path_regex, sm_messages
+from . import (caches, label_descriptor, metric_descriptor, path_regex,
+               sm_messages)
 
 
 _logger = logging.getLogger(__name__)
@@ -120,22 +122,32 @@ class Loaders(Enum):
         return self._load_func(**kw)
 
 
+_NOT_CACHED = object()
+
+
 class MethodRegistry(object):
     """Provides a registry of the api methods defined by a ``Service``.
 
     During construction, ``MethodInfo`` instances are extracted from a
     ``Service``.  The are subsequently accessible via the :func:`lookup` method.
 
+    If ``lookup_cache_size`` is set, the results of :func:`lookup` are kept in
+    an LRU cache of that size, keyed by http method and path.  The cache
+    belongs to the registry, so it is discarded along with the registry when
+    the service config is reloaded.
+
     """
     # pylint: disable=too-few-public-methods
     _OPTIONS = u'OPTIONS'
 
-    def __init__(self, service):
+    def __init__(self, service, lookup_cache_size=0):
         """Constructor.
 
         Args:
           service (:class:`endpoints_management.gen.servicemanagement_v1_messages.Service`):
             a service instance
+          lookup_cache_size (int): the maximum number of (http method, path)
+            lookups to cache; if it is 0, lookups are not cached
         """
         if not isinstance(service, sm_messages.Service):
             raise ValueError(u'service should be an instance of Service')
@@ -148,37 +160,62 @@ class MethodRegistry(object):
         self._auth_infos = self._extract_auth_config()
         self._quota_infos = self._extract_quota_config()
 
-        # tracks urls templates
-        self._templates_method_infos = collections.defaultdict(list)
+        # routes paths to methods, for each http method
+        self._routers = collections.defaultdict(path_regex.PathRouter)
         self._extract_methods()
 
+        self._lookup_cache = None
+        if lookup_cache_size > 0:
+            self._lookup_cache = caches.LockedObject(
+                cachetools.LRUCache(lookup_cache_size))
+        self._lookup_cache_hits = 0
+        self._lookup_cache_misses = 0
+
+    @property
+    def lookup_cache_hits(self):
+        """The number of lookups answered from the lookup cache."""
+        return self._lookup_cache_hits
+
+    @property
+    def lookup_cache_misses(self):
+        """The number of lookups that were not in the lookup cache."""
+        return self._lookup_cache_misses
+
     def lookup(self, http_method, path):
+        if self._lookup_cache is None:
+            return self._lookup(http_method, path)
+
+        key = (http_method, path)
+        with self._lookup_cache as cache:
+            method_info = cache.get(key, _NOT_CACHED)
+            if method_info is not _NOT_CACHED:
+                self._lookup_cache_hits += 1
+                return method_info
+            self._lookup_cache_misses += 1
+
+        method_info = self._lookup(http_method, path)
+        with self._lookup_cache as cache:
+            cache[key] = method_info
+        return method_info
+
+    def _lookup(self, http_method, path):
         http_method = http_method.lower()
         if path.startswith(u'/'):
             path = path[1:]
-        tmi = self._templates_method_infos.get(http_method)
-        if not tmi:
+        router = self._routers.get(http_method)
+        if not router:
             _logger.debug(u'No methods for http method %s in %s',
                           http_method,
-                          list(self._templates_method_infos.keys()))
+                          list(self._routers.keys()))
             return None
         # need to remove url quoting of colons. this is the simplest way.
         path = path.replace('%3A', ':')
-        # pylint: disable=fixme
-        # TODO: speed this up if it proves to be bottleneck.
-        #
-        # There is sophisticated trie-based solution in esp, something similar
-        # could be built around the path_template implementation
-        for template, method_info in tmi:
-            _logger.debug(u'trying %s with template %s', path, template.pattern)
-            match = template.match(path)
-            if match:
-                _logger.debug(u'%s matched template %s', path, template.pattern)
-                return method_info
-            else:
-                _logger.debug(u'%s did not match template %s', path, template.pattern)
-
-        return None
+        method_info = router.lookup(path)
+        if method_info:
+            _logger.debug(u'%s matched method %s', path, method_info.selector)
+        else:
+            _logger.debug(u'%s did not match any template', path)
+        return method_info
 
     def _extract_auth_config(self):
         """Obtains the authentication configurations."""
@@ -245,10 +282,9 @@ class MethodRegistry(object):
             url = url[1:]
         try:
             http_method = http_method.lower()
-            template = path_regex.compile_path_pattern(url)
-            self._templates_method_infos[http_method].append((template, method_info))
+            self._routers[http_method].add(url, method_info)
             _logger.debug(u'Registered template %s under method %s',
-                          template.pattern,
+                          url,
                           http_method)
             return True
         except path_regex.RegexError:
@@ -358,6 +394,29 @@ class MethodInfo(object):
         self.body_field_path = u''
         self._url_query_parameters = collections.defaultdict(list)
         self._header_parameters = collections.defaultdict(list)
+        self._request_templates = {}
+
+    def request_template(self, create, *args):
+        """Obtains a request template for this method.
+
+        Templates hold the parts of the service control requests that are the
+        same for every call to the method.  They are created on first use and
+        cached, and are replaced if the values they are made from change.
+
+        Args:
+           create (func): makes the template, usually a ``Template`` class from
+             one of the request modules
+           *args: the values that the template is made from
+
+        Return:
+           the template returned by ``create(*args)``
+        """
+        cached = self._request_templates.get(create)
+        if cached is not None and cached[0] == args:
+            return cached[1]
+        template = create(*args)
+        self._request_templates[create] = (args, template)
+        return template
 
     def add_url_query_param(self, name, parameter):
         self._url_query_parameters[name].append(parameter)
@@ -12,10 +12,37 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Provides support for creating signatures using secure hashes."""
+"""Provides support for creating signatures using secure hashes.
+
+:class:`Signer` computes the signatures used to key the aggregation caches.  It
+reads the fields of the service control messages directly, and hashes all the
+data for a signature with a single update.  The hash it uses is selected by
+name:
+
+- :data:`MD5`, the default
+- :data:`BLAKE2B`, blake2b with a 128-bit digest
+- :data:`XXH128`, the non-cryptographic xxh3 128-bit hash; this needs the
+  optional ``xxhash`` package
+
+"""
 
 from __future__ import absolute_import
 
+from builtins import object
+import functools
+import hashlib
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+MD5 = u'md5'
+BLAKE2B = u'blake2b'
+XXH128 = u'xxh128'
+ALGORITHMS = (MD5, BLAKE2B, XXH128)
+
 
 def add_dict_to_hash(a_hash, a_dict):
     """Adds `a_dict` to `a_hash`
@@ -29,3 +56,116 @@ def add_dict_to_hash(a_hash, a_dict):
         return
     for k, v in list(a_dict.items()):
         a_hash.update(b'\x00' + k.encode('utf-8') + b'\x00' + v.encode('utf-8'))
+
+
+def _new_hash_func(algorithm):
+    if algorithm == MD5:
+        return hashlib.md5
+    if algorithm == BLAKE2B:
+        return functools.partial(hashlib.blake2b, digest_size=16)
+    if algorithm == XXH128:
+        if xxhash is None:
+            raise ValueError(u'%s signing needs the xxhash package' % (algorithm,))
+        return xxhash.xxh3_128
+    raise ValueError(u'Unknown signing algorithm %s' % (algorithm,))
+
+
+class Signer(object):
+    """Signer computes signatures from service control messages.
+
+    The encoded form of each label is cached, as most labels recur in many
+    requests.
+
+    Thread safe.
+    """
+
+    MAX_CACHED_LABELS = 4096
+    """The cache of encoded labels is cleared when it reaches this size."""
+
+    def __init__(self, algorithm=MD5):
+        """Constructor.
+
+        Args:
+          algorithm (string): the name of the hash to use, one of
+            :data:`ALGORITHMS`
+
+        Raises:
+          ValueError: if the algorithm is unknown or is not available
+        """
+        self._new_hash = _new_hash_func(algorithm)
+        self._algorithm = algorithm
+        self._encoded_labels = {}
+
+    @property
+    def algorithm(self):
+        """The name of the hash used by this instance."""
+        return self._algorithm
+
+    def digest(self, parts):
+        """Obtains the signature of the concatenation of ``parts``.
+
+        Args:
+          parts (list[bytes]): the data to sign
+
+        Returns:
+          bytes: the signature
+        """
+        return self._new_hash(b''.join(parts)).digest()
+
+    def add_labels(self, parts, labels):
+        """Adds the encoding of a ``LabelsValue`` message to ``parts``.
+
+        The encoding is the same as that added to a hash by
+        :func:`add_dict_to_hash` for the equivalent dict.
+        """
+        encoded_labels = self._encoded_labels
+        for prop in labels.additionalProperties:
+            key = (prop.key, prop.value)
+            encoded = encoded_labels.get(key)
+            if encoded is None:
+                if len(encoded_labels) >= self.MAX_CACHED_LABELS:
+                    encoded_labels.clear()
+                encoded = (b'\x00' + prop.key.encode('utf-8') +
+                           b'\x00' + prop.value.encode('utf-8'))
+                encoded_labels[key] = encoded
+            parts.append(encoded)
+
+    def add_metric_value(self, parts, mv):
+        """Adds the encoding of the identifying fields of a ``MetricValue``."""
+        if mv.labels:
+            self.add_labels(parts, mv.labels)
+        money_value = mv.moneyValue
+        if money_value is not None:
+            parts.append(b'\x00')
+            parts.append(money_value.currencyCode.encode('utf-8'))
+
+    def add_quota_properties(self, parts, quota_properties):
+        """Adds the encoding of a ``QuotaProperties`` message to ``parts``."""
+        parts.append(b'\x01')
+        if quota_properties.quotaMode is not None:
+            parts.append(quota_properties.quotaMode.name.encode('utf-8'))
+        if quota_properties.limitByIds:
+            self.add_labels(parts, quota_properties.limitByIds)
+
+
+DEFAULT_SIGNER = Signer()
+"""The :class:`Signer` used when no other is specified."""
+
+
+def create(options):
+    """Create a :class:`Signer` specified by ``options``
+
+    Args:
+      options (object): an instance of one of the options classes in
+        :mod:`endpoints_management.control.caches`, or ``None``
+
+    Returns:
+      :class:`Signer`: that uses ``options.signing_algorithm``, or
+        :data:`DEFAULT_SIGNER` if options is ``None``
+
+    Raises:
+      ValueError: if the algorithm is unknown or is not available
+    """
+    if options is None or options.signing_algorithm == DEFAULT_SIGNER.algorithm:
+        return DEFAULT_SIGNER
+    return Signer(options.signing_algorithm)
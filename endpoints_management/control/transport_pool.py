@@ -0,0 +1,344 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""transport_pool shares keep-alive service control transports across threads.
+
+By default, :class:`endpoints_management.control.client.Client` creates a
+transport, and so an http connection, for each thread that uses it.
+:class:`TransportPool` instead holds a bounded number of transports that are
+borrowed for the duration of each call.  Each transport keeps its connection
+alive between calls, so it is only set up again after it has been idle for
+longer than the idle timeout.
+
+A ``TransportPool`` is a transport factory, so it is used by passing it as the
+``create_transport`` of a ``Client``.
+
+Example:
+
+  >>> from endpoints_management.control import client, transport_pool
+  >>> pool = transport_pool.TransportPool(size=8)
+  >>> control_client = client.Loaders.DEFAULT.load(
+  ...     service_name, create_transport=pool)
+  >>> control_client.start()  # pre-warms the pool's connections
+  >>> pool.stats()
+  PoolStats(size=8, open=1, created=1, in_use=0, idle=1, waits=0, timeouts=0, discarded=0)
+
+"""
+
+from __future__ import absolute_import
+
+from builtins import object
+from builtins import range
+import collections
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from apitools.base.py import exceptions
+
+from . import client
+
+_logger = logging.getLogger(__name__)
+
+
+class PoolExhaustedError(exceptions.CommunicationError):
+    """Raised when no transport became available in the acquire timeout."""
+
+
+class PoolStats(
+        collections.namedtuple(
+            u'PoolStats',
+            [u'size',
+             u'open',
+             u'created',
+             u'in_use',
+             u'idle',
+             u'waits',
+             u'timeouts',
+             u'discarded'])):
+    """Describes the utilization of a :class:`TransportPool`.
+
+    Attributes:
+        size (int): the maximum number of open transports
+        open (int): the number of open transports, whether in use or idle
+        created (int): the number of transports created so far
+        in_use (int): the number of transports currently borrowed
+        idle (int): the number of transports waiting to be borrowed
+        waits (int): the number of times a caller waited for a transport
+          because all of them were in use
+        timeouts (int): the number of times a caller gave up waiting
+        discarded (int): the number of transports closed after their
+          connection failed, or after being idle for longer than the idle
+          timeout
+    """
+    # pylint: disable=too-few-public-methods
+
+
+def _warm_http_transport(transport):
+    # Any response sets up the connection, so the result is ignored
+    transport.http.request(transport.url, method=u'HEAD')
+
+
+def _close_http_transport(transport):
+    close = getattr(transport.http, u'close', None)
+    if close is not None:
+        close()
+
+
+class TransportPool(object):
+    """TransportPool is a transport factory that shares pooled transports.
+
+    Calling an instance returns a transport whose ``services`` methods borrow
+    one of the pooled transports for each call.  The most recently used
+    transport is borrowed first, so that connections that are kept busy stay
+    warm, while others become idle and are discarded.
+
+    Thread safe.
+
+    """
+    # pylint: disable=too-many-instance-attributes, too-many-arguments
+    DEFAULT_SIZE = 10
+    DEFAULT_IDLE_TIMEOUT = timedelta(seconds=60)
+    DEFAULT_NUM_PREWARMED = 1
+
+    def __init__(self,
+                 size=DEFAULT_SIZE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 num_prewarmed=DEFAULT_NUM_PREWARMED,
+                 acquire_timeout=None,
+                 create_transport=client._create_http_transport,
+                 warm_transport=_warm_http_transport,
+                 close_transport=_close_http_transport,
+                 timer=time.time):
+        """Constructor.
+
+        Args:
+          size (int): the maximum number of transports
+          idle_timeout (:class:`datetime.timedelta`): transports that have
+            been idle for longer than this are closed
+          num_prewarmed (int): the number of transports whose connections are
+            set up by :meth:`prewarm`
+          acquire_timeout (:class:`datetime.timedelta`): the maximum time to
+            wait for a transport when they are all in use, or ``None`` to
+            wait indefinitely
+          create_transport (func[[]]): creates a new transport
+          warm_transport (func[[transport]]): sets up a transport's connection
+          close_transport (func[[transport]]): closes a transport's connection
+          timer (func[[float]]): obtains the current time in seconds
+        """
+        assert isinstance(size, int), u'should be an int'
+        assert size > 0, u'should be positive'
+        assert isinstance(idle_timeout, timedelta), u'should be a timedelta'
+        assert isinstance(num_prewarmed, int), u'should be an int'
+        assert 0 <= num_prewarmed <= size, u'should be at most size'
+        assert acquire_timeout is None or isinstance(acquire_timeout, timedelta), (
+            u'should be a timedelta')
+        self._size = size
+        self._idle_timeout = idle_timeout.total_seconds()
+        self._num_prewarmed = num_prewarmed
+        self._acquire_timeout = (None if acquire_timeout is None
+                                 else acquire_timeout.total_seconds())
+        self._create_transport = create_transport
+        self._warm_transport = warm_transport
+        self._close_transport = close_transport
+        self._timer = timer
+        self._available = threading.Condition(threading.Lock())
+        self._idle = []  # (transport, last_used) pairs, most recent last
+        self._open = 0
+        self._created = 0
+        self._in_use = 0
+        self._waits = 0
+        self._timeouts = 0
+        self._discarded = 0
+        self._services = _PooledServices(self)
+
+    def __call__(self):
+        """Obtains a transport that borrows from this pool for each call."""
+        return self
+
+    @property
+    def services(self):
+        """Provides the methods of the pooled transports' ``services``."""
+        return self._services
+
+    def stats(self):
+        """Obtains the current utilization of this pool.
+
+        Returns:
+          :class:`PoolStats`: describing this pool
+        """
+        with self._available:
+            return PoolStats(size=self._size,
+                             open=self._open,
+                             created=self._created,
+                             in_use=self._in_use,
+                             idle=len(self._idle),
+                             waits=self._waits,
+                             timeouts=self._timeouts,
+                             discarded=self._discarded)
+
+    def acquire(self):
+        """Borrows a transport, creating one if there are none idle.
+
+        The transport must be returned using :meth:`release`.
+
+        Raises:
+          PoolExhaustedError: if none became available in the acquire timeout
+        """
+        stale = []
+        try:
+            with self._available:
+                stale = self._take_stale()
+                transport = None
+                if self._idle:
+                    transport = self._idle.pop()[0]
+                elif self._open >= self._size:
+                    transport = self._wait_for_idle()
+                if transport is None:
+                    self._open += 1
+                    self._created += 1
+                self._in_use += 1
+        finally:
+            for t in stale:
+                self._close_quietly(t)
+
+        if transport is not None:
+            return transport
+        try:
+            return self._create_transport()
+        except Exception:
+            self._forget()
+            raise
+
+    def release(self, transport):
+        """Returns a transport obtained from :meth:`acquire`."""
+        with self._available:
+            self._in_use -= 1
+            self._idle.append((transport, self._timer()))
+            self._available.notify()
+
+    def discard(self, transport):
+        """Closes a transport obtained from :meth:`acquire`.
+
+        This should be used instead of :meth:`release` if the transport's
+        connection failed.
+        """
+        self._forget(discarded=1)
+        self._close_quietly(transport)
+
+    def prewarm(self):
+        """Sets up the connections of ``num_prewarmed`` transports."""
+        borrowed = []
+        try:
+            for _ in range(self._num_prewarmed):
+                borrowed.append(self.acquire())
+            for transport in borrowed:
+                self._warm_transport(transport)
+        except Exception:  # pylint: disable=broad-except
+            _logger.warn(u'failed to pre-warm the transport pool', exc_info=True)
+        finally:
+            for transport in borrowed:
+                self.release(transport)
+
+    def clear(self):
+        """Closes all the idle transports."""
+        with self._available:
+            idle = [t for t, _ in self._idle]
+            self._idle = []
+            self._open -= len(idle)
+        for transport in idle:
+            self._close_quietly(transport)
+
+    def _take_stale(self):
+        # the lock must be held by the caller
+        cutoff = self._timer() - self._idle_timeout
+        count = 0
+        for _, last_used in self._idle:
+            if last_used >= cutoff:
+                break
+            count += 1
+        if not count:
+            return []
+        stale = [t for t, _ in self._idle[:count]]
+        del self._idle[:count]
+        self._open -= count
+        self._discarded += count
+        return stale
+
+    def _wait_for_idle(self):
+        # the lock must be held by the caller
+        self._waits += 1
+        deadline = None
+        if self._acquire_timeout is not None:
+            deadline = self._timer() + self._acquire_timeout
+        while not self._idle and self._open >= self._size:
+            if deadline is None:
+                self._available.wait()
+                continue
+            remaining = deadline - self._timer()
+            if remaining <= 0:
+                self._timeouts += 1
+                raise PoolExhaustedError(
+                    u'no transport became available in %s seconds' %
+                    (self._acquire_timeout,))
+            self._available.wait(remaining)
+        if self._idle:
+            return self._idle.pop()[0]
+        return None  # one was discarded, so a new one can be created
+
+    def _forget(self, discarded=0):
+        # called when a borrowed transport is no longer open
+        with self._available:
+            self._open -= 1
+            self._in_use -= 1
+            self._discarded += discarded
+            self._available.notify()
+
+    def _close_quietly(self, transport):
+        try:
+            self._close_transport(transport)
+        except Exception:  # pylint: disable=broad-except
+            _logger.debug(u'failed to close a pooled transport', exc_info=True)
+
+
+class _PooledServices(object):
+    """Invokes the ``services`` methods of a borrowed transport."""
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def __getattr__(self, name):
+        pool = self._pool
+
+        def call(*args, **kw):
+            transport = pool.acquire()
+            try:
+                result = getattr(transport.services, name)(*args, **kw)
+            except exceptions.HttpError:
+                # the server responded, so the connection is still usable
+                pool.release(transport)
+                raise
+            except exceptions.CommunicationError:
+                pool.discard(transport)
+                raise
+            except Exception:
+                pool.release(transport)
+                raise
+            pool.release(transport)
+            return result
+
+        call.__name__ = str(name)
+        return call
@@ -19,6 +19,10 @@ It provides the :class:`Middleware`, which is a WSGI middleware implementation
 that wraps another WSGI application to uses a provided
 :class:`endpoints_management.control.client.Client` to provide service control.
 
+By default, :class:`Middleware` passes the wrapped application's response
+through as it is iterated, and sends the report for the request when the
+response is closed by the WSGI server.
+
 """
 # pylint: disable=too-many-arguments
 
@@ -95,7 +99,10 @@ def running_on_devserver():
 
 
 def add_all(application, project_id, control_client,
-            loader=service.Loaders.FROM_SERVICE_MANAGEMENT):
+            loader=service.Loaders.FROM_SERVICE_MANAGEMENT,
+            buffer_response=False,
+            lookup_cache_size=0,
+            report_pipeline=None):
     """Adds all endpoints middleware to a wsgi application.
 
     Sets up application to use all default endpoints middleware.
@@ -124,8 +131,17 @@ def add_all(application, project_id, control_client,
        control_client: the service control client instance
        loader (:class:`endpoints_management.control.service.Loader`): loads the service
           instance that configures this instance's behaviour
+       buffer_response (bool): if True, the response body is joined before
+          it is returned; see :class:`Middleware`
+       lookup_cache_size (int): the number of method lookups to cache; see
+          :class:`EnvironmentMiddleware`
+       report_pipeline (:class:`endpoints_management.control.report_pipeline.Pipeline`):
+          if set, reports are made by it; see :class:`Middleware`
     """
-    return ConfigFetchWrapper(application, project_id, control_client, loader)
+    return ConfigFetchWrapper(application, project_id, control_client, loader,
+                              buffer_response=buffer_response,
+                              lookup_cache_size=lookup_cache_size,
+                              report_pipeline=report_pipeline)
 
 
 class ConfigFetchWrapper(object):
@@ -144,7 +160,10 @@ class ConfigFetchWrapper(object):
     """
     def __init__(self, application, project_id, control_client,
                  loader=service.Loaders.FROM_SERVICE_MANAGEMENT,
-                 disable_threading=False):
+                 disable_threading=False,
+                 buffer_response=False,
+                 lookup_cache_size=0,
+                 report_pipeline=None):
         self.service_config = None
         self.background_thread = None
         self.threading_failed = disable_threading
@@ -155,6 +174,9 @@ class ConfigFetchWrapper(object):
         self.project_id = project_id
         self.control_client = control_client
         self.loader = loader
+        self.buffer_response = buffer_response
+        self.lookup_cache_size = lookup_cache_size
+        self.report_pipeline = report_pipeline
 
         self.try_loading()
         self.wrap_app()
@@ -173,10 +195,14 @@ class ConfigFetchWrapper(object):
             return
         authenticator = _create_authenticator(self.service_config)
 
-        wrapped_app = Middleware(self.application, self.project_id, self.control_client)
+        wrapped_app = Middleware(self.application, self.project_id, self.control_client,
+                                 buffer_response=self.buffer_response,
+                                 report_pipeline=self.report_pipeline)
         if authenticator:
             wrapped_app = AuthenticationMiddleware(wrapped_app, authenticator)
-        self.wsgi_backend = EnvironmentMiddleware(wrapped_app, self.service_config)
+        self.wsgi_backend = EnvironmentMiddleware(
+            wrapped_app, self.service_config,
+            lookup_cache_size=self.lookup_cache_size)
 
     def try_loading(self):
         try:
@@ -239,26 +265,30 @@ class EnvironmentMiddleware(object):
     METHOD_INFO = u'google.api.config.method_info'
     REPORTING_RULES = u'google.api.config.reporting_rules'
 
-    def __init__(self, application, a_service):
+    def __init__(self, application, a_service, lookup_cache_size=0):
         """Initializes a new Middleware instance.
 
         Args:
           application: the wrapped wsgi application
           a_service (:class:`endpoints_management.gen.servicemanagement_v1_messages.Service`):
             a service instance
+          lookup_cache_size (int): the number of (http method, path) lookups
+            of the method info to cache; if 0, lookups are not cached
         """
         if not isinstance(a_service, sm_messages.Service):
             raise ValueError(u"service is None or not an instance of Service")
 
         self._application = application
         self._service = a_service
+        self._lookup_cache_size = lookup_cache_size
 
         method_registry, reporting_rules = self._configure()
         self._method_registry = method_registry
         self._reporting_rules = reporting_rules
 
     def _configure(self):
-        registry = service.MethodRegistry(self._service)
+        registry = service.MethodRegistry(
+            self._service, lookup_cache_size=self._lookup_cache_size)
         logs, metric_names, label_names = service.extract_report_spec(self._service)
         reporting_rules = report_request.ReportingRules.from_known_inputs(
             logs=logs,
@@ -315,7 +345,9 @@ class Middleware(object):
                  project_id,
                  control_client,
                  next_operation_id=_next_operation_uuid,
-                 timer=datetime.utcnow):
+                 timer=datetime.utcnow,
+                 buffer_response=False,
+                 report_pipeline=None):
         """Initializes a new Middleware instance.
 
         Args:
@@ -324,12 +356,22 @@ class Middleware(object):
            control_client: the service control client instance
            next_operation_id (func): produces the next operation
            timer (func[[datetime.datetime]]): a func that obtains the current time
+           buffer_response (bool): if True, the response body is joined and the
+             report is sent before the response is returned.  Otherwise, the
+             response is streamed, and the report is sent when it is closed
+           report_pipeline (:class:`endpoints_management.control.report_pipeline.Pipeline`):
+             if set, the information to be reported is queued on it, and the
+             report request is made and sent from its worker thread.
+             Otherwise, the report request is made and sent by the thread
+             handling the request
            """
         self._application = application
         self._project_id = project_id
         self._control_client = control_client
         self._next_operation_id = next_operation_id
         self._timer = timer
+        self._buffer_response = buffer_response
+        self._report_pipeline = report_pipeline
 
     def __call__(self, environ, start_response):
         # pylint: disable=too-many-locals
@@ -379,7 +421,8 @@ class Middleware(object):
                 if not quota_info.quota_info:
                     _logger.debug(u'no metric costs for this method')
                 else:
-                    quota_request = quota_info.as_allocate_quota_request()
+                    quota_request = self._create_quota_request(method_info,
+                                                               quota_info)
                     quota_response = self._control_client.allocate_quota(quota_request)
                     error_msg = self._handle_quota_response(
                         app_info, quota_response, start_response)
@@ -388,19 +431,26 @@ class Middleware(object):
             # send a report request that indicates that the request failed
             rules = environ.get(EnvironmentMiddleware.REPORTING_RULES)
             latency_timer.end()
-            report_req = self._create_report_request(method_info,
-                                                     check_info,
-                                                     app_info,
-                                                     latency_timer,
-                                                     rules,
-                                                     consumer_project_number)
-            _logger.debug(u'scheduling report_request %s', report_req)
-            self._control_client.report(report_req)
+            self._report(method_info, check_info, app_info, latency_timer,
+                         rules, consumer_project_number)
             return error_msg
 
         # update the client with the response
         latency_timer.app_start()
+        result = self._call_application(environ, start_response, app_info)
+        rules = environ.get(EnvironmentMiddleware.REPORTING_RULES)
 
+        def report(response_size):
+            latency_timer.end()
+            app_info.response_size = response_size
+            self._report(method_info, check_info, app_info, latency_timer,
+                         rules, consumer_project_number)
+
+        if not self._buffer_response:
+            return _ReportingIterable(result, report)
+        return _buffer_and_report(result, report)
+
+    def _call_application(self, environ, start_response, app_info):
         # run the application request in an inner handler that sets the status
         # and response code on app_info
         def inner_start_response(status, response_headers, exc_info=None):
@@ -411,23 +461,30 @@ class Middleware(object):
                     break
             return start_response(status, response_headers, exc_info)
 
-        result = self._application(environ, inner_start_response)
+        return self._application(environ, inner_start_response)
 
-        # perform reporting, result must be joined otherwise the latency record
-        # is incorrect
-        result = b''.join(result)
-        latency_timer.end()
-        app_info.response_size = len(result)
-        rules = environ.get(EnvironmentMiddleware.REPORTING_RULES)
-        report_req = self._create_report_request(method_info,
-                                                 check_info,
-                                                 app_info,
-                                                 latency_timer,
-                                                 rules,
-                                                 consumer_project_number)
-        _logger.debug(u'scheduling report_request %s', report_req)
-        self._control_client.report(report_req)
-        return (result, )
+    def _report(self, method_info, check_info, app_info, latency_timer,
+                reporting_rules, consumer_project_number):
+        if self._report_pipeline is None:
+            report_req = self._create_report_request(method_info,
+                                                     check_info,
+                                                     app_info,
+                                                     latency_timer,
+                                                     reporting_rules,
+                                                     consumer_project_number)
+            _logger.debug(u'scheduling report_request %s', report_req)
+            self._control_client.report(report_req)
+            return
+
+        report_info = self._create_report_info(method_info,
+                                               check_info,
+                                               app_info,
+                                               latency_timer,
+                                               consumer_project_number)
+        template = method_info.request_template(
+            report_request.Template, reporting_rules, platform)
+        if not self._report_pipeline.put(report_info, reporting_rules, template):
+            _logger.debug(u'report pipeline is full, dropped %s', report_info)
 
     def _create_report_request(self,
                                method_info,
@@ -436,9 +493,25 @@ class Middleware(object):
                                latency_timer,
                                reporting_rules,
                                consumer_project_number):
+        report_info = self._create_report_info(method_info,
+                                               check_info,
+                                               app_info,
+                                               latency_timer,
+                                               consumer_project_number)
+        template = method_info.request_template(
+            report_request.Template, reporting_rules, platform)
+        return report_info.as_report_request(reporting_rules, timer=self._timer,
+                                             template=template)
+
+    def _create_report_info(self,
+                            method_info,
+                            check_info,
+                            app_info,
+                            latency_timer,
+                            consumer_project_number):
         # TODO: determine how to obtain the consumer_project_id and the location
         # correctly
-        report_info = report_request.Info(
+        return report_request.Info(
             api_key=check_info.api_key,
             api_key_valid=app_info.api_key_valid,
             api_method=method_info.selector,
@@ -461,7 +534,6 @@ class Middleware(object):
             service_name=check_info.service_name,
             url=app_info.url
         )
-        return report_info.as_report_request(reporting_rules, timer=self._timer)
 
     def _get_api_key_info(self, method_info, parsed_uri, environ):
         api_key = _find_api_key_param(method_info, parsed_uri)
@@ -510,6 +582,11 @@ class Middleware(object):
             client_ip=environ.get(u'REMOTE_ADDR', u''),
         )
 
+    def _create_quota_request(self, method_info, quota_info):
+        template = method_info.request_template(
+            quota_request.Template, quota_info.quota_info, quota_info.config_id)
+        return quota_info.as_allocate_quota_request(template=template)
+
     def _handle_check_response(self, app_info, check_resp, start_response):
         code, detail, api_key_valid = check_request.convert_response(
             check_resp, self._project_id)
@@ -570,6 +647,48 @@ class _AppInfo(object):
         self.url = None
 
 
+class _ReportingIterable(object):
+    """Wraps a WSGI response, counting the bytes in each chunk it yields.
+
+    The chunks are passed through unchanged.  When the WSGI server closes the
+    response, the wrapped response is closed and ``on_close`` is invoked with
+    the number of bytes that were yielded.
+    """
+
+    def __init__(self, result, on_close):
+        self._result = result
+        self._on_close = on_close
+        self._size = 0
+        self._closed = False
+
+    def __iter__(self):
+        for chunk in self._result:
+            self._size += len(chunk)
+            yield chunk
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            close = getattr(self._result, u'close', None)
+            if close is not None:
+                close()
+        finally:
+            self._on_close(self._size)
+
+
+def _buffer_and_report(result, on_buffered):
+    """Joins a WSGI response, then invokes ``on_buffered`` with its size.
+
+    The response is buffered so that the latency reported includes the time
+    taken to produce all of it.
+    """
+    result = b''.join(result)
+    on_buffered(len(result))
+    return (result, )
+
+
 class _LatencyTimer(object):
 
     def __init__(self, timer):
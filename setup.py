@@ -45,6 +45,11 @@ install_requires = [
     'webob>=1.7.4',
 ]
 
+extras_require = {
+    # enables the xxh128 signing algorithm
+    'xxhash': ['xxhash>=2.0'],
+}
+
 tests_require = [
     "flask>=0.11.1",
     "httmock>=1.2",
@@ -75,6 +80,7 @@ setup(
         'Programming Language :: Python :: Implementation :: CPython',
     ],
     install_requires=install_requires,
+    extras_require=extras_require,
     setup_requires=["pytest_runner"],
     tests_require=tests_require,
     test_suite="tests"
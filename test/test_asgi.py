@@ -0,0 +1,326 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+from builtins import object
+from apitools.base.py import encoding
+import asyncio
+import mock
+import unittest2
+from expects import be_none, be_true, equal, expect
+
+from endpoints_management.auth import tokens
+from endpoints_management.control import (asgi, report_request, sc_messages,
+                                          service, sm_messages)
+
+
+def _run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+_SERVICE_CONFIG = u"""
+{
+    "name": "asgi-service",
+    "http": {
+        "rules": [{
+            "selector": "asgi-service.ListShelves",
+            "get": "/shelves"
+        }]
+    },
+    "usage": {
+        "rules": [{
+            "selector" : "asgi-service.ListShelves",
+            "allowUnregisteredCalls" : true
+        }]
+    }
+}
+"""
+
+
+def _load_service():
+    return encoding.JsonToMessage(sm_messages.Service, _SERVICE_CONFIG)
+
+
+def _make_scope(path=u'/shelves', method=u'GET', headers=(), query=b''):
+    return {
+        u'type': u'http',
+        u'method': method,
+        u'path': path,
+        u'query_string': query,
+        u'scheme': u'http',
+        u'server': (u'localhost', 8080),
+        u'client': (u'10.0.0.1', 1234),
+        u'headers': list(headers),
+    }
+
+
+async def _receive():
+    return {u'type': u'http.request', u'body': b'', u'more_body': False}
+
+
+class _Recorder(object):
+
+    def __init__(self):
+        self.messages = []
+
+    async def __call__(self, message):
+        self.messages.append(message)
+
+
+class _StreamingApp(object):
+
+    def __init__(self, chunks=(b'first', b'second')):
+        self.chunks = chunks
+        self.scope = None
+
+    async def __call__(self, scope, receive, send):
+        self.scope = scope
+        await send({u'type': u'http.response.start', u'status': 200,
+                    u'headers': []})
+        for i, chunk in enumerate(self.chunks):
+            await send({u'type': u'http.response.body', u'body': chunk,
+                        u'more_body': i < len(self.chunks) - 1})
+
+
+class _FailingApp(object):
+
+    async def __call__(self, scope, receive, send):
+        await send({u'type': u'http.response.start', u'status': 200,
+                    u'headers': []})
+        await send({u'type': u'http.response.body', u'body': b'first',
+                    u'more_body': True})
+        raise ValueError(u'the application failed')
+
+
+class _FakeAsyncControlClient(object):
+
+    def __init__(self, check_response=None):
+        self.check_response = check_response or sc_messages.CheckResponse()
+        self.quota_response = sc_messages.AllocateQuotaResponse()
+        self.checks = []
+        self.quotas = []
+        self.reports = []
+
+    async def check(self, req):
+        self.checks.append(req)
+        return self.check_response
+
+    async def allocate_quota(self, req):
+        self.quotas.append(req)
+        return self.quota_response
+
+    async def report(self, req):
+        self.reports.append(req)
+
+
+class TestEnvironmentMiddleware(unittest2.TestCase):
+
+    def test_should_add_service_et_al_to_scope(self):
+        cls = asgi.EnvironmentMiddleware
+        app = _StreamingApp()
+        wanted_service = _load_service()
+        wrapped = cls(app, wanted_service)
+        _run(wrapped(_make_scope(), _receive, _Recorder()))
+        given = app.scope
+        expect(given.get(cls.SERVICE)).to(equal(wanted_service))
+        expect(given.get(cls.SERVICE_NAME)).to(equal(wanted_service.name))
+        expect(given.get(cls.METHOD_REGISTRY)).not_to(be_none)
+        expect(given.get(cls.REPORTING_RULES)).not_to(be_none)
+        expect(given[cls.METHOD_INFO].selector).to(
+            equal(u'asgi-service.ListShelves'))
+
+    def test_should_not_add_method_info_for_unknown_paths(self):
+        cls = asgi.EnvironmentMiddleware
+        app = _StreamingApp()
+        wrapped = cls(app, _load_service())
+        _run(wrapped(_make_scope(path=u'/books'), _receive, _Recorder()))
+        expect(app.scope.get(cls.METHOD_INFO)).to(be_none)
+
+
+class TestMiddleware(unittest2.TestCase):
+    PROJECT_ID = u'middleware'
+
+    def _scope(self, method_info, **kw):
+        scope = _make_scope(**kw)
+        scope[asgi.EnvironmentMiddleware.METHOD_INFO] = method_info
+        scope[asgi.EnvironmentMiddleware.SERVICE_NAME] = u'asgi-service'
+        scope[asgi.EnvironmentMiddleware.SERVICE] = _load_service()
+        scope[asgi.EnvironmentMiddleware.REPORTING_RULES] = (
+            report_request.ReportingRules())
+        return scope
+
+    def _method_info(self, allow_unregistered_calls=True):
+        info = service.MethodInfo(u'asgi-service.ListShelves', None, None)
+        info.allow_unregistered_calls = allow_unregistered_calls
+        return info
+
+    def _call(self, wrapped, scope, send):
+        async def call_and_drain():
+            await wrapped(scope, _receive, send)
+            await asyncio.gather(*list(wrapped._report_tasks))
+
+        _run(call_and_drain())
+
+    def test_should_pass_through_requests_without_method_info(self):
+        control_client = _FakeAsyncControlClient()
+        app = _StreamingApp()
+        wrapped = asgi.Middleware(app, self.PROJECT_ID, control_client)
+        send = _Recorder()
+        self._call(wrapped, _make_scope(), send)
+        expect(len(send.messages)).to(equal(3))
+        expect(control_client.checks).to(equal([]))
+        expect(control_client.reports).to(equal([]))
+
+    def test_should_stream_and_report_the_response_size(self):
+        control_client = _FakeAsyncControlClient()
+        app = _StreamingApp()
+        wrapped = asgi.Middleware(app, self.PROJECT_ID, control_client)
+        send = _Recorder()
+        self._call(wrapped, self._scope(self._method_info()), send)
+        bodies = [m[u'body'] for m in send.messages
+                  if m[u'type'] == u'http.response.body']
+        expect(bodies).to(equal([b'first', b'second']))
+        expect(len(control_client.checks)).to(equal(1))
+        expect(len(control_client.reports)).to(equal(1))
+        op = control_client.reports[0].reportRequest.operations[0]
+        expect(op.operationName).to(equal(u'asgi-service.ListShelves'))
+
+    def test_should_report_after_the_last_chunk_is_sent(self):
+        control_client = _FakeAsyncControlClient()
+        app = _StreamingApp()
+        wrapped = asgi.Middleware(app, self.PROJECT_ID, control_client)
+        seen_at_send = []
+
+        async def send(message):
+            seen_at_send.append(len(control_client.reports))
+
+        self._call(wrapped, self._scope(self._method_info()), send)
+        expect(seen_at_send).to(equal([0, 0, 0]))
+        expect(len(control_client.reports)).to(equal(1))
+
+    def test_should_count_the_streamed_bytes(self):
+        control_client = _FakeAsyncControlClient()
+        app = _StreamingApp(chunks=(b'a' * 10, b'b' * 5))
+        wrapped = asgi.Middleware(app, self.PROJECT_ID, control_client)
+        with mock.patch.object(wrapped, u'_create_report_request',
+                               wraps=wrapped._create_report_request) as create:
+            self._call(wrapped, self._scope(self._method_info()), _Recorder())
+            app_info = create.call_args[0][2]
+            expect(app_info.response_size).to(equal(15))
+            expect(app_info.response_code).to(equal(200))
+
+    def test_should_report_responses_that_are_not_completed(self):
+        control_client = _FakeAsyncControlClient()
+        wrapped = asgi.Middleware(_FailingApp(), self.PROJECT_ID,
+                                  control_client)
+        send = _Recorder()
+
+        async def call_and_drain():
+            with self.assertRaises(ValueError):
+                await wrapped(self._scope(self._method_info()), _receive, send)
+            await asyncio.gather(*list(wrapped._report_tasks))
+
+        with mock.patch.object(wrapped, u'_create_report_request',
+                               wraps=wrapped._create_report_request) as create:
+            _run(call_and_drain())
+            app_info = create.call_args[0][2]
+            expect(app_info.response_size).to(equal(5))
+        expect(len(control_client.reports)).to(equal(1))
+
+    def test_should_log_failures_to_report(self):
+        control_client = _FakeAsyncControlClient()
+        control_client.report = mock.MagicMock(side_effect=ValueError(u'boom'))
+        wrapped = asgi.Middleware(_StreamingApp(), self.PROJECT_ID,
+                                  control_client)
+        with mock.patch.object(asgi._logger, u'error') as log_error:
+            self._call(wrapped, self._scope(self._method_info()), _Recorder())
+            expect(log_error.called).to(be_true)
+
+    def test_should_reject_calls_without_an_api_key(self):
+        control_client = _FakeAsyncControlClient()
+        app = _StreamingApp()
+        wrapped = asgi.Middleware(app, self.PROJECT_ID, control_client)
+        send = _Recorder()
+        self._call(wrapped,
+                   self._scope(self._method_info(allow_unregistered_calls=False)),
+                   send)
+        expect(send.messages[0][u'status']).to(equal(401))
+        expect(app.scope).to(be_none)
+        expect(control_client.checks).to(equal([]))
+        expect(len(control_client.reports)).to(equal(1))
+
+    def test_should_send_the_api_key_from_the_query(self):
+        control_client = _FakeAsyncControlClient()
+        wrapped = asgi.Middleware(_StreamingApp(), self.PROJECT_ID,
+                                  control_client)
+        self._call(wrapped,
+                   self._scope(self._method_info(allow_unregistered_calls=False),
+                               query=b'key=my-api-key'),
+                   _Recorder())
+        op = control_client.checks[0].checkRequest.operation
+        expect(op.consumerId).to(equal(u'api_key:my-api-key'))
+
+    def test_should_reject_requests_when_the_check_fails(self):
+        error = sc_messages.CheckError(
+            code=sc_messages.CheckError.CodeValueValuesEnum.PROJECT_DELETED)
+        control_client = _FakeAsyncControlClient(
+            check_response=sc_messages.CheckResponse(checkErrors=[error]))
+        app = _StreamingApp()
+        wrapped = asgi.Middleware(app, self.PROJECT_ID, control_client)
+        send = _Recorder()
+        self._call(wrapped, self._scope(self._method_info()), send)
+        expect(send.messages[0][u'status']).to(equal(403))
+        expect(app.scope).to(be_none)
+        expect(len(control_client.reports)).to(equal(1))
+
+
+class TestAuthenticationMiddleware(unittest2.TestCase):
+
+    def setUp(self):
+        self._authenticator = mock.MagicMock(spec=tokens.Authenticator)
+        self._app = _StreamingApp()
+        self._middleware = asgi.AuthenticationMiddleware(self._app,
+                                                         self._authenticator)
+
+    def _scope(self, headers=()):
+        method_info = service.MethodInfo(u'selector', mock.MagicMock(), None)
+        scope = _make_scope(headers=headers)
+        scope[asgi.EnvironmentMiddleware.METHOD_INFO] = method_info
+        scope[asgi.EnvironmentMiddleware.SERVICE_NAME] = u'service'
+        return scope
+
+    def test_should_add_the_user_info_to_the_scope(self):
+        user_info = mock.MagicMock()
+        self._authenticator.authenticate.return_value = user_info
+        scope = self._scope(headers=[(b'authorization', b'Bearer a-token')])
+        _run(self._middleware(scope, _receive, _Recorder()))
+        expect(self._authenticator.authenticate.called).to(be_true)
+        expect(self._authenticator.authenticate.call_args[0][0]).to(
+            equal(u'a-token'))
+        expect(self._app.scope[asgi.AuthenticationMiddleware.USER_INFO]).to(
+            equal(user_info))
+
+    def test_should_set_no_user_info_if_authentication_fails(self):
+        self._authenticator.authenticate.side_effect = Exception()
+        scope = self._scope(headers=[(b'authorization', b'Bearer a-token')])
+        _run(self._middleware(scope, _receive, _Recorder()))
+        expect(self._app.scope[asgi.AuthenticationMiddleware.USER_INFO]).to(
+            be_none)
+
+    def test_should_set_no_user_info_without_a_token(self):
+        _run(self._middleware(self._scope(), _receive, _Recorder()))
+        expect(self._authenticator.authenticate.called).to(equal(False))
+        expect(self._app.scope[asgi.AuthenticationMiddleware.USER_INFO]).to(
+            be_none)
@@ -0,0 +1,299 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+from builtins import object
+from apitools.base.py import exceptions
+import asyncio
+import datetime
+import mock
+import unittest2
+from expects import be_a, be_false, be_none, be_true, expect, equal
+
+from endpoints_management.control import (
+    async_client, caches, check_request, client, quota_request,
+    report_request, sc_messages
+)
+
+
+def _run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+class _FakeAsyncTransport(object):
+    """Records the requests it is sent and answers them from fixed responses."""
+
+    def __init__(self):
+        self.check_response = None
+        self.quota_response = None
+        self.error = None
+        self.checks = []
+        self.quotas = []
+        self.reports = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def _respond(self, reqs, req, resp):
+        reqs.append(req)
+        self.in_flight += 1
+        self.max_in_flight = max(self.in_flight, self.max_in_flight)
+        try:
+            await asyncio.sleep(0)
+            if self.error is not None:
+                raise self.error
+            return resp
+        finally:
+            self.in_flight -= 1
+
+    async def Check(self, req):
+        return await self._respond(self.checks, req, self.check_response)
+
+    async def AllocateQuota(self, req):
+        return await self._respond(self.quotas, req, self.quota_response)
+
+    async def Report(self, req):
+        return await self._respond(self.reports, req, None)
+
+
+def _make_dummy_report_request(project_id, service_name):
+    rules = report_request.ReportingRules()
+    info = report_request.Info(
+        consumer_project_id=project_id,
+        operation_id=u'an_op_id',
+        operation_name=u'an_op_name',
+        method=u'GET',
+        referer=u'a_referer',
+        service_name=service_name)
+    return info.as_report_request(rules)
+
+
+def _make_dummy_quota_request(project_id, service_name):
+    info = quota_request.Info(
+        consumer_project_id=project_id,
+        operation_id=u'an_op_id',
+        operation_name=u'an_op_name',
+        referer=u'a_referer',
+        service_name=service_name,
+        quota_info={'foo': 1, 'bar': 2})
+    return info.as_allocate_quota_request()
+
+
+def _make_dummy_check_request(project_id, service_name, consumer=u''):
+    info = check_request.Info(
+        consumer_project_id=project_id + consumer,
+        operation_id=u'an_op_id',
+        operation_name=u'an_op_name',
+        referer=u'a_referer',
+        service_name=service_name)
+    return info.as_check_request()
+
+
+class TestLoadAsync(unittest2.TestCase):
+    SERVICE_NAME = u'load-async'
+
+    def test_should_create_an_async_client(self):
+        a_client = client.Loaders.DEFAULT.load_async(self.SERVICE_NAME)
+        expect(a_client).to(be_a(async_client.AsyncClient))
+
+
+class TestAsyncClientCheck(unittest2.TestCase):
+    SERVICE_NAME = u'async-check'
+    PROJECT_ID = SERVICE_NAME + u'.project'
+
+    def setUp(self):
+        self._transport = _FakeAsyncTransport()
+        self._subject = client.Loaders.DEFAULT.load_async(
+            self.SERVICE_NAME, transport=self._transport)
+
+    def tearDown(self):
+        _run(self._subject.stop())
+
+    def test_should_send_the_request_if_not_cached(self):
+        req = _make_dummy_check_request(self.PROJECT_ID, self.SERVICE_NAME)
+        resp = sc_messages.CheckResponse(operationId=u'an_op_id')
+        self._transport.check_response = resp
+        expect(_run(self._subject.check(req))).to(equal(resp))
+        expect(len(self._transport.checks)).to(equal(1))
+
+    def test_should_not_send_the_request_if_cached(self):
+        req = _make_dummy_check_request(self.PROJECT_ID, self.SERVICE_NAME)
+        resp = sc_messages.CheckResponse(operationId=u'an_op_id')
+        self._transport.check_response = resp
+        expect(_run(self._subject.check(req))).to(equal(resp))
+        expect(_run(self._subject.check(req))).to(equal(resp))
+        expect(len(self._transport.checks)).to(equal(1))
+
+    def test_should_return_none_if_transport_fails(self):
+        req = _make_dummy_check_request(self.PROJECT_ID, self.SERVICE_NAME)
+        self._transport.error = exceptions.Error()
+        expect(_run(self._subject.check(req))).to(be_none)
+
+    def test_should_send_concurrent_misses_without_blocking(self):
+        reqs = [
+            _make_dummy_check_request(self.PROJECT_ID, self.SERVICE_NAME,
+                                      consumer=u'%d' % (i,))
+            for i in range(20)
+        ]
+        self._transport.check_response = sc_messages.CheckResponse()
+
+        async def check_all():
+            return await asyncio.gather(*[self._subject.check(r) for r in reqs])
+
+        expect(len(_run(check_all()))).to(equal(20))
+        expect(self._transport.max_in_flight).to(equal(20))
+
+    def test_should_coalesce_concurrent_identical_misses(self):
+        reqs = [_make_dummy_check_request(self.PROJECT_ID, self.SERVICE_NAME)
+                for _ in range(5)]
+        resp = sc_messages.CheckResponse(operationId=u'an_op_id')
+        self._transport.check_response = resp
+
+        async def check_all():
+            return await asyncio.gather(*[self._subject.check(r) for r in reqs])
+
+        expect(_run(check_all())).to(equal([resp] * 5))
+        expect(len(self._transport.checks)).to(equal(1))
+        expect(self._subject._check_calls).to(equal({}))
+
+
+class TestAsyncClientQuota(unittest2.TestCase):
+    SERVICE_NAME = u'async-quota'
+    PROJECT_ID = SERVICE_NAME + u'.project'
+
+    def setUp(self):
+        self._transport = _FakeAsyncTransport()
+
+    def tearDown(self):
+        _run(self._subject.stop())
+
+    def test_should_queue_the_request_if_not_cached(self):
+        self._subject = client.Loaders.DEFAULT.load_async(
+            self.SERVICE_NAME, transport=self._transport)
+        req = _make_dummy_quota_request(self.PROJECT_ID, self.SERVICE_NAME)
+        resp = _run(self._subject.allocate_quota(req))
+        expect(resp.operationId).to(equal(
+            req.allocateQuotaRequest.allocateOperation.operationId))
+
+    def test_should_return_dummy_response_if_transport_fails(self):
+        self._subject = client.Loaders.NO_CACHE.load_async(
+            self.SERVICE_NAME, transport=self._transport)
+        req = _make_dummy_quota_request(self.PROJECT_ID, self.SERVICE_NAME)
+        self._transport.error = exceptions.Error()
+        expect(_run(self._subject.allocate_quota(req))).to(
+            equal(sc_messages.AllocateQuotaResponse()))
+
+
+class TestAsyncClientReport(unittest2.TestCase):
+    SERVICE_NAME = u'async-report'
+    PROJECT_ID = SERVICE_NAME + u'.project'
+
+    def setUp(self):
+        self._transport = _FakeAsyncTransport()
+
+    def test_should_not_send_the_request_if_cached(self):
+        subject = client.Loaders.DEFAULT.load_async(
+            self.SERVICE_NAME, transport=self._transport)
+        _run(subject.report(
+            _make_dummy_report_request(self.PROJECT_ID, self.SERVICE_NAME)))
+        expect(len(self._transport.reports)).to(equal(0))
+        _run(subject.stop())
+
+    def test_should_send_a_request_if_not_cached(self):
+        subject = client.Loaders.NO_CACHE.load_async(
+            self.SERVICE_NAME, transport=self._transport)
+        _run(subject.report(
+            _make_dummy_report_request(self.PROJECT_ID, self.SERVICE_NAME)))
+        expect(len(self._transport.reports)).to(equal(1))
+        _run(subject.stop())
+
+    def test_should_send_cached_reports_on_stop(self):
+        subject = client.Loaders.DEFAULT.load_async(
+            self.SERVICE_NAME, transport=self._transport)
+        _run(subject.report(
+            _make_dummy_report_request(self.PROJECT_ID, self.SERVICE_NAME)))
+        _run(subject.stop())
+        expect(len(self._transport.reports)).to(equal(1))
+        sent = self._transport.reports[0]
+        expect(sent).to(be_a(sc_messages.ServicecontrolServicesReportRequest))
+        expect(len(sent.reportRequest.operations)).to(equal(1))
+
+    def test_should_flush_reports_from_a_task(self):
+        options = caches.ReportOptions(
+            flush_interval=datetime.timedelta(milliseconds=10))
+        subject = async_client.AsyncClient(
+            self.SERVICE_NAME, caches.CheckOptions(), caches.QuotaOptions(),
+            options, transport=self._transport)
+
+        async def report_then_wait():
+            await subject.report(
+                _make_dummy_report_request(self.PROJECT_ID, self.SERVICE_NAME))
+            for _ in range(100):
+                if self._transport.reports:
+                    break
+                await asyncio.sleep(0.01)
+
+        _run(report_then_wait())
+        expect(len(self._transport.reports)).to(equal(1))
+        _run(subject.stop())
+
+
+class TestAsyncClientStartAndStop(unittest2.TestCase):
+    SERVICE_NAME = u'async-start-and-stop'
+
+    def test_should_create_flush_tasks_when_started(self):
+        subject = client.Loaders.DEFAULT.load_async(
+            self.SERVICE_NAME, transport=_FakeAsyncTransport())
+
+        async def start():
+            subject.start()
+            return list(subject._flush_tasks)
+
+        tasks = _run(start())
+        expect(len(tasks)).to(equal(3))
+        _run(subject.stop())
+        for task in tasks:
+            expect(task.done()).to(be_true)
+
+    def test_should_not_create_flush_tasks_when_caching_is_disabled(self):
+        subject = client.Loaders.NO_CACHE.load_async(
+            self.SERVICE_NAME, transport=_FakeAsyncTransport())
+
+        async def start():
+            subject.start()
+            return list(subject._flush_tasks)
+
+        expect(_run(start())).to(equal([]))
+        _run(subject.stop())
+
+    def test_should_ignore_stop_if_not_started(self):
+        transport = _FakeAsyncTransport()
+        subject = client.Loaders.DEFAULT.load_async(
+            self.SERVICE_NAME, transport=transport)
+        _run(subject.stop())
+        expect(transport.reports).to(equal([]))
+
+
+class TestExecutorTransport(unittest2.TestCase):
+
+    def test_should_call_the_blocking_transport(self):
+        blocking = mock.MagicMock()
+        blocking.services.Check.return_value = sc_messages.CheckResponse()
+        transport = async_client.ExecutorTransport(
+            create_transport=lambda: blocking)
+        req = _make_dummy_check_request(u'project', u'service')
+        expect(_run(transport.Check(req))).to(
+            equal(sc_messages.CheckResponse()))
+        blocking.services.Check.assert_called_once_with(req)
+        expect(blocking.services.Report.called).to(be_false)
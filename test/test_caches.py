@@ -15,11 +15,13 @@
 from __future__ import absolute_import
 
 from builtins import object
+import cachetools
 import collections
 import datetime
 import unittest2
 
-from expects import be, be_a, be_none, equal, expect, raise_error
+from expects import (be, be_a, be_false, be_none, equal, expect,
+                     raise_error)
 
 from endpoints_management.control import caches, report_request
 
@@ -58,6 +60,16 @@ class TestDequeOutLRUCache(unittest2.TestCase):
         expect(cache.get(2)).to(be_none)
         expect(len(cache.out_deque)).to(be(2))
 
+    def test_swap_out_deque(self):
+        a_deque = collections.deque()
+        cache = caches.DequeOutLRUCache(1, out_deque=a_deque)
+        cache[1] = 1
+        cache[2] = 2
+        expect(cache.swap_out_deque()).to(be(a_deque))
+        expect(list(a_deque)).to(equal([1]))
+        expect(len(cache.out_deque)).to(equal(0))
+        expect(cache.out_deque).not_to(be(a_deque))
+
 
 class _Timer(object):
     def __init__(self, auto=False):
@@ -138,6 +150,143 @@ class TestDequeOutTTLCache(unittest2.TestCase):
         expect(cache[2]).to(equal(2))
         expect(cache.get(1)).to(be_none)
 
+    def test_swap_out_deque_should_include_expired_items(self):
+        cache = caches.DequeOutTTLCache(2, ttl=1, timer=_Timer())
+        cache[1] = 1
+        cache.timer.tick()
+        cache.timer.tick()
+        swapped = cache.swap_out_deque()
+        expect(list(swapped)).to(equal([1]))
+        expect(len(cache.out_deque)).to(equal(0))
+        expect(cache.out_deque).not_to(be(swapped))
+
+
+class TestFrequencySketch(unittest2.TestCase):
+
+    def test_should_estimate_the_number_of_uses(self):
+        sketch = caches.FrequencySketch(100)
+        for _ in range(3):
+            sketch.increment(b'a_key')
+        sketch.increment(b'another_key')
+        expect(sketch.frequency(b'a_key')).to(equal(3))
+        expect(sketch.frequency(b'another_key')).to(equal(1))
+        expect(sketch.frequency(b'an_unused_key')).to(equal(0))
+
+    def test_should_not_count_beyond_the_maximum(self):
+        sketch = caches.FrequencySketch(100)
+        for _ in range(caches.FrequencySketch.MAX_COUNT + 5):
+            sketch.increment(b'a_key')
+        expect(sketch.frequency(b'a_key')).to(
+            equal(caches.FrequencySketch.MAX_COUNT))
+
+    def test_should_halve_the_counts_after_the_sample_size(self):
+        sketch = caches.FrequencySketch(1)  # sample size is 10
+        for _ in range(8):
+            sketch.increment(b'a_key')
+        sketch.increment(b'another_key')
+        expect(sketch.frequency(b'a_key')).to(equal(8))
+        sketch.increment(b'another_key')
+        expect(sketch.frequency(b'a_key')).to(equal(4))
+        expect(sketch.frequency(b'another_key')).to(equal(1))
+
+
+class TestTinyLFUCache(unittest2.TestCase):
+
+    def test_constructor_should_fail_on_bad_deques(self):
+        testf = lambda: caches.TinyLFUCache(_TEST_NUM_ENTRIES,
+                                            out_deque=object())
+        expect(testf).to(raise_error(ValueError))
+
+    def test_constructor_should_accept_deques(self):
+        a_deque = collections.deque()
+        c = caches.TinyLFUCache(_TEST_NUM_ENTRIES, out_deque=a_deque)
+        expect(c.out_deque).to(be(a_deque))
+        expect(caches.TinyLFUCache(_TEST_NUM_ENTRIES).out_deque).to(be_none)
+
+    def test_should_admit_entries_while_there_is_room(self):
+        cache = caches.TinyLFUCache(3, out_deque=collections.deque())
+        for key in (1, 2, 3):
+            cache[key] = key
+        expect(len(cache)).to(equal(3))
+        expect(set(cache)).to(equal({1, 2, 3}))
+        expect(len(cache.out_deque)).to(equal(0))
+
+    def test_should_evict_unused_candidates(self):
+        cache = caches.TinyLFUCache(3, out_deque=collections.deque())
+        for key in (1, 2, 3):
+            cache[key] = key
+            cache.get(key)
+        cache[4] = 4
+        expect(len(cache)).to(equal(3))
+        expect(cache.get(3)).to(be_none)  # 4 pushed the candidate 3 out
+        expect(list(cache.out_deque)).to(equal([3]))
+
+    def test_should_evict_less_used_entries_for_candidates(self):
+        cache = caches.TinyLFUCache(3, out_deque=collections.deque())
+        for key in (1, 2, 3):
+            cache[key] = key
+        for _ in range(2):
+            cache.get(3)
+        cache[4] = 4
+        expect(cache.get(1)).to(be_none)
+        expect(cache.get(3)).to(equal(3))
+        expect(list(cache.out_deque)).to(equal([1]))
+
+    def test_should_keep_used_entries_during_a_scan(self):
+        cache = caches.TinyLFUCache(20, out_deque=collections.deque())
+        hot_keys = list(range(5))
+        for key in hot_keys:
+            for _ in range(3):
+                if cache.get(key) is None:
+                    cache[key] = key
+        for key in range(100, 130):
+            if cache.get(key) is None:
+                cache[key] = key
+        for key in hot_keys:
+            expect(cache.get(key)).to(equal(key))
+        expect(len(cache)).to(equal(20))
+        expect(len(cache.out_deque)).to(equal(15))
+
+    def test_ttl(self):
+        cache = caches.TinyLFUCache(2, ttl=1, timer=_Timer(),
+                                    out_deque=collections.deque())
+        expect(cache.timer()).to(equal(0))
+        expect(cache.ttl).to(equal(1))
+
+        cache[1] = 1
+        expect(set(cache)).to(equal({1}))
+        expect(cache[1]).to(equal(1))
+
+        cache.timer.tick()
+        cache[2] = 2
+        expect(set(cache)).to(equal({1, 2}))
+        expect(len(cache)).to(equal(2))
+
+        cache.timer.tick()
+        expect(1 in cache).to(be_false)
+        expect(cache.get(1)).to(be_none)
+        expect(set(cache)).to(equal({2}))
+        expect(list(cache.out_deque)).to(equal([1]))
+
+    def test_swap_out_deque(self):
+        a_deque = collections.deque()
+        cache = caches.TinyLFUCache(1, out_deque=a_deque)
+        cache[1] = 1
+        cache[2] = 2
+        expect(cache.swap_out_deque()).to(be(a_deque))
+        expect(list(a_deque)).to(equal([1]))
+        expect(len(cache.out_deque)).to(equal(0))
+        expect(cache.out_deque).not_to(be(a_deque))
+        testf = caches.TinyLFUCache(1).swap_out_deque
+        expect(testf).to(raise_error(ValueError))
+
+    def test_values_should_not_record_uses(self):
+        cache = caches.TinyLFUCache(3)
+        cache[1] = 1
+        for _ in range(3):
+            expect(cache.values()).to(equal([1]))
+        expect(cache._sketch.frequency(1)).to(equal(0))
+
 
 class _DateTimeTimer(object):
     def __init__(self, auto=False):
@@ -153,6 +302,17 @@ class _DateTimeTimer(object):
         self.time += datetime.timedelta(seconds=1)
 
 
+class _NanosClock(object):
+    def __init__(self):
+        self.time = 5 * caches.NANOS_PER_SECOND
+
+    def __call__(self):
+        return self.time
+
+    def tick(self):
+        self.time += caches.NANOS_PER_SECOND
+
+
 class TestCreate(unittest2.TestCase):
 
     def test_should_fail_if_bad_options_are_used(self):
@@ -208,6 +368,20 @@ class TestCreate(unittest2.TestCase):
             with sync_cache as cache:
                 expect(cache).to(be_a(caches.DequeOutTTLCache))
 
+    def test_should_use_the_clock_if_one_is_given(self):
+        clock = _NanosClock()
+        sync_cache = caches.create(
+            caches.CheckOptions(num_entries=1,
+                                flush_interval=datetime.timedelta(seconds=1)),
+            timer=_DateTimeTimer(), clock=clock)
+        with sync_cache as cache:
+            expect(cache.timer()).to(equal(5.0))
+            cache[1] = 1
+            clock.tick()
+            expect(cache.get(1)).to(equal(1))
+            clock.tick()
+            expect(cache.get(1)).to(be_none)
+
     def test_should_return_a_lru_cache_if_flush_interval_is_negative(self):
         delta = datetime.timedelta(seconds=-1)
         should_be_ttl = [
@@ -224,6 +398,85 @@ class TestCreate(unittest2.TestCase):
                 expect(cache).to(be_a(caches.DequeOutLRUCache))
 
 
+    def test_should_return_a_tiny_lfu_cache_if_it_is_selected(self):
+        delta = datetime.timedelta(seconds=1)
+        should_be_tiny_lfu = [
+            (lambda: caches.create(caches.CheckOptions(
+                num_entries=1, flush_interval=delta, expiration=2 * delta,
+                eviction_policy=caches.TINY_LFU), timer=_DateTimeTimer()),
+             2.0),
+            (lambda: caches.create(caches.CheckOptions(
+                num_entries=1, flush_interval=-delta,
+                eviction_policy=caches.TINY_LFU)),
+             None),
+        ]
+        for testf, ttl in should_be_tiny_lfu:
+            sync_cache = testf()
+            expect(sync_cache).to(be_a(caches.LockedObject))
+            with sync_cache as cache:
+                expect(cache).to(be_a(caches.TinyLFUCache))
+                expect(cache.ttl).to(equal(ttl))
+                expect(cache.out_deque).to(be_a(collections.deque))
+
+        sync_cache = caches.create(
+            caches.QuotaOptions(num_entries=1, eviction_policy=caches.TINY_LFU),
+            use_deque=False)
+        with sync_cache as cache:
+            expect(cache).to(be_a(caches.TinyLFUCache))
+            expect(cache.out_deque).to(be_none)
+
+    def test_should_return_a_sharded_cache_if_there_are_many_shards(self):
+        delta = datetime.timedelta(seconds=1)
+        should_be_sharded = [
+            (lambda: caches.create(caches.CheckOptions(
+                num_entries=10, flush_interval=delta, num_shards=4)),
+             caches.DequeOutTTLCache),
+            (lambda: caches.create(caches.QuotaOptions(
+                num_entries=10, flush_interval=delta, num_shards=4),
+                use_deque=False), cachetools.TTLCache),
+            (lambda: caches.create(caches.ReportOptions(
+                num_entries=10, flush_interval=-delta, num_shards=4)),
+             caches.DequeOutLRUCache),
+        ]
+        for testf, cache_cls in should_be_sharded:
+            sharded = testf()
+            expect(sharded).to(be_a(caches.ShardedCache))
+            expect(len(sharded.shards)).to(equal(4))
+            expect(caches.shards_of(sharded)).to(equal(sharded.shards))
+            for shard in sharded.shards:
+                expect(shard).to(be_a(caches.LockedObject))
+                with shard as cache:
+                    expect(cache).to(be_a(cache_cls))
+                    expect(cache.maxsize).to(equal(3))
+
+    def test_should_select_the_same_shard_for_a_key(self):
+        sharded = caches.create(caches.CheckOptions(num_shards=8))
+        for key in (b'a_key', b'another_key', u'a_unicode_key'):
+            shard = caches.shard_for(sharded, key)
+            expect(shard).to(be(sharded.shard(key)))
+            expect(caches.shard_for(sharded, key)).to(be(shard))
+
+    def test_should_treat_an_unsharded_cache_as_a_single_shard(self):
+        sync_cache = caches.create(caches.CheckOptions())
+        expect(sync_cache).to(be_a(caches.LockedObject))
+        expect(caches.shard_for(sync_cache, b'a_key')).to(be(sync_cache))
+        expect(caches.shards_of(sync_cache)).to(equal((sync_cache,)))
+
+
+class TestToClockInterval(unittest2.TestCase):
+
+    def test_should_convert_to_nanoseconds(self):
+        delta = datetime.timedelta(days=1, seconds=2, microseconds=3)
+        expect(caches.to_clock_interval(delta, caches.monotonic_nanos)).to(
+            equal(86402000003000))
+
+    def test_should_not_convert_without_a_clock(self):
+        delta = datetime.timedelta(seconds=2)
+        expect(caches.to_clock_interval(delta, None)).to(equal(delta))
+        expect(caches.to_clock_interval(None, caches.monotonic_nanos)).to(
+            be_none)
+
+
 class TestReportOptions(unittest2.TestCase):
 
     def test_should_create_with_defaults(self):
@@ -232,6 +485,12 @@ class TestReportOptions(unittest2.TestCase):
             caches.ReportOptions.DEFAULT_NUM_ENTRIES))
         expect(options.flush_interval).to(equal(
             caches.ReportOptions.DEFAULT_FLUSH_INTERVAL))
+        expect(options.num_shards).to(equal(
+            caches.ReportOptions.DEFAULT_NUM_SHARDS))
+        expect(options.max_log_entries).to(be_none)
+        expect(options.dedupe_log_entries).to(be_false)
+        expect(options.log_sample_rate).to(equal(1.0))
+        expect(options.max_request_bytes).to(be_none)
 
 
 class TestCheckOptions(unittest2.TestCase):
@@ -246,6 +505,9 @@ class TestCheckOptions(unittest2.TestCase):
             caches.CheckOptions.DEFAULT_FLUSH_INTERVAL))
         expect(options.expiration).to(equal(
             caches.CheckOptions.DEFAULT_EXPIRATION))
+        expect(options.num_shards).to(equal(
+            caches.CheckOptions.DEFAULT_NUM_SHARDS))
+        expect(options.max_staleness).to(be_none)
 
     def test_should_ignores_lower_expiration(self):
         wanted_expiration = (
@@ -19,9 +19,13 @@ standard_library.install_aliases()
 from builtins import object
 import datetime
 import http.client
+import threading
 import unittest2
 from operator import attrgetter
-from expects import be_none, equal, expect, raise_error
+
+import mock
+from expects import (be_empty, be_false, be_none, be_true, equal, expect,
+                     raise_error)
 
 from apitools.base.py import encoding
 
@@ -314,6 +318,32 @@ class TestCachingAggregator(unittest2.TestCase):
         self.timer.tick() # now past expiry
         expect(len(agg.flush())).to(equal(1)) # got the cached check request
 
+    def test_should_not_hold_the_cache_locks_while_extracting_requests(self):
+        req = _make_test_request(self.SERVICE_NAME)
+        fake_response = sc_messages.CheckResponse(
+            operationId=self.FAKE_OPERATION_ID
+        )
+        agg = self.agg
+        expect(agg.check(req)).to(be_none)
+        agg.add_response(req, fake_response)
+        expect(agg.check(req)).to(equal(fake_response))
+        for _ in range(3):
+            self.timer.tick() # now past expiry
+
+        locked = []
+        extract_request = check_request.CachedItem.extract_request
+
+        def checking_extract_request(item):
+            locked.extend(_is_locked(shard)
+                          for shard in caches.shards_of(agg._cache))
+            return extract_request(item)
+
+        with mock.patch.object(check_request.CachedItem, u'extract_request',
+                               checking_extract_request):
+            expect(len(agg.flush())).to(equal(1))
+        expect(locked).not_to(be_empty)
+        expect(any(locked)).to(be_false)
+
     def test_should_clear_requests(self):
         req = _make_test_request(self.SERVICE_NAME)
         fake_response = sc_messages.CheckResponse(
@@ -436,6 +466,156 @@ _INCOMPLETE_INFO_TESTS = [
 KEYGETTER = attrgetter(u'key')
 
 
+class TestShardedCachingAggregator(TestCachingAggregator):
+
+    def setUp(self):
+        self.timer = _DateTimeTimer()
+        self.expiration = datetime.timedelta(seconds=2)
+        options = caches.CheckOptions(
+            flush_interval=datetime.timedelta(seconds=1),
+            expiration=self.expiration,
+            num_shards=4)
+        self.agg = check_request.Aggregator(
+            self.SERVICE_NAME, options, timer=self.timer)
+
+
+class TestClockedCachingAggregator(TestCachingAggregator):
+
+    def setUp(self):
+        self.timer = _NanosClock()
+        self.expiration = datetime.timedelta(seconds=2)
+        options = caches.CheckOptions(
+            flush_interval=datetime.timedelta(seconds=1),
+            expiration=self.expiration)
+        self.agg = check_request.Aggregator(
+            self.SERVICE_NAME, options, clock=self.timer)
+
+
+class TestTinyLFUCachingAggregator(TestCachingAggregator):
+
+    def setUp(self):
+        self.timer = _DateTimeTimer()
+        self.expiration = datetime.timedelta(seconds=2)
+        options = caches.CheckOptions(
+            flush_interval=datetime.timedelta(seconds=1),
+            expiration=self.expiration,
+            eviction_policy=caches.TINY_LFU)
+        self.agg = check_request.Aggregator(
+            self.SERVICE_NAME, options, timer=self.timer)
+
+
+class TestStaleWhileRevalidateAggregator(unittest2.TestCase):
+    SERVICE_NAME = u'service.with_stale_responses'
+    FAKE_OPERATION_ID = u'service.with_stale_responses.op_id'
+
+    def setUp(self):
+        self.timer = _DateTimeTimer()
+        options = caches.CheckOptions(
+            flush_interval=datetime.timedelta(seconds=1),
+            expiration=datetime.timedelta(seconds=5),
+            max_staleness=datetime.timedelta(seconds=3))
+        self.agg = check_request.Aggregator(
+            self.SERVICE_NAME, options, timer=self.timer)
+
+    def _add_cached_response(self, req):
+        fake_response = sc_messages.CheckResponse(
+            operationId=self.FAKE_OPERATION_ID)
+        expect(self.agg.check(req)).to(be_none)
+        self.agg.add_response(req, fake_response)
+        return fake_response
+
+    def test_should_return_stale_responses_after_flush_interval(self):
+        req = _make_test_request(self.SERVICE_NAME)
+        fake_response = self._add_cached_response(req)
+        self.timer.tick()
+        self.timer.tick()
+        expect(self.agg.check(req)).to(equal(fake_response))
+        expect(self.agg.check(req)).to(equal(fake_response))
+
+    def test_should_flush_one_refresh_request(self):
+        req = _make_test_request(self.SERVICE_NAME)
+        self._add_cached_response(req)
+        agg = self.agg
+        expect(agg.flush()).to(equal([]))
+        self.timer.tick()
+        agg.check(req)
+        agg.check(req)
+        flushed = agg.flush()
+        expect(len(flushed)).to(equal(1))
+        expect(flushed[0].checkRequest.operation.operationName).to(
+            equal(req.checkRequest.operation.operationName))
+        agg.check(req)
+        expect(agg.flush()).to(equal([]))
+
+    def test_should_use_the_refreshed_response(self):
+        req = _make_test_request(self.SERVICE_NAME)
+        self._add_cached_response(req)
+        agg = self.agg
+        self.timer.tick()
+        agg.check(req)
+        refreshed = sc_messages.CheckResponse(operationId=u'refreshed')
+        agg.add_response(agg.flush()[0], refreshed)
+        expect(agg.check(req)).to(equal(refreshed))
+        expect(agg.flush()).to(equal([]))
+
+    def test_should_signal_a_resend_after_max_staleness(self):
+        req = _make_test_request(self.SERVICE_NAME)
+        self._add_cached_response(req)
+        agg = self.agg
+        self.timer.tick()
+        agg.check(req)
+        agg.flush()  # the refresh is lost
+        self.timer.tick()
+        self.timer.tick()
+        expect(agg.check(req)).to(be_none)
+
+    def test_should_be_flushed_every_flush_interval(self):
+        expect(self.agg.flush_interval).to(
+            equal(datetime.timedelta(seconds=1)))
+
+    def test_should_keep_responses_cached_while_they_are_refreshed(self):
+        req = _make_test_request(self.SERVICE_NAME)
+        fake_response = self._add_cached_response(req)
+        signature = check_request.sign(req.checkRequest)
+        self.timer.tick()
+        self.timer.tick()
+        expect(self.agg.check(req)).to(equal(fake_response))
+        for _ in range(4):
+            self.timer.tick()  # past the expiration of the cached response
+        with self.agg._cache as cache:
+            expect(signature in cache).to(be_true)
+
+    def test_should_not_return_stale_error_responses(self):
+        req = _make_test_request(self.SERVICE_NAME)
+        error = sc_messages.CheckError(
+            code=sc_messages.CheckError.CodeValueValuesEnum.PROJECT_DELETED)
+        self.agg.add_response(
+            req, sc_messages.CheckResponse(checkErrors=[error]))
+        self.timer.tick()
+        expect(self.agg.check(req)).to(be_none)
+
+    def test_should_discard_refresh_requests_on_clear(self):
+        req = _make_test_request(self.SERVICE_NAME)
+        self._add_cached_response(req)
+        self.timer.tick()
+        self.agg.check(req)
+        self.agg.clear()
+        expect(self.agg.flush()).to(equal([]))
+
+
+class TestClockedStaleWhileRevalidateAggregator(
+        TestStaleWhileRevalidateAggregator):
+
+    def setUp(self):
+        self.timer = _NanosClock()
+        options = caches.CheckOptions(
+            flush_interval=datetime.timedelta(seconds=1),
+            expiration=datetime.timedelta(seconds=5),
+            max_staleness=datetime.timedelta(seconds=3))
+        self.agg = check_request.Aggregator(
+            self.SERVICE_NAME, options, clock=self.timer)
+
+
 class TestInfo(unittest2.TestCase):
 
     def test_should_construct_with_no_args(self):
@@ -505,3 +685,31 @@ class _DateTimeTimer(object):
 
     def tick(self):
         self.time += datetime.timedelta(seconds=1)
+
+
+class _NanosClock(object):
+    def __init__(self):
+        self.time = 1234567
+
+    def __call__(self):
+        return self.time
+
+    def tick(self):
+        self.time += caches.NANOS_PER_SECOND
+
+
+def _is_locked(locked_object):
+    """Determines if another thread holds the lock of a LockedObject."""
+    # pylint: disable=protected-access
+    result = []
+
+    def try_lock():
+        acquired = locked_object._lock.acquire(False)
+        if acquired:
+            locked_object._lock.release()
+        result.append(not acquired)
+
+    thread = threading.Thread(target=try_lock)
+    thread.start()
+    thread.join()
+    return result[0]
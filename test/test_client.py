@@ -22,11 +22,14 @@ import datetime
 import mock
 import os
 import tempfile
+import threading
+import time
 import unittest2
-from expects import be_false, be_none, be_true, expect, equal, raise_error
+from expects import be_a, be_false, be_none, be_true, expect, equal, raise_error
 
 from endpoints_management.control import (
-    caches, check_request, client, quota_request, report_request, sc_messages
+    caches, check_request, client, flush_dispatch, quota_request,
+    report_request, sc_messages, transport_pool
 )
 
 
@@ -187,6 +190,80 @@ class TestClientStartAndStop(unittest2.TestCase):
         self._subject.start()
         expect(len(thread_class.call_args_list)).to(equal(1))
 
+    def test_should_prewarm_the_transport_when_flushing_starts(self):
+        pool = mock.MagicMock(spec=transport_pool.TransportPool)
+        subject = client.Loaders.DEFAULT.load(self.SERVICE_NAME,
+                                              create_transport=pool)
+        subject._scheduler = mock.MagicMock()
+        with mock.patch.object(subject, u'_initialize_flushing'):
+            subject._schedule_flushes()
+        expect(pool.prewarm.call_count).to(equal(1))
+        expect(subject._scheduler.run.called).to(be_true)
+
+    def test_should_send_flushed_requests_with_the_dispatcher(self):
+        subject = client.Loaders.DEFAULT.load(
+            self.SERVICE_NAME,
+            create_transport=lambda: self._mock_transport,
+            flush_options=flush_dispatch.FlushOptions())
+        subject._flush_dispatcher = mock.MagicMock(
+            spec=flush_dispatch.Dispatcher)
+        req = _make_dummy_report_request(self.PROJECT_ID, self.SERVICE_NAME)
+        interval = datetime.timedelta(seconds=1)
+        subject._send_flushed(flush_dispatch.REPORT,
+                              subject._send_flushed_report, [req], interval)
+        subject._flush_dispatcher.send_all.assert_called_once_with(
+            flush_dispatch.REPORT, subject._send_flushed_report, [req],
+            interval, on_unsent=None)
+        expect(self._mock_transport.services.Report.called).to(be_false)
+
+    def test_should_return_unsent_quota_refreshes_to_the_aggregator(self):
+        subject = client.Loaders.DEFAULT.load(
+            self.SERVICE_NAME,
+            create_transport=lambda: self._mock_transport,
+            flush_options=flush_dispatch.FlushOptions())
+        subject._flush_dispatcher = mock.MagicMock(
+            spec=flush_dispatch.Dispatcher)
+        subject._scheduler = mock.MagicMock()
+        subject._flush_schedule_quota_aggregator()
+        _, kw = subject._flush_dispatcher.send_all.call_args
+        expect(kw[u'on_unsent']).to(equal(
+            subject._quota_aggregator.add_unsent))
+
+    @mock.patch(u"endpoints_management.control.client._THREAD_CLASS", spec=True)
+    def test_should_shut_down_the_dispatcher_on_stop(self, dummy_thread_class):
+        subject = client.Loaders.DEFAULT.load(
+            self.SERVICE_NAME,
+            create_transport=lambda: self._mock_transport,
+            flush_options=flush_dispatch.FlushOptions())
+        subject.start()
+        dispatcher = mock.MagicMock(spec=flush_dispatch.Dispatcher)
+        subject._flush_dispatcher = dispatcher
+        subject.stop()
+        expect(dispatcher.shutdown.called).to(be_true)
+        expect(subject._flush_dispatcher).to(be_none)
+
+    @mock.patch(u"endpoints_management.control.client._THREAD_CLASS", spec=True)
+    def test_should_recreate_the_dispatcher_on_restart(self, dummy_thread_class):
+        subject = client.Loaders.DEFAULT.load(
+            self.SERVICE_NAME,
+            create_transport=lambda: self._mock_transport,
+            flush_options=flush_dispatch.FlushOptions())
+        subject.start()
+        subject.stop()
+        subject._running = False  # the mock thread never runs the scheduler
+        subject.start()
+        expect(subject._flush_dispatcher).to(
+            be_a(flush_dispatch.Dispatcher))
+        subject.stop()
+
+    def test_should_time_flushes_with_the_clock(self):
+        clock = mock.MagicMock(return_value=3 * caches.NANOS_PER_SECOND)
+        subject = client.Loaders.DEFAULT.load(
+            self.SERVICE_NAME,
+            create_transport=lambda: self._mock_transport,
+            clock=clock)
+        expect(subject._timer()).to(equal(3.0))
+
     def test_should_noop_stop_if_not_started(self):
         # stop the subject, the transport should not see a request
         self._subject.stop()
@@ -269,6 +346,83 @@ class TestClientCheck(unittest2.TestCase):
         self._mock_transport.services.Check.side_effect = exceptions.Error()
         expect(self._subject.check(dummy_request)).to(be_none)
 
+    def _check_concurrently(self, reqs):
+        t = self._mock_transport
+        sending = threading.Event()
+        release = threading.Event()
+
+        def blocking_check(req):
+            sending.set()
+            release.wait()
+            return sc_messages.CheckResponse(
+                operationId=req.checkRequest.operation.operationId)
+
+        t.services.Check.side_effect = blocking_check
+        results = [None] * len(reqs)
+
+        def check(i):
+            results[i] = self._subject.check(reqs[i])
+
+        first = threading.Thread(target=check, args=(0,))
+        first.start()
+        sending.wait()
+        others = [threading.Thread(target=check, args=(i,))
+                  for i in range(1, len(reqs))]
+        for thread in others:
+            thread.start()
+        time.sleep(0.1)  # let the other threads reach the in-flight check
+        release.set()
+        for thread in [first] + others:
+            thread.join()
+        return results
+
+    @mock.patch(u"endpoints_management.control.client._THREAD_CLASS", spec=True)
+    def test_should_coalesce_concurrent_identical_misses(self, dummy_thread_class):
+        self._subject.start()
+        reqs = [_make_dummy_check_request(self.PROJECT_ID, self.SERVICE_NAME)
+                for _ in range(5)]
+        results = self._check_concurrently(reqs)
+        expect(self._mock_transport.services.Check.call_count).to(equal(1))
+        for result in results:
+            expect(result).to(equal(results[0]))
+
+    @mock.patch(u"endpoints_management.control.client._THREAD_CLASS", spec=True)
+    def test_should_not_coalesce_distinct_misses(self, dummy_thread_class):
+        self._subject.start()
+        reqs = [_make_dummy_check_request(self.PROJECT_ID + u'%d' % (i,),
+                                          self.SERVICE_NAME)
+                for i in range(3)]
+        self._check_concurrently(reqs)
+        expect(self._mock_transport.services.Check.call_count).to(equal(3))
+
+    @mock.patch(u"endpoints_management.control.client._THREAD_CLASS", spec=True)
+    def test_should_not_coalesce_important_operations(self, dummy_thread_class):
+        self._subject.start()
+        reqs = [_make_dummy_check_request(self.PROJECT_ID, self.SERVICE_NAME)
+                for _ in range(3)]
+        for req in reqs:
+            req.checkRequest.operation.importance = (
+                sc_messages.Operation.ImportanceValueValuesEnum.HIGH)
+        self._check_concurrently(reqs)
+        expect(self._mock_transport.services.Check.call_count).to(equal(3))
+
+
+class TestSingleFlight(unittest2.TestCase):
+
+    def test_should_return_the_result_of_the_call(self):
+        expect(client._SingleFlight().call(u'key', lambda x: x + 1, 1)).to(
+            equal(2))
+
+    def test_should_raise_the_error_of_the_call(self):
+        def fail():
+            raise ValueError()
+
+        single_flight = client._SingleFlight()
+        expect(lambda: single_flight.call(u'key', fail)).to(
+            raise_error(ValueError))
+        # the failed call is no longer in flight
+        expect(single_flight.call(u'key', lambda: 1)).to(equal(1))
+
 
 class TestClientQuota(unittest2.TestCase):
     SERVICE_NAME = u'quota'
@@ -295,8 +449,8 @@ class TestClientQuota(unittest2.TestCase):
         dummy_request = _make_dummy_quota_request(self.PROJECT_ID,
                                                   self.SERVICE_NAME)
         resp = self._subject.allocate_quota(dummy_request)
-        with self._subject._quota_aggregator._out as out_deque:
-            expect(out_deque[0]).to(equal(dummy_request))
+        out_deque = self._subject._quota_aggregator._out
+        expect(out_deque[0]).to(equal(dummy_request))
         expect(resp.operationId).to(equal(
             dummy_request.allocateQuotaRequest.allocateOperation.operationId))
 
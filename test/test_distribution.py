@@ -44,6 +44,23 @@ class TestCreateExponential(unittest2.TestCase):
         expect(len(got.bucketCounts)).to(equal(num_finite_buckets + 2))
 
 
+class TestExponentialSampler(unittest2.TestCase):
+
+    def test_should_fail_if_the_args_are_bad(self):
+        for args in ((0, 1.1, 0.1), (1, 0.9, 0.1), (1, 1.1, -0.1)):
+            testf = lambda: distribution.exponential_sampler(*args)
+            expect(testf).to(raise_error(ValueError))
+
+    def test_should_match_a_created_distribution_with_a_sample(self):
+        args = (3, 2.0, 0.1)
+        sampler = distribution.exponential_sampler(*args)
+        for t in _TEST_SAMPLES_AND_BUCKETS:
+            sample = t[u'samples'][0]
+            want = distribution.create_exponential(*args)
+            distribution.add_sample(sample, want)
+            expect(sampler(sample)).to(equal(want))
+
+
 class TestCreateLinear(unittest2.TestCase):
 
     def test_should_fail_if_num_finite_buckets_is_bad(self):
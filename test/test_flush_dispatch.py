@@ -0,0 +1,178 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+from builtins import object
+from builtins import range
+import datetime
+import threading
+import time
+import unittest2
+from expects import equal, expect
+
+from endpoints_management.control import flush_dispatch
+
+
+class _Sender(object):
+    """Records the requests it sends, blocking each until it is released."""
+
+    def __init__(self, blocked=False):
+        self.sent = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.release = threading.Event()
+        if not blocked:
+            self.release.set()
+        self._lock = threading.Lock()
+
+    def __call__(self, req):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.in_flight, self.max_in_flight)
+        self.release.wait(5)
+        with self._lock:
+            self.in_flight -= 1
+            self.sent.append(req)
+
+
+class TestFlushOptions(unittest2.TestCase):
+
+    def test_should_create_with_defaults(self):
+        options = flush_dispatch.FlushOptions()
+        expect(options.check_concurrency).to(equal(
+            flush_dispatch.FlushOptions.DEFAULT_CHECK_CONCURRENCY))
+        expect(options.quota_concurrency).to(equal(
+            flush_dispatch.FlushOptions.DEFAULT_QUOTA_CONCURRENCY))
+        expect(options.report_concurrency).to(equal(
+            flush_dispatch.FlushOptions.DEFAULT_REPORT_CONCURRENCY))
+        expect(options.deadline).to(equal(None))
+
+
+class _Timer(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _wait_for(predicate):
+    for _ in range(500):
+        if predicate():
+            return
+        time.sleep(0.01)
+
+
+class TestDispatcher(unittest2.TestCase):
+    A_LONG_TIME = datetime.timedelta(seconds=5)
+    A_SECOND = datetime.timedelta(seconds=1)
+
+    def setUp(self):
+        self._timer = _Timer()
+
+    def _make_dispatcher(self, **kw):
+        return flush_dispatch.Dispatcher(flush_dispatch.FlushOptions(**kw),
+                                         timer=self._timer)
+
+    def test_should_send_all_the_requests(self):
+        subject = self._make_dispatcher()
+        send = _Sender()
+        overdue = subject.send_all(flush_dispatch.CHECK, send, list(range(10)),
+                                   self.A_LONG_TIME)
+        expect(overdue).to(equal(0))
+        subject.shutdown()
+        expect(sorted(send.sent)).to(equal(list(range(10))))
+
+    def test_should_bound_the_concurrency_of_each_kind(self):
+        subject = self._make_dispatcher(report_concurrency=3)
+        send = _Sender(blocked=True)
+        threading.Timer(0.1, send.release.set).start()
+        subject.send_all(flush_dispatch.REPORT, send, list(range(10)),
+                         self.A_LONG_TIME)
+        subject.shutdown()
+        expect(len(send.sent)).to(equal(10))
+        expect(send.max_in_flight).to(equal(3))
+
+    def test_should_not_wait_for_the_requests_to_be_sent(self):
+        subject = self._make_dispatcher()
+        send = _Sender(blocked=True)
+        subject.send_all(flush_dispatch.REPORT, send, list(range(3)),
+                         self.A_LONG_TIME)
+        expect(send.sent).to(equal([]))
+        send.release.set()
+        subject.shutdown()
+        expect(sorted(send.sent)).to(equal(list(range(3))))
+
+    def test_should_cancel_overdue_sends_that_can_be_returned(self):
+        subject = self._make_dispatcher(quota_concurrency=1,
+                                        deadline=self.A_SECOND)
+        send = _Sender(blocked=True)
+        unsent = []
+        subject.send_all(flush_dispatch.QUOTA, send, list(range(3)),
+                         on_unsent=unsent.append)
+        _wait_for(lambda: send.in_flight == 1)
+        expect(subject.send_all(flush_dispatch.QUOTA, send, [])).to(equal(0))
+        self._timer.now = 2.0
+        expect(subject.send_all(flush_dispatch.QUOTA, send, [])).to(equal(3))
+        expect(unsent).to(equal([1, 2]))
+        send.release.set()
+        subject.shutdown()
+        # only the send that had started by the deadline completed
+        expect(send.sent).to(equal([0]))
+
+    def test_should_not_cancel_overdue_sends_that_cannot_be_returned(self):
+        subject = self._make_dispatcher(report_concurrency=1,
+                                        deadline=self.A_SECOND)
+        send = _Sender(blocked=True)
+        subject.send_all(flush_dispatch.REPORT, send, list(range(3)))
+        self._timer.now = 2.0
+        expect(subject.send_all(flush_dispatch.REPORT, send,
+                                [u'next'])).to(equal(3))
+        send.release.set()
+        subject.shutdown()
+        expect(send.sent).to(equal([0, 1, 2, u'next']))
+
+    def test_should_use_the_flush_interval_if_there_is_no_deadline(self):
+        subject = self._make_dispatcher()
+        send = _Sender(blocked=True)
+        subject.send_all(flush_dispatch.CHECK, send, [1], self.A_SECOND)
+        self._timer.now = 0.5
+        expect(subject.send_all(flush_dispatch.CHECK, send, [])).to(equal(0))
+        self._timer.now = 1.5
+        expect(subject.send_all(flush_dispatch.CHECK, send, [])).to(equal(1))
+        send.release.set()
+        subject.shutdown()
+
+    def test_should_not_queue_checks_behind_reports(self):
+        subject = self._make_dispatcher(report_concurrency=1)
+        reports = _Sender(blocked=True)
+        subject.send_all(flush_dispatch.REPORT, reports, list(range(100)),
+                         self.A_LONG_TIME)
+        checks = _Sender()
+        subject.send_all(flush_dispatch.CHECK, checks, [u'check'],
+                         self.A_LONG_TIME)
+        _wait_for(lambda: checks.sent)
+        expect(checks.sent).to(equal([u'check']))
+        expect(reports.in_flight).to(equal(1))
+        reports.release.set()
+        subject.shutdown()
+
+    def test_should_send_on_the_calling_thread_after_shutdown(self):
+        subject = self._make_dispatcher()
+        subject.shutdown()
+        send = _Sender()
+        subject.send_all(flush_dispatch.REPORT, send, [1, 2])
+        expect(send.sent).to(equal([1, 2]))
@@ -15,13 +15,14 @@
 from __future__ import absolute_import
 
 from builtins import object
+from apitools.base.py import encoding
 import base64
 import datetime
 import unittest2
 from expects import be_none, be_true, expect, equal, raise_error
 
-from endpoints_management.control import (label_descriptor, sm_messages,
-                                          report_request)
+from endpoints_management.control import (label_descriptor, sc_messages,
+                                          sm_messages, report_request)
 
 _KNOWN = label_descriptor.KnownLabels
 ValueType = label_descriptor.ValueType
@@ -66,6 +67,15 @@ class KnownLabelsBase(object):
         self.SUBJECT.do_labels_update(self.GIVEN_INFO, given_dict)
         expect(given_dict).to(equal(self.WANTED_LABEL_DICT))
 
+    def test_should_update_request_info_using_a_bound_setter(self):
+        given_dict = {}
+        set_label = self.SUBJECT.bind()
+        if set_label:
+            set_label(self.GIVEN_INFO, given_dict)
+        else:
+            expect(self.SUBJECT.update_label_func).to(be_none)
+        expect(given_dict).to(equal(self.WANTED_LABEL_DICT))
+
 
 class TestCredentialIdWithNoCreds(KnownLabelsBase, unittest2.TestCase):
     SUBJECT = _KNOWN.CREDENTIAL_ID
@@ -268,3 +278,24 @@ class SccUserAgent(KnownLabelsBase, unittest2.TestCase):
 class SccConsumerProject(KnownLabelsBase, unittest2.TestCase):
     SUBJECT = _KNOWN.SCC_CONSUMER_PROJECT
     WANTED_LABEL_DICT = {SUBJECT.label_name: "1234"}
+
+
+class TestLabelsMessage(unittest2.TestCase):
+    LABELS_CLASS = sc_messages.Operation.LabelsValue
+
+    def test_should_match_py_value_to_message(self):
+        labels = {u'a_label': u'a_value', u'b_label': u'b_value'}
+        expect(label_descriptor.labels_message(self.LABELS_CLASS, labels)).to(
+            equal(encoding.PyValueToMessage(self.LABELS_CLASS, labels)))
+
+    def test_should_accept_pairs(self):
+        pairs = [(u'b_label', u'b_value'), (u'a_label', u'a_value')]
+        got = label_descriptor.labels_message(self.LABELS_CLASS, pairs)
+        expect([(p.key, p.value) for p in got.additionalProperties]).to(
+            equal(pairs))
+
+    def test_should_decode_bytes_values(self):
+        labels = {u'a_label': b'apiKey:dummy_api_key'}
+        got = label_descriptor.labels_message(self.LABELS_CLASS, labels)
+        expect(got.additionalProperties[0].value).to(
+            equal(u'apiKey:dummy_api_key'))
@@ -92,6 +92,12 @@ class KnownMetricsBase(object):
         self.SUBJECT.do_operation_update(self.GIVEN_INFO, an_op)
         expect(an_op).to(equal(wanted_op))
 
+    def test_should_update_request_info_using_a_bound_setter(self):
+        an_op = self._base_operation()
+        wanted_op = self._wanted_operation()
+        self.SUBJECT.bind()(self.GIVEN_INFO, an_op)
+        expect(an_op).to(equal(wanted_op))
+
 
 class KnownMetricsInvalidApiKey(KnownMetricsBase):
     GIVEN_INFO = _given_info(KnownMetricsBase.WANTED_SIZE,
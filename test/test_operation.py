@@ -19,7 +19,11 @@ import datetime
 import unittest2
 from expects import be_none, expect, equal, raise_error
 
-from endpoints_management.control import (metric_value, operation, sc_messages,
+from apitools.base.py import encoding
+
+from endpoints_management.control import (label_descriptor, metric_descriptor,
+                                          metric_value, operation,
+                                          report_request, sc_messages,
                                           timestamp)
 from endpoints_management.control import MetricKind
 
@@ -305,6 +309,178 @@ class TestOperationAggregation(unittest2.TestCase):
                 raise AssertionError(u'Failed to {0}\n{1}'.format(desc, e))
 
 
+# operation.Aggregator changes the metric values it merges, so
+# CompactAggregator is tested with copies made before any tests run
+_COMPACT_TESTS = [
+    dict(t,
+         initial=encoding.CopyProtoMessage(t[u'initial']),
+         ops=[encoding.CopyProtoMessage(o) for o in t[u'ops']])
+    for t in _TESTS
+]
+
+
+class TestCompactOperationAggregation(unittest2.TestCase):
+
+    def test_should_aggregate_as_expected(self):
+        for t in _COMPACT_TESTS:
+            desc = t[u'description']
+            initial = t[u'initial']
+            want = t[u'want']
+            agg = operation.CompactAggregator(initial, kinds=t[u'kinds'])
+            for o in t[u'ops']:
+                agg.add(o)
+                got = agg.as_operation()
+            try:
+                expect(got).to(equal(want))
+            except AssertionError as e:
+                raise AssertionError(u'Failed to {0}\n{1}'.format(desc, e))
+
+    def test_should_aggregate_like_the_aggregator(self):
+        ops = [_make_report_operation(*args) for args in (
+            (200, 10, 0.1), (200, 20, 0.2), (404, 30, 1.3), (200, 40, 0.4))]
+        agg = operation.Aggregator(ops[0])
+        compact_agg = operation.CompactAggregator(_make_report_operation(
+            200, 10, 0.1))
+        for op in ops[1:]:
+            compact_agg.add(encoding.CopyProtoMessage(op))
+            agg.add(op)
+        want = agg.as_operation()
+        got = compact_agg.as_operation()
+        expect(len(got.metricValueSets)).to(equal(len(want.metricValueSets)))
+        expect(got).to(equal(want))
+
+    def test_should_not_change_the_operations_it_aggregates(self):
+        initial = _make_report_operation(200, 10, 0.1)
+        other = _make_report_operation(200, 20, 0.2)
+        initial_copy = encoding.CopyProtoMessage(initial)
+        other_copy = encoding.CopyProtoMessage(other)
+        agg = operation.CompactAggregator(initial)
+        agg.add(other)
+        agg.as_operation()
+        expect(initial).to(equal(initial_copy))
+        expect(other).to(equal(other_copy))
+
+    def test_should_fail_to_merge_incompatible_values(self):
+        def make_op(**kw):
+            return sc_messages.Operation(
+                startTime=_EARLY,
+                endTime=_LATER,
+                metricValueSets=[
+                    sc_messages.MetricValueSet(
+                        metricName=u'some_values',
+                        metricValues=[metric_value.create(labels=_TEST_LABELS,
+                                                          **kw)])])
+        agg = operation.CompactAggregator(make_op(doubleValue=_A_FLOAT_VALUE))
+        testf = lambda: agg.add(make_op(int64Value=1))
+        expect(testf).to(raise_error(ValueError))
+
+
+def _make_logged_operation(when, text=u'a message', **kw):
+    return sc_messages.Operation(
+        startTime=when,
+        endTime=when,
+        logEntries=[sc_messages.LogEntry(
+            name=u'a_log',
+            timestamp=when,
+            textPayload=text,
+            structPayload=encoding.PyValueToMessage(
+                sc_messages.LogEntry.StructPayloadValue, dict(
+                    timestamp=when, http_response_code=200, **kw)))])
+
+
+class TestCompactAggregationOfLogEntries(unittest2.TestCase):
+
+    def _aggregate(self, ops, **kw):
+        agg = operation.CompactAggregator(
+            ops[0], log_limits=operation.LogEntryLimits(**kw))
+        for op in ops[1:]:
+            agg.add(op)
+        return agg
+
+    def test_should_keep_all_entries_without_limits(self):
+        agg = self._aggregate([_make_logged_operation(_EARLY)
+                               for _ in range(5)])
+        expect(len(agg.as_operation().logEntries)).to(equal(5))
+        expect(agg.dropped_log_entries).to(equal(0))
+
+    def test_should_keep_at_most_max_entries(self):
+        ops = [_make_logged_operation(_EARLY, text=u'message %d' % (i,))
+               for i in range(20)]
+        agg = self._aggregate(ops, max_entries=3)
+        got = agg.as_operation().logEntries
+        expect(len(got)).to(equal(3))
+        expect(len(set(e.textPayload for e in got))).to(equal(3))
+        expect(agg.dropped_log_entries).to(equal(17))
+
+    def test_should_collapse_identical_entries(self):
+        ops = [
+            _make_logged_operation(_EARLY, request_latency_in_ms=1.0),
+            _make_logged_operation(_LATER, request_latency_in_ms=2.0),
+            _make_logged_operation(_LATER_STILL, request_latency_in_ms=3.0),
+            _make_logged_operation(_LATER, text=u'another message'),
+        ]
+        agg = self._aggregate(ops, dedupe=True)
+        got = agg.as_operation().logEntries
+        expect(len(got)).to(equal(2))
+        expect(got[0].timestamp).to(equal(_EARLY))
+        expect(encoding.MessageToPyValue(got[0].labels)).to(equal(
+            {operation.LOG_ENTRY_COUNT_LABEL: u'3'}))
+        expect(got[1].textPayload).to(equal(u'another message'))
+        expect(got[1].labels).to(be_none)
+        expect(agg.dropped_log_entries).to(equal(0))
+
+    def test_should_count_the_collapsed_entries_that_are_dropped(self):
+        ops = [_make_logged_operation(_EARLY) for _ in range(3)]
+        ops.extend(_make_logged_operation(_EARLY, text=u'message %d' % (i,))
+                   for i in range(20))
+        agg = self._aggregate(ops, max_entries=1, dedupe=True)
+        got = agg.as_operation().logEntries
+        expect(len(got)).to(equal(1))
+        kept = 3 if got[0].textPayload == u'a message' else 1
+        expect(agg.dropped_log_entries).to(equal(23 - kept))
+
+    def test_should_sample_entries(self):
+        ops = [_make_logged_operation(_EARLY) for _ in range(5)]
+        agg = self._aggregate(ops, sample_rate=0.0)
+        expect(len(agg.as_operation().logEntries)).to(equal(0))
+        expect(agg.dropped_log_entries).to(equal(5))
+
+    def test_should_fail_on_bad_limits(self):
+        should_fail = [
+            lambda: operation.LogEntryLimits(max_entries=-1),
+            lambda: operation.LogEntryLimits(sample_rate=1.5),
+        ]
+        for testf in should_fail:
+            expect(testf).to(raise_error(AssertionError))
+
+
+def _make_report_operation(response_code, size, latency_secs):
+    info = report_request.Info(
+        api_key=u'an_api_key',
+        api_key_valid=True,
+        backend_time=datetime.timedelta(seconds=latency_secs / 2),
+        consumer_project_number=1234,
+        method=u'GET',
+        operation_id=u'an_op_id',
+        operation_name=u'an_op_name',
+        overhead_time=datetime.timedelta(seconds=latency_secs / 10),
+        referer=u'a_referer',
+        request_size=size,
+        request_time=datetime.timedelta(seconds=latency_secs),
+        response_code=response_code,
+        response_size=size * 2,
+        service_name=u'a_service_name')
+    # pylint: disable=no-member
+    rules = report_request.ReportingRules.from_known_inputs(
+        metric_names=[m.metric_name for m in
+                      metric_descriptor.KnownMetrics.__members__.values()],
+        label_names=[l.label_name for l in
+                     label_descriptor.KnownLabels.__members__.values()])
+    timer = lambda: datetime.datetime(1980, 1, 1, 10, 0, int(latency_secs * 10))
+    req = info.as_report_request(rules, timer=timer)
+    return req.reportRequest.operations[0]
+
+
 _INFO_TESTS = [
     (operation.Info(
         referer=u'a_referer',
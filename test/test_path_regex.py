@@ -0,0 +1,123 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import unittest2
+from expects import be_none, equal, expect, raise_error
+
+from endpoints_management.control import path_regex
+
+
+class TestCompilePathPattern(unittest2.TestCase):
+
+    def test_should_match_variables(self):
+        regex = path_regex.compile_path_pattern(u'shelves/{shelf}/books')
+        expect(regex.match(u'shelves/88/books')).not_to(be_none)
+        expect(regex.match(u'shelves/88/books/')).not_to(be_none)
+        expect(regex.match(u'shelves/88/notes')).to(be_none)
+
+    def test_should_match_variables_with_dotted_names(self):
+        regex = path_regex.compile_path_pattern(u'shelves/{shelf.id}')
+        expect(regex.match(u'shelves/88')).not_to(be_none)
+
+
+_TEMPLATES = (
+    u'shelves',
+    u'shelves/{shelf}',
+    u'shelves/{shelf}:lock',
+    u'shelves/{shelf}/books',
+    u'shelves/{shelf}/books/{book}',
+    u'shelves/first/books',
+    u'shelves/{shelf}/books/{book}:read',
+    u'v1.0/shelves',
+    u'notes/{note}',
+    u'{x}',
+)
+
+_PATHS = (
+    u'',
+    u'shelves',
+    u'shelves/',
+    u'shelves//',
+    u'shelves/88',
+    u'shelves/88/',
+    u'shelves/',
+    u'shelves/88:lock',
+    u'shelves/88:unlock',
+    u'shelves/:lock',
+    u'shelves/88/books',
+    u'shelves/first/books',
+    u'shelves//books',
+    u'shelves/88/books/9',
+    u'shelves/88/books/9:read',
+    u'shelves/88/books/9/pages',
+    u'shelves/{88}',
+    u'v1.0/shelves',
+    u'v1x0/shelves',
+    u'notes/a:b',
+    u'anything',
+    u'any/thing',
+)
+
+
+class TestPathRouter(unittest2.TestCase):
+
+    def _router(self, templates):
+        router = path_regex.PathRouter()
+        for t in templates:
+            router.add(t, t)
+        return router
+
+    def test_should_find_the_same_template_as_the_regexes(self):
+        router = self._router(_TEMPLATES)
+        regexes = [(path_regex.compile_path_pattern(t), t) for t in _TEMPLATES]
+        for path in _PATHS:
+            want = next((t for r, t in regexes if r.match(path)), None)
+            expect((path, router.lookup(path))).to(equal((path, want)))
+
+    def test_should_prefer_the_first_matching_template(self):
+        router = self._router([u'shelves/{shelf}', u'shelves/first'])
+        expect(router.lookup(u'shelves/first')).to(equal(u'shelves/{shelf}'))
+        router = self._router([u'shelves/first', u'shelves/{shelf}'])
+        expect(router.lookup(u'shelves/first')).to(equal(u'shelves/first'))
+
+    def test_should_prefer_the_first_template_across_regexes(self):
+        router = self._router([u'a+/b', u'a/{b}', u'a/b'])
+        expect(router.lookup(u'aa/b')).to(equal(u'a+/b'))
+        expect(router.lookup(u'a/b')).to(equal(u'a+/b'))
+        router = self._router([u'a/{b}', u'a+/b'])
+        expect(router.lookup(u'a/b')).to(equal(u'a/{b}'))
+        expect(router.lookup(u'aa/b')).to(equal(u'a+/b'))
+
+    def test_should_match_wildcards(self):
+        router = self._router([u'shelves/*/books', u'files/**'])
+        expect(router.lookup(u'shelves/88/books')).to(
+            equal(u'shelves/*/books'))
+        expect(router.lookup(u'shelves/88/notes')).to(be_none)
+        expect(router.lookup(u'files')).to(equal(u'files/**'))
+        expect(router.lookup(u'files/a/b/c')).to(equal(u'files/**'))
+        expect(router.lookup(u'other/a')).to(be_none)
+
+    def test_should_count_the_added_templates(self):
+        expect(len(path_regex.PathRouter())).to(equal(0))
+        expect(len(self._router(_TEMPLATES))).to(equal(len(_TEMPLATES)))
+
+    def test_should_reject_invalid_templates(self):
+        router = path_regex.PathRouter()
+        testf = lambda: router.add(u'shelves/{shelf}/{shelf}', None)
+        expect(testf).to(raise_error(path_regex.RegexError))
+        testf = lambda: router.add(u'shelves/(', None)
+        expect(testf).to(raise_error(path_regex.RegexError))
+        expect(len(router)).to(equal(0))
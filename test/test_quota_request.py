@@ -22,7 +22,8 @@ import http.client
 import unittest2
 import mock
 from operator import attrgetter
-from expects import be, be_none, be_true, be_false, equal, expect, raise_error
+from expects import (be, be_below_or_equal, be_empty, be_none, be_true, be_false,
+                     equal, expect, raise_error)
 
 from apitools.base.py import encoding
 
@@ -245,8 +246,7 @@ class TestCachingAggregator(unittest2.TestCase):
             expect(item._op_aggregator).to(be_none)
         agg.allocate_quota(req)
         agg.allocate_quota(req)
-        with agg._out as out:
-            expect(len(out)).to(equal(1))
+        expect(len(agg._out)).to(equal(1))
         with agg._cache as cache:
             item = cache[signature]
             expect(item._op_aggregator).not_to(be_none)
@@ -287,7 +287,8 @@ class TestCachingAggregator(unittest2.TestCase):
         assert len(agg.flush()) == 1
         agg.add_response(req, real_response)
         signature = quota_request.sign(req.allocateQuotaRequest)
-        with agg._cache as cache, agg._out as out:
+        out = agg._out
+        with agg._cache as cache:
             assert len(out) == 0
             assert signature in cache
             self.timer.tick()
@@ -301,6 +302,233 @@ class TestCachingAggregator(unittest2.TestCase):
             assert signature not in cache
 
 
+    def test_should_flush_the_refreshes_of_negative_responses_first(self):
+        agg = self.agg
+        positive = _make_test_request(self.SERVICE_NAME, u'positive',
+                                      consumer_id=u'positive_consumer')
+        negative = _make_test_request(self.SERVICE_NAME, u'negative',
+                                      consumer_id=u'negative_consumer')
+        exhausted = sc_messages.AllocateQuotaResponse(
+            operationId=u'negative',
+            allocateErrors=[sc_messages.QuotaError(
+                code=sc_messages.QuotaError.CodeValueValuesEnum.RESOURCE_EXHAUSTED)])
+        for req in (positive, negative):
+            agg.allocate_quota(req)
+        agg.flush()
+        agg.add_response(positive, sc_messages.AllocateQuotaResponse(
+            operationId=u'positive'))
+        agg.add_response(negative, exhausted)
+        self.timer.tick()
+        for req in (positive, negative):
+            agg.allocate_quota(req)
+        flushed = agg.flush()
+        expect([r.allocateQuotaRequest.allocateOperation.consumerId
+                for r in flushed]).to(equal([u'negative_consumer',
+                                             u'positive_consumer']))
+
+    def test_should_refresh_unsent_requests_again(self):
+        req = _make_test_request(self.SERVICE_NAME, self.FAKE_OPERATION_ID,
+                                 costs={u'a_metric': 1})
+        agg = self.agg
+        agg.allocate_quota(req)
+        flushed = agg.flush()
+        agg.add_unsent(flushed[0])
+        agg.allocate_quota(req)
+        flushed = agg.flush()
+        expect(len(flushed)).to(equal(1))
+        op = flushed[0].allocateQuotaRequest.allocateOperation
+        expect(op.quotaMetrics[0].metricValues[0].int64Value).to(equal(2))
+
+
+class TestClockedCachingAggregator(TestCachingAggregator):
+
+    def setUp(self):
+        self.timer = _NanosClock()
+        self.expiration = datetime.timedelta(seconds=2)
+        self.flush_interval = datetime.timedelta(seconds=1)
+        options = caches.QuotaOptions(
+            flush_interval=self.flush_interval,
+            expiration=self.expiration)
+        self.agg = quota_request.Aggregator(
+            self.SERVICE_NAME, options, clock=self.timer)
+
+
+class TestTinyLFUCachingAggregator(TestCachingAggregator):
+
+    def setUp(self):
+        self.timer = _DateTimeTimer()
+        self.expiration = datetime.timedelta(seconds=2)
+        self.flush_interval = datetime.timedelta(seconds=1)
+        options = caches.QuotaOptions(
+            flush_interval=self.flush_interval,
+            expiration=self.expiration,
+            eviction_policy=caches.TINY_LFU)
+        self.agg = quota_request.Aggregator(
+            self.SERVICE_NAME, options, timer=self.timer)
+
+
+class TestShardedCachingAggregator(unittest2.TestCase):
+    SERVICE_NAME = u'service.with_sharded_cache'
+
+    def setUp(self):
+        self.timer = _DateTimeTimer()
+        options = caches.QuotaOptions(
+            flush_interval=datetime.timedelta(seconds=1),
+            expiration=datetime.timedelta(seconds=2),
+            num_shards=4)
+        self.agg = quota_request.Aggregator(
+            self.SERVICE_NAME, options, timer=self.timer)
+
+    def _make_requests(self):
+        reqs = []
+        for i in range(8):
+            req = _make_test_request(self.SERVICE_NAME, u'op_id_%d' % (i,))
+            req.allocateQuotaRequest.allocateOperation.consumerId = (
+                u'project:consumer-%d' % (i,))
+            reqs.append(req)
+        return reqs
+
+    def test_should_cache_responses_in_each_shard(self):
+        agg = self.agg
+        for req in self._make_requests():
+            op_id = req.allocateQuotaRequest.allocateOperation.operationId
+            real_response = sc_messages.AllocateQuotaResponse(
+                operationId=op_id + u'-real')
+            agg.allocate_quota(req)
+            agg.add_response(req, real_response)
+            expect(agg.allocate_quota(req)).to(equal(real_response))
+
+    def test_should_flush_all_shards(self):
+        agg = self.agg
+        reqs = self._make_requests()
+        for req in reqs:
+            agg.allocate_quota(req)
+        expect(len(agg.flush())).to(equal(len(reqs)))
+        expect(agg.flush()).to(equal([]))
+
+    def test_should_clear_all_shards(self):
+        agg = self.agg
+        reqs = self._make_requests()
+        for req in reqs:
+            agg.allocate_quota(req)
+        agg.clear()
+        expect(agg.flush()).to(equal([]))
+        for shard in caches.shards_of(agg._cache):
+            with shard as cache:
+                expect(len(cache)).to(equal(0))
+
+
+class TestLeasingAggregator(unittest2.TestCase):
+    SERVICE_NAME = u'service.with_leases'
+    METRIC_NAME = u'a_metric'
+    LEASE_SIZE = 10
+
+    def setUp(self):
+        self.timer = _DateTimeTimer()
+        options = caches.QuotaOptions(
+            flush_interval=datetime.timedelta(seconds=1),
+            expiration=datetime.timedelta(seconds=10),
+            lease_size=self.LEASE_SIZE)
+        self.agg = quota_request.Aggregator(
+            self.SERVICE_NAME, options, timer=self.timer)
+
+    def _make_request(self, consumer_id=None, cost=1):
+        return _make_test_request(self.SERVICE_NAME, u'an_op_id',
+                                  consumer_id=consumer_id,
+                                  costs={self.METRIC_NAME: cost})
+
+    def _allocate(self, server, count, **kw):
+        allowed = 0
+        for _ in range(count):
+            resp = self.agg.allocate_quota(self._make_request(**kw))
+            if not resp.allocateErrors:
+                allowed += 1
+            server.serve(self.agg)
+        return allowed
+
+    def test_should_lease_blocks_of_quota(self):
+        server = _StandInQuotaServer({
+            (_TEST_CONSUMER_ID, self.METRIC_NAME): 1000})
+        expect(self._allocate(server, 100)).to(equal(100))
+        expect(server.calls).to(be_below_or_equal(100 // self.LEASE_SIZE + 2))
+        for req in server.requests:
+            expect(req.allocateQuotaRequest.allocateOperation.quotaMode).to(
+                equal(_BEST_EFFORT))
+
+    def test_should_allocate_no_more_than_the_leased_quota(self):
+        server = _StandInQuotaServer({
+            (_TEST_CONSUMER_ID, self.METRIC_NAME): 25})
+        expect(self._allocate(server, 100)).to(equal(25))
+        resp = self.agg.allocate_quota(self._make_request())
+        expect(resp.allocateErrors[0].code).to(
+            equal(_QuotaErrors.RESOURCE_EXHAUSTED))
+
+    def test_should_lease_separately_for_each_consumer(self):
+        server = _StandInQuotaServer({
+            (_TEST_CONSUMER_ID, self.METRIC_NAME): 5,
+            (u'another_consumer', self.METRIC_NAME): 15})
+        expect(self._allocate(server, 50)).to(equal(5))
+        expect(self._allocate(server, 50, consumer_id=u'another_consumer')).to(
+            equal(15))
+
+    def test_should_refill_before_the_lease_runs_out(self):
+        server = _StandInQuotaServer({
+            (_TEST_CONSUMER_ID, self.METRIC_NAME): 1000})
+        agg = self.agg
+        agg.allocate_quota(self._make_request())
+        server.serve(agg)  # the first block has arrived
+        # 9 units remain; the refill is requested once fewer than 5 would
+        for _ in range(4):
+            agg.allocate_quota(self._make_request())
+            expect(agg.flush()).to(be_empty)
+        agg.allocate_quota(self._make_request())
+        expect(len(agg.flush())).to(equal(1))
+
+    def test_should_request_each_refill_once(self):
+        agg = self.agg
+        for _ in range(self.LEASE_SIZE):
+            agg.allocate_quota(self._make_request())
+        expect(len(agg.flush())).to(equal(1))
+
+    def test_should_return_errors_that_do_not_fail_open(self):
+        agg = self.agg
+        agg.allocate_quota(self._make_request())
+        req = agg.flush()[0]
+        bad_key = sc_messages.AllocateQuotaResponse(
+            allocateErrors=[sc_messages.QuotaError(
+                code=_QuotaErrors.API_KEY_INVALID)])
+        agg.add_response(req, bad_key)
+        expect(agg.allocate_quota(self._make_request())).to(equal(bad_key))
+
+    def test_should_allocate_the_whole_block_on_errors_that_fail_open(self):
+        agg = self.agg
+        agg.allocate_quota(self._make_request())
+        req = agg.flush()[0]
+        unavailable = sc_messages.AllocateQuotaResponse(
+            allocateErrors=[sc_messages.QuotaError(
+                code=_QuotaErrors.QUOTA_SYSTEM_UNAVAILABLE)])
+        agg.add_response(req, unavailable)
+        for _ in range(self.LEASE_SIZE - 1):
+            resp = agg.allocate_quota(self._make_request())
+            expect(resp.allocateErrors).to(be_empty)
+
+    def test_should_request_an_unsent_refill_again(self):
+        agg = self.agg
+        agg.allocate_quota(self._make_request())
+        agg.add_unsent(agg.flush()[0])
+        agg.allocate_quota(self._make_request())
+        expect(len(agg.flush())).to(equal(1))
+
+    def test_should_request_a_lost_refill_again(self):
+        agg = self.agg
+        agg.allocate_quota(self._make_request())
+        expect(len(agg.flush())).to(equal(1))  # but no response is added
+        for _ in range(10):
+            self.timer.tick()
+        agg.allocate_quota(self._make_request())
+        expect(len(agg.flush())).to(equal(1))
+
+
 class TestCacheItem(unittest2.TestCase):
     SERVICE_NAME = u'service.quota'
     FAKE_OPERATION_ID = u'service.general.quota'
@@ -358,18 +586,94 @@ class TestCacheItem(unittest2.TestCase):
         expect(op.quotaMetrics[0].metricValues[0].int64Value).to(equal(24))
 
 
+class TestQuotaOperationAggregator(unittest2.TestCase):
+    SERVICE_NAME = u'service.quota'
+    FAKE_OPERATION_ID = u'service.general.quota'
+
+    def _make_op(self, **costs):
+        req = _make_test_request(self.SERVICE_NAME, self.FAKE_OPERATION_ID,
+                                 costs=costs)
+        return req.allocateQuotaRequest.allocateOperation
+
+    def test_should_sum_the_costs_of_each_metric(self):
+        agg = quota_request.QuotaOperationAggregator(self._make_op(a=1, b=2))
+        agg.merge_operation(self._make_op(a=3))
+        agg.merge_operation(self._make_op(a=5, b=7))
+        op = agg.as_quota_operation()
+        got = dict((mv_set.metricName, mv_set.metricValues[0].int64Value)
+                   for mv_set in op.quotaMetrics)
+        expect(got).to(equal({u'a': 9, u'b': 9}))
+        expect(op.operationId).to(equal(self.FAKE_OPERATION_ID))
+        expect(op.consumerId).to(equal(_TEST_CONSUMER_ID))
+        expect(op.methodName).to(equal(_TEST_OP_NAME))
+
+    def test_should_not_modify_the_aggregated_operations(self):
+        first = self._make_op(a=1)
+        agg = quota_request.QuotaOperationAggregator(first)
+        agg.merge_operation(self._make_op(a=2))
+        agg.as_quota_operation()
+        expect(first).to(equal(self._make_op(a=1)))
+
+    def test_should_make_a_new_operation_each_time(self):
+        agg = quota_request.QuotaOperationAggregator(self._make_op(a=1))
+        expect(agg.as_quota_operation()).not_to(be(agg.as_quota_operation()))
+        expect(agg.as_quota_operation()).to(equal(agg.as_quota_operation()))
+
+    def test_should_merge_values_that_are_not_plain_ints(self):
+        labelled = sc_messages.MetricValueSet(
+            metricName=u'a',
+            metricValues=[metric_value.create(labels={u'key1': u'value1'},
+                                              int64Value=4)])
+        op = self._make_op(a=1)
+        agg = quota_request.QuotaOperationAggregator(op)
+        agg.merge_operation(sc_messages.QuotaOperation(quotaMetrics=[labelled]))
+        agg.merge_operation(op)
+        got = agg.as_quota_operation().quotaMetrics[0].metricValues[0]
+        expect(got.int64Value).to(equal(6))
+
+    def test_should_not_modify_merged_values_that_are_not_plain_ints(self):
+        def money_op():
+            return sc_messages.QuotaOperation(quotaMetrics=[
+                sc_messages.MetricValueSet(
+                    metricName=u'a',
+                    metricValues=[sc_messages.MetricValue(
+                        moneyValue=sc_messages.Money(currencyCode=u'USD',
+                                                     units=3, nanos=0))])])
+        first = money_op()
+        second = money_op()
+        agg = quota_request.QuotaOperationAggregator(first)
+        aggregated = agg.as_quota_operation()
+        agg.merge_operation(second)
+        agg.merge_operation(money_op())
+        expect(first).to(equal(money_op()))
+        expect(second).to(equal(money_op()))
+        expect(aggregated.quotaMetrics[0].metricValues[0].moneyValue.units).to(
+            equal(3))
+        merged = agg.as_quota_operation().quotaMetrics[0].metricValues[0]
+        expect(merged.moneyValue.units).to(equal(9))
+
+
 _TEST_CONSUMER_ID = u'testConsumerID'
 _TEST_OP_NAME = u'testOperationName'
 
 
-def _make_test_request(service_name, operation_id=None, importance=None):
+def _make_test_request(service_name, operation_id=None, importance=None,
+                       consumer_id=None, costs=None):
     if importance is None:
         importance = sc_messages.Operation.ImportanceValueValuesEnum.LOW
+    if consumer_id is None:
+        consumer_id = _TEST_CONSUMER_ID
     op = sc_messages.QuotaOperation(
-        consumerId=_TEST_CONSUMER_ID,
+        consumerId=consumer_id,
         methodName=_TEST_OP_NAME,
         operationId=operation_id,
     )
+    if costs:
+        op.quotaMetrics = [
+            sc_messages.MetricValueSet(
+                metricName=name,
+                metricValues=[sc_messages.MetricValue(int64Value=cost)])
+            for name, cost in costs.items()]
     quota_request = sc_messages.AllocateQuotaRequest(allocateOperation=op)
     return sc_messages.ServicecontrolServicesAllocateQuotaRequest(
         serviceName=service_name,
@@ -468,6 +772,31 @@ class TestInfo(unittest2.TestCase):
             testf = lambda: info.as_allocate_quota_request(timer=timer)
             expect(testf).to(raise_error(ValueError))
 
+    def test_should_convert_the_same_using_a_template(self):
+        timer = _DateTimeTimer()
+        for info, _ in _INFO_TESTS:
+            template = quota_request.Template(info.quota_info, info.config_id)
+            want = info.as_allocate_quota_request(timer=timer)
+            got = info.as_allocate_quota_request(timer=timer, template=template)
+            expect(got).to(equal(want))
+
+
+class TestTemplate(unittest2.TestCase):
+
+    def test_should_make_new_quota_metrics_each_time(self):
+        template = quota_request.Template({u'a_metric': 2}, u'a_config_id')
+        first = template.quota_metrics()
+        expect(first).to(equal([
+            sc_messages.MetricValueSet(
+                metricName=u'a_metric',
+                metricValues=[sc_messages.MetricValue(int64Value=2)])
+        ]))
+        expect(template.quota_metrics()).to(equal(first))
+        expect(template.quota_metrics()[0]).not_to(be(first[0]))
+
+    def test_should_have_no_quota_metrics_without_quota_info(self):
+        expect(quota_request.Template(None, None).quota_metrics()).to(equal([]))
+
 
 class TestConvertResponse(unittest2.TestCase):
     PROJECT_ID = u'test_convert_response'
@@ -504,6 +833,41 @@ class TestConvertResponse(unittest2.TestCase):
         assert got.endswith(detail)
 
 
+_QuotaErrors = sc_messages.QuotaError.CodeValueValuesEnum
+_BEST_EFFORT = sc_messages.QuotaOperation.QuotaModeValueValuesEnum.BEST_EFFORT
+
+
+class _StandInQuotaServer(object):
+    """Allocates quota from fixed limits, as the server does in BEST_EFFORT mode."""
+
+    def __init__(self, limits):
+        self.available = dict(limits)
+        self.requests = []
+
+    @property
+    def calls(self):
+        return len(self.requests)
+
+    def AllocateQuota(self, req):  # pylint: disable=invalid-name
+        self.requests.append(req)
+        op = req.allocateQuotaRequest.allocateOperation
+        allocated = []
+        for mv_set in op.quotaMetrics:
+            key = (op.consumerId, mv_set.metricName)
+            wanted = sum(mv.int64Value for mv in mv_set.metricValues)
+            granted = min(wanted, self.available.get(key, 0))
+            self.available[key] = self.available.get(key, 0) - granted
+            allocated.append(sc_messages.MetricValueSet(
+                metricName=mv_set.metricName,
+                metricValues=[sc_messages.MetricValue(int64Value=granted)]))
+        return sc_messages.AllocateQuotaResponse(
+            operationId=op.operationId, quotaMetrics=allocated)
+
+    def serve(self, agg):
+        for req in agg.flush():
+            agg.add_response(req, self.AllocateQuota(req))
+
+
 class _DateTimeTimer(object):
     def __init__(self, auto=False):
         self.auto = auto
@@ -516,3 +880,14 @@ class _DateTimeTimer(object):
 
     def tick(self):
         self.time += datetime.timedelta(seconds=1)
+
+
+class _NanosClock(object):
+    def __init__(self):
+        self.time = 1234567
+
+    def __call__(self):
+        return self.time
+
+    def tick(self):
+        self.time += caches.NANOS_PER_SECOND
@@ -0,0 +1,205 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+from builtins import range
+import datetime
+import threading
+import mock
+import unittest2
+from expects import be_a, be_false, be_none, be_true, equal, expect
+
+from endpoints_management.control import (report_pipeline, report_request,
+                                          sc_messages, timestamp)
+
+
+_SERVICE_NAME = u'pipeline.service'
+_A_TIME = datetime.datetime(2017, 1, 2, 3, 4, 5)
+_RULES = report_request.ReportingRules(logs=[u'a_log'])
+
+
+def _make_info(operation_id=u'an_op_id'):
+    return report_request.Info(
+        operation_id=operation_id,
+        operation_name=u'an_op_name',
+        referer=u'a_referer',
+        service_name=_SERVICE_NAME)
+
+
+def _no_thread(target):
+    thread = mock.MagicMock()
+    thread.start.side_effect = RuntimeError(u'no threads here')
+    return thread
+
+
+class TestPipeline(unittest2.TestCase):
+
+    def setUp(self):
+        self.reported = []
+        patcher = mock.patch.object(report_pipeline.client, u'create_thread',
+                                    side_effect=_no_thread)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _make_subject(self, **kw):
+        return report_pipeline.Pipeline(self.reported.append,
+                                        timer=lambda: _A_TIME, **kw)
+
+    def test_should_report_from_put_without_a_thread(self):
+        subject = self._make_subject()
+        expect(subject.put(_make_info(), _RULES)).to(be_true)
+        expect(len(self.reported)).to(equal(1))
+        req = self.reported[0]
+        expect(req).to(equal(_make_info().as_report_request(
+            _RULES, timer=lambda: _A_TIME)))
+        expect(len(subject)).to(equal(0))
+
+    def test_should_use_the_time_when_queued(self):
+        subject = self._make_subject()
+        subject.put(_make_info(), _RULES)
+        op = self.reported[0].reportRequest.operations[0]
+        expect(op.endTime).to(equal(timestamp.to_rfc3339(_A_TIME)))
+        expect(op.logEntries[0].timestamp).to(
+            equal(timestamp.to_rfc3339(_A_TIME)))
+
+    def test_should_use_the_template(self):
+        subject = self._make_subject()
+        template = report_request.Template(
+            report_request.ReportingRules(),
+            report_request.ReportedPlatforms.GCE)
+        subject.put(_make_info(), _RULES, template)
+        op = self.reported[0].reportRequest.operations[0]
+        expect(op.logEntries).to(equal([]))
+
+    def test_should_log_bad_values_without_failing(self):
+        subject = self._make_subject()
+        bad_info = report_request.Info(operation_id=u'no_service_name')
+        expect(subject.put(bad_info, _RULES)).to(be_true)
+        expect(self.reported).to(equal([]))
+
+
+class TestPipelineOverflow(unittest2.TestCase):
+
+    def setUp(self):
+        self.reported = []
+
+    def _make_subject(self, **kw):
+        return report_pipeline.Pipeline(self.reported.append, **kw)
+
+    def _fill(self, subject, count):
+        # queue without starting the worker, as if it had fallen behind
+        with mock.patch.object(subject, u'_start_worker'):
+            subject._thread = mock.MagicMock()
+            return [subject.put(_make_info(u'op_%d' % (i,)), _RULES)
+                    for i in range(count)]
+
+    def test_should_drop_logs_then_operations(self):
+        subject = self._make_subject(max_queued=4)
+        queued = self._fill(subject, 6)
+        expect(queued).to(equal([True] * 4 + [False] * 2))
+        expect(subject.dropped_logs).to(equal(2))
+        expect(subject.dropped_operations).to(equal(2))
+        expect(subject.drain()).to(equal(4))
+        with_logs = [len(r.reportRequest.operations[0].logEntries)
+                     for r in self.reported]
+        expect(with_logs).to(equal([1, 1, 0, 0]))
+
+    def test_should_only_drop_operations_if_configured(self):
+        subject = self._make_subject(
+            max_queued=4, overflow_policy=report_pipeline.DROP_OPERATIONS)
+        queued = self._fill(subject, 6)
+        expect(queued).to(equal([True] * 4 + [False] * 2))
+        expect(subject.dropped_logs).to(equal(0))
+        expect(subject.dropped_operations).to(equal(2))
+        subject.drain()
+        with_logs = [len(r.reportRequest.operations[0].logEntries)
+                     for r in self.reported]
+        expect(with_logs).to(equal([1, 1, 1, 1]))
+
+    def test_should_not_exceed_the_bound_when_put_concurrently(self):
+        subject = self._make_subject(max_queued=50)
+
+        def put_many():
+            for _ in range(100):
+                subject.put(_make_info(), _RULES)
+
+        threads = [threading.Thread(target=put_many) for _ in range(8)]
+        subject._thread = mock.MagicMock()
+        with mock.patch.object(subject, u'_start_worker'):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        expect(len(subject)).to(equal(50))
+        expect(subject.dropped_operations).to(equal(750))
+
+    def test_should_drain_in_batches(self):
+        subject = self._make_subject(batch_size=2)
+        self._fill(subject, 5)
+        with mock.patch.object(subject, u'_make_requests',
+                               wraps=subject._make_requests) as make:
+            expect(subject.drain()).to(equal(5))
+            expect([len(c[0][0]) for c in make.call_args_list]).to(
+                equal([2, 2, 1]))
+
+
+class TestPipelineThread(unittest2.TestCase):
+
+    def test_should_report_from_the_worker_thread(self):
+        reported = threading.Event()
+        threads = []
+
+        def report(req):
+            threads.append(threading.current_thread())
+            reported.set()
+
+        subject = report_pipeline.Pipeline(report)
+        subject.put(_make_info(), _RULES)
+        expect(reported.wait(5)).to(be_true)
+        subject.stop()
+        expect(threads[0]).not_to(equal(threading.current_thread()))
+        expect(threads[0].is_alive()).to(be_false)
+
+    def test_should_drop_values_put_after_stop(self):
+        reported = []
+        subject = report_pipeline.Pipeline(reported.append)
+        subject.put(_make_info(), _RULES)
+        subject.stop()
+        expect(subject.put(_make_info(), _RULES)).to(be_false)
+        expect(subject._thread).to(be_none)
+        expect(subject.dropped_operations).to(equal(1))
+        expect(len(reported)).to(equal(1))
+
+    def test_should_queue_values_again_once_restarted(self):
+        reported = threading.Event()
+        subject = report_pipeline.Pipeline(lambda req: reported.set())
+        subject.stop()
+        subject.start()
+        expect(subject.put(_make_info(), _RULES)).to(be_true)
+        expect(reported.wait(5)).to(be_true)
+        subject.stop()
+
+    def test_should_report_queued_values_on_stop(self):
+        reported = []
+        subject = report_pipeline.Pipeline(reported.append)
+        with mock.patch.object(subject, u'_start_worker'):
+            subject._thread = mock.MagicMock()
+            subject.put(_make_info(), _RULES)
+        subject._thread = None
+        expect(reported).to(equal([]))
+        subject.stop()
+        expect(len(reported)).to(equal(1))
+        expect(reported[0]).to(
+            be_a(sc_messages.ServicecontrolServicesReportRequest))
@@ -18,17 +18,22 @@ from __future__ import print_function
 from builtins import range
 from builtins import object
 import datetime
+import threading
 import time
 import unittest2
 from operator import attrgetter
-from expects import be_none, equal, expect, raise_error
 
+import mock
+from expects import (be_above, be_above_or_equal, be_below_or_equal,
+                     be_empty, be_false, be_none, equal, expect, raise_error)
+
+from apitools.base.protorpclite import messages
 from apitools.base.py import encoding
 
 from endpoints_management.control import (caches, label_descriptor,
                                           metric_value, sc_messages,
-                                          metric_descriptor, report_request,
-                                          timestamp)
+                                          metric_descriptor, operation,
+                                          report_request, timestamp)
 
 
 class TestReportingRules(unittest2.TestCase):
@@ -380,6 +385,48 @@ class TestInfo(unittest2.TestCase):
             expect(got.serviceName).to(equal(_TEST_SERVICE_NAME))
             expect(got.reportRequest.operations[0]).to(equal(want))
 
+    def test_should_report_the_same_using_a_template(self):
+        rules = report_request.ReportingRules(
+            logs=[u'endpoints-log'],
+            metrics=[_EXPECTED_OK_METRIC, _EXPECTED_NOK_METRIC],
+            labels=[_EXPECTED_OK_LABEL])
+        for info, _ in _ADD_METRICS_TESTS + _ADD_LABELS_TESTS:
+            template = report_request.Template(rules, info.platform)
+            want = info.as_report_request(rules, timer=_DateTimeTimer())
+            got = info.as_report_request(rules, timer=_DateTimeTimer(),
+                                         template=template)
+            expect(got).to(equal(want))
+
+
+class TestTemplate(unittest2.TestCase):
+
+    def test_should_only_keep_labels_that_can_be_updated(self):
+        known = label_descriptor.KnownLabels
+        rules = report_request.ReportingRules(
+            labels=[known.END_USER, known.REFERER])
+        template = report_request.Template(
+            rules, report_request.ReportedPlatforms.GCE)
+        expect(len(template.label_setters)).to(equal(1))
+        labels = {}
+        template.label_setters[0](report_request.Info(referer=u'a_referer'),
+                                  labels)
+        expect(labels).to(equal({known.REFERER.label_name: u'a_referer'}))
+
+    def test_should_bind_a_setter_for_each_metric(self):
+        rules = report_request.ReportingRules(
+            metrics=[_EXPECTED_OK_METRIC, _EXPECTED_NOK_METRIC])
+        template = report_request.Template(
+            rules, report_request.ReportedPlatforms.GCE)
+        expect(len(template.metric_setters)).to(equal(2))
+
+    def test_should_include_the_platform_in_the_system_labels(self):
+        template = report_request.Template(
+            report_request.ReportingRules(),
+            report_request.ReportedPlatforms.GAE_FLEX)
+        expect(dict(template.system_labels)[
+            label_descriptor.KnownLabels.SCC_PLATFORM.label_name]).to(
+                equal(u'GAE Flex'))
+
 
 class TestAggregatorReport(unittest2.TestCase):
     SERVICE_NAME = u'service.report'
@@ -487,6 +534,28 @@ class TestCachingAggregator(unittest2.TestCase):
         flushed_ops = flushed_reqs[0].reportRequest.operations
         expect(len(flushed_ops)).to(equal(2)) # many requests, but only two ops
 
+    def test_should_not_hold_the_cache_locks_while_making_operations(self):
+        req = _make_test_request(self.SERVICE_NAME, n=2, start=0)
+        agg = self.agg
+        expect(agg.report(req)).to(equal(report_request.Aggregator.CACHED_OK))
+        self.timer.tick() # time passes ...
+        self.timer.tick() # ... and is now past the flush_interval
+
+        locked = []
+        as_operation = operation.CompactAggregator.as_operation
+
+        def checking_as_operation(op_agg):
+            locked.extend(_is_locked(shard)
+                          for shard in caches.shards_of(agg._cache))
+            return as_operation(op_agg)
+
+        with mock.patch.object(operation.CompactAggregator, u'as_operation',
+                               checking_as_operation):
+            flushed_reqs = agg.flush()
+        expect(len(flushed_reqs)).to(equal(1))
+        expect(locked).not_to(be_empty)
+        expect(any(locked)).to(be_false)
+
     def test_may_clear_aggregated_operations(self):
         n = 261 # arbitrary
         agg = self.agg
@@ -504,6 +573,157 @@ class TestCachingAggregator(unittest2.TestCase):
         expect(len(flushed_reqs)).to(equal(0))  # but there is nothing
 
 
+class TestLogLimitingAggregator(unittest2.TestCase):
+    SERVICE_NAME = u'service.with_limited_logs'
+
+    def setUp(self):
+        self.timer = _DateTimeTimer()
+        options = caches.ReportOptions(
+            flush_interval=datetime.timedelta(seconds=1),
+            max_log_entries=2)
+        self.agg = report_request.Aggregator(
+            self.SERVICE_NAME, options, timer=self.timer)
+
+    def _make_logged_request(self):
+        req = _make_test_request(self.SERVICE_NAME, n=1)
+        req.reportRequest.operations[0].logEntries = [
+            sc_messages.LogEntry(name=u'a_log', textPayload=u'a message')]
+        return req
+
+    def test_should_limit_the_reported_log_entries(self):
+        agg = self.agg
+        for _ in range(5):
+            expect(agg.report(self._make_logged_request())).to(
+                equal(report_request.Aggregator.CACHED_OK))
+        expect(agg.dropped_log_entries).to(equal(0))
+        self.timer.tick() # time passes ...
+        self.timer.tick() # ... and is now past the flush_interval
+        flushed_reqs = agg.flush()
+        expect(len(flushed_reqs)).to(equal(1))
+        flushed_ops = flushed_reqs[0].reportRequest.operations
+        expect(len(flushed_ops[0].logEntries)).to(equal(2))
+        expect(agg.dropped_log_entries).to(equal(3))
+
+    def test_should_count_dropped_log_entries_on_clear(self):
+        agg = self.agg
+        for _ in range(3):
+            agg.report(self._make_logged_request())
+        expect(len(agg.clear()[0].logEntries)).to(equal(2))
+        expect(agg.dropped_log_entries).to(equal(1))
+
+
+class TestSizeBatchingAggregator(unittest2.TestCase):
+    SERVICE_NAME = u'service.with_large_logs'
+    MAX_REQUEST_BYTES = 50000
+
+    def setUp(self):
+        self.timer = _DateTimeTimer()
+        options = caches.ReportOptions(
+            flush_interval=datetime.timedelta(seconds=1),
+            max_request_bytes=self.MAX_REQUEST_BYTES)
+        self.agg = report_request.Aggregator(
+            self.SERVICE_NAME, options, timer=self.timer)
+
+    def _make_logged_request(self, n, payload_size):
+        req = _make_test_request(self.SERVICE_NAME, n=n)
+        for op in req.reportRequest.operations:
+            op.logEntries = [sc_messages.LogEntry(
+                name=u'a_log',
+                textPayload=u'x' * payload_size,
+                structPayload=encoding.PyValueToMessage(
+                    sc_messages.LogEntry.StructPayloadValue,
+                    {u'error_cause': u'y' * payload_size,
+                     u'http_response_code': 500}))]
+        return req
+
+    def _flush(self):
+        self.timer.tick() # time passes ...
+        self.timer.tick() # ... and is now past the flush_interval
+        return self.agg.flush()
+
+    def test_should_pack_requests_up_to_the_byte_limit(self):
+        agg = self.agg
+        expect(agg.report(self._make_logged_request(20, 10000))).to(
+            equal(report_request.Aggregator.CACHED_OK))
+        flushed_reqs = self._flush()
+        expect(len(flushed_reqs)).to(be_above(4))
+        total_ops = 0
+        for req in flushed_reqs:
+            total_ops += len(req.reportRequest.operations)
+            size = len(encoding.MessageToJson(req.reportRequest))
+            expect(size).to(be_below_or_equal(self.MAX_REQUEST_BYTES))
+        expect(total_ops).to(equal(20))
+
+    def test_should_pack_small_operations_together(self):
+        agg = self.agg
+        agg.report(self._make_logged_request(20, 10))
+        flushed_reqs = self._flush()
+        expect(len(flushed_reqs)).to(equal(1))
+        expect(len(flushed_reqs[0].reportRequest.operations)).to(equal(20))
+
+    def test_should_send_oversized_operations_on_their_own(self):
+        agg = self.agg
+        agg.report(self._make_logged_request(3, self.MAX_REQUEST_BYTES))
+        flushed_reqs = self._flush()
+        expect(len(flushed_reqs)).to(equal(3))
+        for req in flushed_reqs:
+            expect(len(req.reportRequest.operations)).to(equal(1))
+
+    def test_should_not_exceed_the_operation_count(self):
+        ops = _make_test_request(self.SERVICE_NAME, n=25).reportRequest.operations
+        # pylint: disable=protected-access
+        batches = report_request._batch_operations(
+            ops, 10, self.MAX_REQUEST_BYTES)
+        expect([len(b) for b in batches]).to(equal([10, 10, 5]))
+
+
+    def _expect_estimate_to_be_close(self, op):
+        # pylint: disable=protected-access
+        estimate = report_request._estimate_size(op)
+        size = len(encoding.MessageToJson(op))
+        expect(estimate).to(be_above_or_equal(size))
+        expect(estimate).to(be_below_or_equal(size * 1.01))
+
+    def test_should_estimate_the_size_of_non_ascii_text(self):
+        op = _make_test_request(self.SERVICE_NAME, n=1).reportRequest.operations[0]
+        op.logEntries = [sc_messages.LogEntry(
+            name=u'a_log',
+            textPayload=u'caf\xe9 \u4e2d\u6587 \U0001f600 "quoted"\n' * 100,
+            structPayload=encoding.PyValueToMessage(
+                sc_messages.LogEntry.StructPayloadValue,
+                {u'error_cause': u'\u00fcberf\u00e4llig' * 100,
+                 u'http_response_code': 500}))]
+        self._expect_estimate_to_be_close(op)
+
+    def test_should_estimate_the_size_of_many_labels(self):
+        op = _make_test_request(self.SERVICE_NAME, n=1).reportRequest.operations[0]
+        op.labels = encoding.PyValueToMessage(
+            sc_messages.Operation.LabelsValue,
+            dict((u'cloud.googleapis.com/label_%d' % (x,), u'value %d' % (x,))
+                 for x in range(100)))
+        self._expect_estimate_to_be_close(op)
+
+    def test_should_estimate_the_size_of_bytes(self):
+        msg = _BytesMessage(name=u'a_name', data=b'\x00\xff' * 1000)
+        self._expect_estimate_to_be_close(msg)
+
+
+class _BytesMessage(messages.Message):
+    name = messages.StringField(1)
+    data = messages.BytesField(2)
+
+
+class TestShardedCachingAggregator(TestCachingAggregator):
+
+    def setUp(self):
+        self.timer = _DateTimeTimer()
+        self.flush_interval = datetime.timedelta(seconds=1)
+        options = caches.ReportOptions(flush_interval=self.flush_interval,
+                                       num_shards=4)
+        self.agg = report_request.Aggregator(
+            self.SERVICE_NAME, options, timer=self.timer)
+
+
 class _DateTimeTimer(object):
     def __init__(self, auto=False):
         self.auto = auto
@@ -537,3 +757,20 @@ def _make_test_request(service_name, importance=None, n=3, start=0):
     return sc_messages.ServicecontrolServicesReportRequest(
         serviceName=service_name,
         reportRequest=report_request)
+
+
+def _is_locked(locked_object):
+    """Determines if another thread holds the lock of a LockedObject."""
+    # pylint: disable=protected-access
+    result = []
+
+    def try_lock():
+        acquired = locked_object._lock.acquire(False)
+        if acquired:
+            locked_object._lock.release()
+        result.append(not acquired)
+
+    thread = threading.Thread(target=try_lock)
+    thread.start()
+    thread.join()
+    return result[0]
@@ -775,6 +775,69 @@ class TestQuotaConfig(_JsonServiceBase, unittest2.TestCase):
         self.assertIsNotNone(info)
         self.assertIsNone(info.quota_info)
 
+
+class TestMethodRegistryLookupCache(unittest2.TestCase):
+
+    def _registry(self, lookup_cache_size):
+        return service.MethodRegistry(service.Loaders.SIMPLE.load(),
+                                      lookup_cache_size=lookup_cache_size)
+
+    def test_should_not_cache_by_default(self):
+        registry = service.MethodRegistry(service.Loaders.SIMPLE.load())
+        registry.lookup(u'GET', u'/anything')
+        registry.lookup(u'GET', u'/anything')
+        expect(registry.lookup_cache_hits).to(equal(0))
+        expect(registry.lookup_cache_misses).to(equal(0))
+
+    def test_should_count_hits_and_misses(self):
+        registry = self._registry(10)
+        first = registry.lookup(u'GET', u'/anything')
+        expect(registry.lookup(u'GET', u'/anything')).to(equal(first))
+        registry.lookup(u'POST', u'/anything')
+        expect(registry.lookup_cache_hits).to(equal(1))
+        expect(registry.lookup_cache_misses).to(equal(2))
+
+    def test_should_cache_paths_that_do_not_match(self):
+        registry = self._registry(10)
+        expect(registry.lookup(u'GET', u'/any/thing')).to(be_none)
+        expect(registry.lookup(u'GET', u'/any/thing')).to(be_none)
+        expect(registry.lookup_cache_hits).to(equal(1))
+
+    def test_should_evict_the_least_recently_used_lookup(self):
+        registry = self._registry(2)
+        registry.lookup(u'GET', u'/a')
+        registry.lookup(u'GET', u'/b')
+        registry.lookup(u'GET', u'/a')
+        registry.lookup(u'GET', u'/c')  # evicts /b
+        registry.lookup(u'GET', u'/a')
+        registry.lookup(u'GET', u'/b')
+        expect(registry.lookup_cache_hits).to(equal(2))
+        expect(registry.lookup_cache_misses).to(equal(4))
+
+
+class TestMethodInfoRequestTemplate(unittest2.TestCase):
+
+    def setUp(self):
+        self._info = service.MethodInfo(u'a_selector', None, None)
+        self._created = []
+
+    def _create(self, *args):
+        self._created.append(args)
+        return object()
+
+    def test_should_create_the_template_once(self):
+        first = self._info.request_template(self._create, u'a', 1)
+        expect(self._info.request_template(self._create, u'a', 1)).to(
+            equal(first))
+        expect(self._created).to(equal([(u'a', 1)]))
+
+    def test_should_recreate_the_template_if_the_args_change(self):
+        first = self._info.request_template(self._create, u'a', 1)
+        second = self._info.request_template(self._create, u'a', 2)
+        expect(second).not_to(equal(first))
+        expect(self._created).to(equal([(u'a', 1), (u'a', 2)]))
+
+
 _CUSTOM_METHOD_CONFIG_TEST = b"""
 {
     "name": "bookstore-http-api",
@@ -16,10 +16,12 @@ from __future__ import absolute_import
 
 import hashlib
 
+import mock
 import unittest2
-from expects import equal, expect
+from apitools.base.py import encoding
+from expects import be, equal, expect, raise_error
 
-from endpoints_management.control import signing
+from endpoints_management.control import caches, sc_messages, signing
 
 
 class TestAddDictToHash(unittest2.TestCase):
@@ -40,3 +42,59 @@ class TestAddDictToHash(unittest2.TestCase):
         signing.add_dict_to_hash(got_hash, same_dict)
         got = got_hash.digest()
         expect(got).to(equal(want))
+
+
+class TestSigner(unittest2.TestCase):
+
+    def _labels(self, a_dict):
+        return encoding.PyValueToMessage(sc_messages.Operation.LabelsValue,
+                                         a_dict)
+
+    def test_should_fail_on_unknown_algorithms(self):
+        expect(lambda: signing.Signer(u'not-a-hash')).to(
+            raise_error(ValueError))
+
+    @mock.patch(u'endpoints_management.control.signing.xxhash', None)
+    def test_should_fail_if_xxhash_is_not_installed(self):
+        expect(lambda: signing.Signer(signing.XXH128)).to(
+            raise_error(ValueError))
+
+    def test_should_create_128_bit_signatures(self):
+        for algorithm in (signing.MD5, signing.BLAKE2B):
+            signer = signing.Signer(algorithm)
+            expect(signer.algorithm).to(equal(algorithm))
+            expect(len(signer.digest([b'some', b'data']))).to(equal(16))
+
+    def test_should_sign_like_md5_by_default(self):
+        expect(signing.DEFAULT_SIGNER.digest([b'some', b'data'])).to(
+            equal(hashlib.md5(b'somedata').digest()))
+
+    def test_should_encode_labels_like_add_dict_to_hash(self):
+        a_dict = {u'key1': u'value1', u'key2': u'value2'}
+        want_hash = hashlib.md5()
+        signing.add_dict_to_hash(want_hash, a_dict)
+        parts = []
+        signing.DEFAULT_SIGNER.add_labels(parts, self._labels(a_dict))
+        expect(signing.DEFAULT_SIGNER.digest(parts)).to(
+            equal(want_hash.digest()))
+
+    def test_should_clear_the_cached_labels_when_full(self):
+        signer = signing.Signer()
+        signer.MAX_CACHED_LABELS = 2
+        parts = []
+        signer.add_labels(parts, self._labels({u'a': u'1', u'b': u'2'}))
+        signer.add_labels(parts, self._labels({u'c': u'3'}))
+        expect(len(signer._encoded_labels)).to(equal(1))
+        expect(b''.join(parts)).to(equal(b'\x00a\x001\x00b\x002\x00c\x003'))
+
+
+class TestCreate(unittest2.TestCase):
+
+    def test_should_use_the_default_signer_without_options(self):
+        expect(signing.create(None)).to(be(signing.DEFAULT_SIGNER))
+        expect(signing.create(caches.CheckOptions())).to(
+            be(signing.DEFAULT_SIGNER))
+
+    def test_should_use_the_algorithm_in_the_options(self):
+        options = caches.ReportOptions(signing_algorithm=signing.BLAKE2B)
+        expect(signing.create(options).algorithm).to(equal(signing.BLAKE2B))
@@ -12,12 +12,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from future import standard_library
+standard_library.install_aliases()
+import datetime
+import http.server
 import json
+import threading
+import time
 import unittest
 import httmock
 import mock
+import requests
 
 from Crypto import PublicKey
+from jwkest import ecc
 from jwkest import jwk
 
 from endpoints_management.auth import suppliers
@@ -140,6 +148,9 @@ class JwksSupplierTest(unittest.TestCase):
         with httmock.HTTMock(_mock_response_with_x509_certificates):
             actual_jwks = self._jwks_uri_supplier.supply(issuer)
             self.assertEquals(1, len(actual_jwks))
+            self.assertIsInstance(actual_jwks, suppliers.VerificationKeys)
+            self.assertEquals([actual_jwks[0]],
+                              actual_jwks.matching(kid, u"RS256"))
             actual_key = actual_jwks[0].key
 
             self.assertEquals(kid, actual_jwks[0].kid)
@@ -190,3 +201,206 @@ class JwksSupplierTest(unittest.TestCase):
             JwksSupplierTest._mock_timer.return_value += 5 * 60
             self._jwks_uri_supplier.supply(issuer)
             self.assertEqual(2, len(self._jwks_uri_supplier.supply(issuer)))
+
+
+class VerificationKeysTest(unittest.TestCase):
+
+    def setUp(self):
+        self._ec_keys = []
+        for kid in (u"ec-1", u"ec-2", None):
+            ec_jwk = jwk.ECKey(use=u"sig").load_key(ecc.P256)
+            ec_jwk.kid = kid
+            self._ec_keys.append(ec_jwk)
+        self._rsa_key = jwk.RSAKey(use=u"sig", kid=u"ec-1")
+        self._keys = suppliers.VerificationKeys(
+            self._ec_keys + [self._rsa_key])
+
+    def test_should_be_a_list_of_the_keys(self):
+        self.assertEqual(4, len(self._keys))
+        self.assertIs(self._rsa_key, self._keys[3])
+
+    def test_should_match_by_kid_and_key_type(self):
+        self.assertEqual([self._ec_keys[1]],
+                         self._keys.matching(u"ec-2", u"ES256"))
+        self.assertEqual([self._ec_keys[0]],
+                         self._keys.matching(u"ec-1", u"ES256"))
+        self.assertEqual([self._rsa_key],
+                         self._keys.matching(u"ec-1", u"RS256"))
+        self.assertEqual([], self._keys.matching(u"unknown", u"ES256"))
+
+    def test_should_match_every_key_of_the_type_without_kid(self):
+        self.assertEqual(self._ec_keys, self._keys.matching(None, u"ES256"))
+        self.assertEqual([self._rsa_key], self._keys.matching(None, u"RS256"))
+
+
+class _JwksServer(object):
+    """A local HTTP server that serves a JWKS, or errors."""
+
+    def __init__(self):
+        self.body = u""
+        self.status = 200
+        self.headers = {}
+        self.paths = []
+        stand_in = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):  # pylint: disable=invalid-name
+                stand_in.paths.append(self.path)
+                body = stand_in.body.encode(u"utf-8")
+                self.send_response(stand_in.status)
+                for name, value in stand_in.headers.items():
+                    self.send_header(name, value)
+                self.send_header(u"Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                pass
+
+        self._server = http.server.HTTPServer((u"127.0.0.1", 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def uri(self):
+        return u"http://127.0.0.1:%d/jwks" % (self._server.server_address[1],)
+
+    @property
+    def requests(self):
+        return len(self.paths)
+
+    def serve_certificates(self, *kids):
+        certs = {}
+        for kid in kids:
+            rsa_key = PublicKey.RSA.generate(1024)
+            certs[kid] = rsa_key.publickey().exportKey(u"PEM").decode(u"ascii")
+        self.body = json.dumps(certs)
+        self.status = 200
+
+    def fail(self):
+        self.body = u"unavailable"
+        self.status = 503
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class _Timer(object):
+
+    def __init__(self):
+        self.time = 1000.0
+
+    def __call__(self):
+        return self.time
+
+
+class JwksSupplierRefreshTest(unittest.TestCase):
+    ISSUER = u"https://issuer.com"
+    MAX_AGE = datetime.timedelta(minutes=30)
+
+    def setUp(self):
+        self._server = _JwksServer()
+        self._timer = _Timer()
+        key_uri_supplier = mock.MagicMock()
+        key_uri_supplier.supply.return_value = self._server.uri
+        self._supplier = suppliers.JwksSupplier(key_uri_supplier,
+                                                max_age=self.MAX_AGE,
+                                                timer=self._timer)
+
+    def tearDown(self):
+        self._server.close()
+
+    def _kids(self):
+        return sorted(key.kid for key in self._supplier.supply(self.ISSUER))
+
+    def _wait_for_requests(self, count):
+        deadline = time.time() + 5
+        while self._server.requests < count and time.time() < deadline:
+            time.sleep(0.01)
+        # let the refreshing thread update the cache
+        while self._supplier._refreshing and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_should_use_the_default_expiration(self):
+        self._server.serve_certificates(u"first")
+        self.assertEqual([u"first"], self._kids())
+        self._server.serve_certificates(u"second")
+        self._timer.time += 60
+        self.assertEqual([u"first"], self._kids())
+        self._timer.time += 5 * 60
+        self.assertEqual([u"second"], self._kids())
+        self.assertEqual(2, self._server.requests)
+
+    def test_should_use_the_cache_control_max_age(self):
+        self._server.headers = {u"Cache-Control": u"public, max-age=100"}
+        self._server.serve_certificates(u"first")
+        self.assertEqual([u"first"], self._kids())
+        self._server.serve_certificates(u"second")
+        self._timer.time += 50
+        self.assertEqual([u"first"], self._kids())
+        self._timer.time += 51
+        self.assertEqual([u"second"], self._kids())
+        self.assertEqual(2, self._server.requests)
+
+    def test_should_refresh_in_the_background_before_expiry(self):
+        self._server.headers = {u"Cache-Control": u"max-age=100"}
+        self._server.serve_certificates(u"first")
+        self.assertEqual([u"first"], self._kids())
+        self._server.serve_certificates(u"second")
+        self._timer.time += 81
+        # the cached keys are supplied while they are refreshed
+        self.assertEqual([u"first"], self._kids())
+        self._wait_for_requests(2)
+        self.assertEqual([u"second"], self._kids())
+        self.assertEqual(2, self._server.requests)
+
+    def test_should_supply_the_last_good_keys_until_the_max_age(self):
+        self._server.serve_certificates(u"first")
+        self.assertEqual([u"first"], self._kids())
+        self._server.fail()
+        self._timer.time += 6 * 60
+        self.assertEqual([u"first"], self._kids())
+        # the failed retrieval is not retried until the retry interval
+        self.assertEqual([u"first"], self._kids())
+        self.assertEqual(2, self._server.requests)
+        self._timer.time += self.MAX_AGE.total_seconds()
+        with self.assertRaises(suppliers.UnauthenticatedException):
+            self._supplier.supply(self.ISSUER)
+
+    def test_should_retry_failed_background_refreshes(self):
+        self._server.headers = {u"Cache-Control": u"max-age=100"}
+        self._server.serve_certificates(u"first")
+        self._kids()
+        self._server.fail()
+        self._timer.time += 81
+        self.assertEqual([u"first"], self._kids())
+        self._wait_for_requests(2)
+        self._server.serve_certificates(u"second")
+        self._timer.time += 10
+        self.assertEqual([u"first"], self._kids())
+        self.assertEqual(2, self._server.requests)
+        self._timer.time += suppliers.JwksSupplier.RETRY_INTERVAL.total_seconds()
+        # the retry is made in the background too
+        self.assertEqual([u"first"], self._kids())
+        self._wait_for_requests(3)
+        self.assertEqual([u"second"], self._kids())
+        self.assertEqual(3, self._server.requests)
+
+    def test_should_supply_expired_keys_while_they_are_retrieved(self):
+        self._server.serve_certificates(u"first")
+        self._kids()
+        self._server.serve_certificates(u"second")
+        self._timer.time += 6 * 60
+        with self._supplier._fetch_lock(self.ISSUER):
+            self.assertEqual([u"first"], self._kids())
+        self.assertEqual(1, self._server.requests)
+        self.assertEqual([u"second"], self._kids())
+
+    def test_should_time_out_requests_for_keys(self):
+        self._server.serve_certificates(u"first")
+        with mock.patch(u"requests.get", wraps=requests.get) as get:
+            self._kids()
+        get.assert_called_once_with(
+            self._server.uri, timeout=suppliers._REQUEST_TIMEOUT_SECS)
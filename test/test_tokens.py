@@ -75,6 +75,44 @@ class AuthenticatorTest(unittest.TestCase):
         actual_jwt_claims = self._authenticator.get_jwt_claims(auth_token)
         self.assertEqual(self._jwt_claims, actual_jwt_claims)
 
+    def _supply_indexed_keys(self):
+        keys = list(self._jwks._keys)
+        for index in range(3):
+            other_jwk = jwk.ECKey(use=u"sig").load_key(ecc.P256)
+            other_jwk.kid = u"other-key-id-%d" % index
+            keys.append(other_jwk)
+        self._jwks_supplier.supply.return_value = suppliers.VerificationKeys(keys)
+
+    def test_get_jwt_claims_with_indexed_keys(self):
+        self._supply_indexed_keys()
+        auth_token = token_utils.generate_auth_token(self._jwt_claims,
+                                                     self._jwks._keys,
+                                                     kid=self._ec_kid)
+        verify_compact = jws.JWS.verify_compact
+        with mock.patch.object(jws.JWS, u"verify_compact", autospec=True,
+                               side_effect=verify_compact) as verify:
+            actual_jwt_claims = self._authenticator.get_jwt_claims(auth_token)
+        self.assertEqual(self._jwt_claims, actual_jwt_claims)
+        tried_keys = verify.call_args[0][2]
+        self.assertEqual([self._ec_kid], [key.kid for key in tried_keys])
+
+    def test_get_jwt_claims_with_indexed_keys_without_kid(self):
+        self._supply_indexed_keys()
+        auth_token = token_utils.generate_auth_token(self._jwt_claims,
+                                                     self._jwks._keys)
+        actual_jwt_claims = self._authenticator.get_jwt_claims(auth_token)
+        self.assertEqual(self._jwt_claims, actual_jwt_claims)
+
+    def test_get_jwt_claims_with_indexed_keys_and_unknown_kid(self):
+        self._supply_indexed_keys()
+        unknown_jwk = jwk.ECKey(use=u"sig").load_key(ecc.P256)
+        unknown_jwk.kid = u"unknown-key-id"
+        auth_token = token_utils.generate_auth_token(self._jwt_claims,
+                                                     [unknown_jwk],
+                                                     kid=unknown_jwk.kid)
+        with self.assertRaises(suppliers.UnauthenticatedException):
+            self._authenticator.get_jwt_claims(auth_token)
+
     def test_required_claims(self):
         def assert_missing_claim_raise_exception(claim_name):
             jwt_claims = copy.deepcopy(self._jwt_claims)
@@ -0,0 +1,178 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+from builtins import object
+from apitools.base.py import exceptions
+import datetime
+import threading
+import mock
+import unittest2
+from expects import be_false, be_true, equal, expect, raise_error
+
+from endpoints_management.control import sc_messages, transport_pool
+
+
+class _Timer(object):
+    def __init__(self):
+        self.time = 0.0
+
+    def __call__(self):
+        return self.time
+
+    def tick(self, secs=1.0):
+        self.time += secs
+
+
+class TestTransportPool(unittest2.TestCase):
+
+    def setUp(self):
+        self.created = []
+        self.closed = []
+        self.warmed = []
+        self.timer = _Timer()
+
+    def _create_transport(self):
+        transport = mock.MagicMock()
+        transport.services.Check.return_value = sc_messages.CheckResponse(
+            operationId=u'%d' % (len(self.created),))
+        self.created.append(transport)
+        return transport
+
+    def _make_subject(self, **kw):
+        kw.setdefault(u'create_transport', self._create_transport)
+        kw.setdefault(u'warm_transport', self.warmed.append)
+        return transport_pool.TransportPool(
+            close_transport=self.closed.append, timer=self.timer, **kw)
+
+    def test_should_be_a_transport_factory(self):
+        subject = self._make_subject()
+        req = sc_messages.ServicecontrolServicesCheckRequest()
+        resp = subject().services.Check(req)
+        expect(resp).to(equal(sc_messages.CheckResponse(operationId=u'0')))
+        self.created[0].services.Check.assert_called_once_with(req)
+
+    def test_should_reuse_released_transports(self):
+        subject = self._make_subject()
+        for _ in range(3):
+            subject().services.Check(None)
+        expect(len(self.created)).to(equal(1))
+        expect(subject.stats()).to(equal(transport_pool.PoolStats(
+            size=subject.DEFAULT_SIZE, open=1, created=1, in_use=0, idle=1,
+            waits=0, timeouts=0, discarded=0)))
+
+    def test_should_create_transports_for_concurrent_calls(self):
+        subject = self._make_subject(size=2)
+        first = subject.acquire()
+        second = subject.acquire()
+        expect(first).not_to(equal(second))
+        stats = subject.stats()
+        expect(stats.in_use).to(equal(2))
+        expect(stats.idle).to(equal(0))
+        subject.release(first)
+        expect(subject.acquire()).to(equal(first))
+
+    def test_should_time_out_when_all_transports_are_in_use(self):
+        subject = self._make_subject(
+            size=1, acquire_timeout=datetime.timedelta(seconds=0))
+        subject.acquire()
+        expect(subject.acquire).to(
+            raise_error(transport_pool.PoolExhaustedError))
+        stats = subject.stats()
+        expect(stats.waits).to(equal(1))
+        expect(stats.timeouts).to(equal(1))
+        expect(stats.open).to(equal(1))
+
+    def test_should_wait_for_a_transport_to_be_released(self):
+        subject = transport_pool.TransportPool(
+            size=1, create_transport=self._create_transport)
+        first = subject.acquire()
+        acquired = []
+        waiter = threading.Thread(
+            target=lambda: acquired.append(subject.acquire()))
+        waiter.start()
+        while subject.stats().waits == 0:
+            waiter.join(0.01)
+        expect(acquired).to(equal([]))
+        subject.release(first)
+        waiter.join(5)
+        expect(acquired).to(equal([first]))
+        expect(len(self.created)).to(equal(1))
+
+    def test_should_close_transports_that_are_idle_too_long(self):
+        subject = self._make_subject(
+            idle_timeout=datetime.timedelta(seconds=5))
+        subject.release(subject.acquire())
+        self.timer.tick(6)
+        transport = subject.acquire()
+        expect(self.closed).to(equal([self.created[0]]))
+        expect(transport).to(equal(self.created[1]))
+        stats = subject.stats()
+        expect(stats.discarded).to(equal(1))
+        expect(stats.open).to(equal(1))
+        expect(stats.created).to(equal(2))
+
+    def test_should_keep_transports_idle_within_the_timeout(self):
+        subject = self._make_subject(
+            idle_timeout=datetime.timedelta(seconds=5))
+        subject.release(subject.acquire())
+        self.timer.tick(4)
+        subject.acquire()
+        expect(self.closed).to(equal([]))
+        expect(len(self.created)).to(equal(1))
+
+    def test_should_discard_transports_whose_connection_failed(self):
+        self._create_transport().services.Check.side_effect = (
+            exceptions.CommunicationError(u'connection reset'))
+        subject = self._make_subject(create_transport=lambda: self.created[0])
+        expect(lambda: subject().services.Check(None)).to(
+            raise_error(exceptions.CommunicationError))
+        expect(self.closed).to(equal([self.created[0]]))
+        stats = subject.stats()
+        expect(stats.open).to(equal(0))
+        expect(stats.discarded).to(equal(1))
+
+    def test_should_release_transports_after_other_errors(self):
+        self._create_transport().services.Check.side_effect = (
+            exceptions.HttpError({u'status': 503}, u'', u''))
+        subject = self._make_subject(create_transport=lambda: self.created[0])
+        expect(lambda: subject().services.Check(None)).to(
+            raise_error(exceptions.HttpError))
+        expect(self.closed).to(equal([]))
+        expect(subject.stats().idle).to(equal(1))
+
+    def test_should_prewarm_transports(self):
+        subject = self._make_subject(num_prewarmed=2)
+        subject.prewarm()
+        expect(self.warmed).to(equal(self.created))
+        expect(len(self.warmed)).to(equal(2))
+        stats = subject.stats()
+        expect(stats.idle).to(equal(2))
+        expect(stats.in_use).to(equal(0))
+
+    def test_should_not_fail_if_prewarming_fails(self):
+        def fail(transport):
+            raise exceptions.CommunicationError(u'no network')
+
+        subject = self._make_subject(warm_transport=fail)
+        subject.prewarm()
+        expect(subject.stats().idle).to(equal(1))
+
+    def test_should_close_idle_transports_on_clear(self):
+        subject = self._make_subject()
+        subject.release(subject.acquire())
+        subject.clear()
+        expect(self.closed).to(equal(self.created))
+        expect(subject.stats().open).to(equal(0))
@@ -21,11 +21,12 @@ import os
 import tempfile
 import unittest2
 import webtest
-from expects import be_false, be_none, be_true, expect, equal, raise_error
+from expects import be_a, be_false, be_none, be_true, expect, equal, raise_error
 
 from endpoints_management.auth import suppliers
 from endpoints_management.auth import tokens
-from endpoints_management.control import (client, report_request, service,
+from endpoints_management.control import (client, report_pipeline,
+                                          report_request, service,
                                           sc_messages, sm_messages, wsgi)
 
 
@@ -33,6 +34,16 @@ def _dummy_start_response(status, response_headers, exc_info=None):
     pass
 
 
+def _serve(app, environ):
+    """Calls app, then consumes and closes its result as a WSGI server would."""
+    result = app(environ, _dummy_start_response)
+    try:
+        return b''.join(result)
+    finally:
+        if hasattr(result, u'close'):
+            result.close()
+
+
 _DUMMY_RESPONSE = (b'This is the dummy app response.',)
 
 
@@ -78,6 +89,22 @@ class TestEnvironmentMiddleware(unittest2.TestCase):
         wrapped(given, _dummy_start_response)
         assert given[cls.METHOD_INFO].selector == 'allow-all.PATCH'
 
+    def test_should_cache_method_lookups_if_configured(self):
+        cls = wsgi.EnvironmentMiddleware
+        wrapped = cls(_DummyWsgiApp(), service.Loaders.SIMPLE.load(),
+                      lookup_cache_size=10)
+        for _ in range(3):
+            given = {
+                u'wsgi.url_scheme': u'http',
+                u'HTTP_HOST': u'localhost',
+                u'PATH_INFO': u'/any',
+                u'REQUEST_METHOD': u'GET'}
+            wrapped(given, _dummy_start_response)
+            expect(given[cls.METHOD_INFO].selector).to(equal(u'allow-all.GET'))
+        registry = given[cls.METHOD_REGISTRY]
+        expect(registry.lookup_cache_hits).to(equal(2))
+        expect(registry.lookup_cache_misses).to(equal(1))
+
 
 class TestMiddleware(unittest2.TestCase):
     PROJECT_ID = u'middleware'
@@ -96,7 +123,7 @@ class TestMiddleware(unittest2.TestCase):
         dummy_response = sc_messages.CheckResponse(
             operationId=u'fake_operation_id')
         wrapped = wsgi.Middleware(wrappee, self.PROJECT_ID, control_client)
-        wrapped(given, _dummy_start_response)
+        _serve(wrapped, given)
         expect(control_client.check.called).to(be_false)
         expect(control_client.report.called).to(be_false)
         expect(control_client.allocate_quota.called).to(be_false)
@@ -118,7 +145,7 @@ class TestMiddleware(unittest2.TestCase):
         wrapped = wsgi.EnvironmentMiddleware(with_control,
                                              service.Loaders.SIMPLE.load())
         control_client.check.return_value = dummy_response
-        wrapped(given, _dummy_start_response)
+        _serve(wrapped, given)
         expect(control_client.check.called).to(be_true)
         expect(control_client.report.called).to(be_true)
         # no quota definitions in this service config
@@ -146,7 +173,7 @@ class TestMiddleware(unittest2.TestCase):
                                control_client,
                                loader=service.Loaders.SIMPLE)
         control_client.check.return_value = dummy_response
-        wrapped(given, _dummy_start_response)
+        _serve(wrapped, given)
         expect(control_client.check.called).to(be_true)
         expect(control_client.report.called).to(be_true)
         expect(control_client.allocate_quota.called).to(be_false)
@@ -181,6 +208,22 @@ class TestMiddleware(unittest2.TestCase):
         resp = test_app.get('/any')
         assert resp.status_code == 200
 
+    def test_should_cache_lookups_in_the_registry_of_the_loaded_config(self):
+        control_client = mock.MagicMock(spec=client.Client)
+        loader = mock.MagicMock()
+        loader.load.side_effect = [None, service.Loaders.SIMPLE.load()]
+        result = wsgi.ConfigFetchWrapper(
+            _DummyWsgiApp(), self.PROJECT_ID, control_client,
+            loader=loader, disable_threading=True, lookup_cache_size=10)
+        given = {
+            u'wsgi.url_scheme': u'http',
+            u'HTTP_HOST': u'localhost',
+            u'PATH_INFO': u'/any',
+            u'REQUEST_METHOD': u'GET'}
+        result(given, _dummy_start_response)
+        registry = given[wsgi.EnvironmentMiddleware.METHOD_REGISTRY]
+        expect(registry.lookup_cache_misses).to(equal(1))
+
 
 
 _SYSTEM_PARAMETER_CONFIG_TEST = b"""
@@ -297,6 +340,107 @@ _SYSTEM_PARAMETER_CONFIG_TEST = b"""
 }
 """
 
+class _ClosingWsgiApp(object):
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def __call__(self, environ, start_response):
+        start_response("200 OK", [])
+        return self
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        self.closed = True
+
+
+class TestMiddlewareStreaming(unittest2.TestCase):
+    PROJECT_ID = u'middleware-streaming'
+
+    def setUp(self):
+        self._control_client = mock.MagicMock(spec=client.Client)
+        self._control_client.check.return_value = sc_messages.CheckResponse(
+            operationId=u'fake_operation_id')
+        method_info = service.MethodInfo(u'a-service.AMethod', None, None)
+        method_info.allow_unregistered_calls = True
+        self._given = {
+            u'wsgi.url_scheme': u'http',
+            u'PATH_INFO': u'/any',
+            u'REMOTE_ADDR': u'192.168.0.3',
+            u'HTTP_HOST': u'localhost',
+            u'REQUEST_METHOD': u'GET',
+            wsgi.EnvironmentMiddleware.METHOD_INFO: method_info,
+            wsgi.EnvironmentMiddleware.SERVICE: sm_messages.Service(
+                name=u'a-service'),
+            wsgi.EnvironmentMiddleware.SERVICE_NAME: u'a-service',
+            wsgi.EnvironmentMiddleware.REPORTING_RULES: (
+                report_request.ReportingRules()),
+        }
+
+    def test_should_pass_the_chunks_through_unchanged(self):
+        chunks = [b'first', b'second', b'third']
+        wrapped = wsgi.Middleware(_ClosingWsgiApp(chunks), self.PROJECT_ID,
+                                  self._control_client)
+        result = wrapped(self._given, _dummy_start_response)
+        expect(list(result)).to(equal(chunks))
+
+    def test_should_report_when_the_response_is_closed(self):
+        wrappee = _ClosingWsgiApp([b'first', b'second'])
+        wrapped = wsgi.Middleware(wrappee, self.PROJECT_ID,
+                                  self._control_client)
+        with mock.patch.object(wrapped, u'_create_report_request',
+                               wraps=wrapped._create_report_request) as create:
+            result = wrapped(self._given, _dummy_start_response)
+            for _ in result:
+                pass
+            expect(self._control_client.report.called).to(be_false)
+            result.close()
+            expect(wrappee.closed).to(be_true)
+            expect(self._control_client.report.call_count).to(equal(1))
+            app_info = create.call_args[0][2]
+            expect(app_info.response_size).to(equal(11))
+
+    def test_should_only_report_once_if_closed_repeatedly(self):
+        wrapped = wsgi.Middleware(_ClosingWsgiApp([b'first']), self.PROJECT_ID,
+                                  self._control_client)
+        result = wrapped(self._given, _dummy_start_response)
+        result.close()
+        result.close()
+        expect(self._control_client.report.call_count).to(equal(1))
+
+    def test_should_report_before_returning_when_buffered(self):
+        wrapped = wsgi.Middleware(_ClosingWsgiApp([b'first', b'second']),
+                                  self.PROJECT_ID, self._control_client,
+                                  buffer_response=True)
+        with mock.patch.object(wrapped, u'_create_report_request',
+                               wraps=wrapped._create_report_request) as create:
+            result = wrapped(self._given, _dummy_start_response)
+            expect(result).to(equal((b'firstsecond',)))
+            expect(self._control_client.report.call_count).to(equal(1))
+            app_info = create.call_args[0][2]
+            expect(app_info.response_size).to(equal(11))
+
+    def test_should_queue_reports_on_the_report_pipeline(self):
+        pipeline = mock.MagicMock(spec=report_pipeline.Pipeline)
+        wrapped = wsgi.Middleware(_ClosingWsgiApp([b'first', b'second']),
+                                  self.PROJECT_ID, self._control_client,
+                                  report_pipeline=pipeline)
+        result = wrapped(self._given, _dummy_start_response)
+        expect(list(result)).to(equal([b'first', b'second']))
+        result.close()
+        expect(self._control_client.report.called).to(be_false)
+        expect(pipeline.put.call_count).to(equal(1))
+        info, rules, template = pipeline.put.call_args[0]
+        expect(info.response_size).to(equal(11))
+        expect(info.operation_name).to(equal(u'a-service.AMethod'))
+        expect(rules).to(equal(
+            self._given[wsgi.EnvironmentMiddleware.REPORTING_RULES]))
+        expect(template).to(be_a(report_request.Template))
+
+
 class TestMiddlewareWithParams(unittest2.TestCase):
     PROJECT_ID = u'middleware-with-params'
 
@@ -328,7 +472,7 @@ class TestMiddlewareWithParams(unittest2.TestCase):
                                control_client,
                                loader=service.Loaders.ENVIRONMENT)
         control_client.check.return_value = dummy_response
-        wrapped(given, _dummy_start_response)
+        _serve(wrapped, given)
         expect(control_client.check.called).to(be_true)
         req = control_client.check.call_args[0][0]
         expect(req.checkRequest.operation.consumerId).to(
@@ -355,7 +499,7 @@ class TestMiddlewareWithParams(unittest2.TestCase):
         control_client.check.return_value = dummy_response
         control_client.allocate_quota.side_effect = lambda req: sc_messages.AllocateQuotaResponse(
             operationId=req.allocateQuotaRequest.allocateOperation.operationId)
-        wrapped(given, _dummy_start_response)
+        _serve(wrapped, given)
         expect(control_client.check.called).to(be_true)
         req = control_client.check.call_args[0][0]
         expect(req.checkRequest.operation.consumerId).to(
@@ -381,7 +525,7 @@ class TestMiddlewareWithParams(unittest2.TestCase):
                                control_client,
                                loader=service.Loaders.ENVIRONMENT)
         control_client.check.return_value = dummy_response
-        wrapped(given, _dummy_start_response)
+        _serve(wrapped, given)
         expect(control_client.check.called).to(be_true)
         check_req = control_client.check.call_args[0][0]
         expect(check_req.checkRequest.operation.consumerId).to(
@@ -410,7 +554,7 @@ class TestMiddlewareWithParams(unittest2.TestCase):
                                control_client,
                                loader=service.Loaders.ENVIRONMENT)
         control_client.check.return_value = dummy_response
-        wrapped(given, _dummy_start_response)
+        _serve(wrapped, given)
         expect(control_client.check.called).to(be_true)
         check_request = control_client.check.call_args_list[0].checkRequest
         check_req = control_client.check.call_args[0][0]
@@ -441,7 +585,7 @@ class TestMiddlewareWithParams(unittest2.TestCase):
                                    control_client,
                                    loader=service.Loaders.ENVIRONMENT)
             control_client.check.return_value = dummy_response
-            wrapped(given, _dummy_start_response)
+            _serve(wrapped, given)
             expect(control_client.check.called).to(be_true)
             check_request = control_client.check.call_args_list[0].checkRequest
             check_req = control_client.check.call_args[0][0]
@@ -470,7 +614,7 @@ class TestMiddlewareWithParams(unittest2.TestCase):
                                control_client,
                                loader=service.Loaders.ENVIRONMENT)
         control_client.check.return_value = dummy_response
-        wrapped(given, _dummy_start_response)
+        _serve(wrapped, given)
         expect(control_client.check.called).to(be_false)
         expect(control_client.report.called).to(be_true)
         report_req = control_client.report.call_args[0][0]